@@ -0,0 +1,272 @@
+"""Micro-benchmarks for model kernels, run on CPU / GPU with a placement mesh.
+
+Usage:
+    python3 benchmarks.py linear_attention --seq_len 2048 --dim_head 128
+    python3 benchmarks.py sampling --batch_size 8 --vocab_size 50257
+    python3 benchmarks.py prefill --batch_size 8 --seq_len 1024 --chunk_sizes 64 128
+    python3 benchmarks.py records --seq_len 2048 --batch_size 8
+"""
+import argparse
+import os
+import tempfile
+import time
+from collections import defaultdict
+from functools import partial
+
+import numpy as np
+import mesh_tensorflow as mtf
+import tensorflow.compat.v1 as tf
+from mesh_tensorflow import placement_mesh_impl
+
+import mesh_tensorflow.transformer as mtf_transformer
+
+from models.layers import causal_linear_attention, chunked_causal_linear_attention, blockwise_attention
+from models.gpt2 import gpt2
+from models.utils import biasmask_attn_weights, entmax, sample_categorical
+from inputs import sequential_input
+from sample import sample_logits, prefill_in_chunks
+
+
+def largest_activation(graph):
+    # Size (in elements) of the largest tensor in an mtf graph - a proxy for peak activation memory
+    return max(t.shape.size for op in graph.operations for t in op.outputs)
+
+
+def time_mtf_fn(build_fn, n_iters=10, gpu_ids=("",)):
+    """
+    Builds an mtf graph with build_fn(mesh) -> list of mtf.Tensors, lowers it and times running the outputs.
+
+    :return: (seconds per iteration, largest activation in elements)
+    """
+    with tf.Graph().as_default():
+        graph = mtf.Graph()
+        mesh = mtf.Mesh(graph, "bench_mesh")
+        outputs = build_fn(mesh)
+        activation_size = largest_activation(graph)
+
+        mesh_impl = placement_mesh_impl.PlacementMeshImpl(shape=[], layout={}, devices=list(gpu_ids))
+        lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+        tf_outputs = [lowering.export_to_tf_tensor(t) for t in outputs]
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(tf_outputs)  # warmup
+            start = time.time()
+            for _ in range(n_iters):
+                sess.run(tf_outputs)
+            return (time.time() - start) / n_iters, activation_size
+
+
+def _report(name, seconds, activation_size):
+    print(f"{name:<40} {seconds * 1000:>10.2f} ms {activation_size:>16,} elements")
+
+
+def _attention_fwd_bwd(args, attn_fn, memory_length_name="sequence"):
+    # Returns a build_fn running attn_fn(q, k, v) forwards and backwards on random inputs
+    batch_dim = mtf.Dimension("batch", args.batch_size)
+    seq_dim = mtf.Dimension("sequence", args.seq_len)
+    memory_length_dim = mtf.Dimension(memory_length_name, args.seq_len)
+    heads_dim = mtf.Dimension("heads", args.n_head)
+    kv_dim = mtf.Dimension("features_per_head", args.dim_head)
+
+    def _random(mesh, length_dim):
+        shape = mtf.Shape([batch_dim, length_dim, heads_dim, kv_dim])
+        return mtf.import_tf_tensor(mesh, tf.random.normal(shape.to_integer_list, stddev=0.1), shape)
+
+    def build_fn(mesh):
+        q, k, v = _random(mesh, seq_dim), _random(mesh, memory_length_dim), _random(mesh, memory_length_dim)
+        out = attn_fn(q, k, v)
+        loss = mtf.reduce_sum(out)
+        grads = mtf.gradients([loss], [q, k, v])
+        return [loss] + grads
+    return build_fn
+
+
+def benchmark_linear_attention(args):
+    """Forward + backward of causal_linear_attention vs chunked_causal_linear_attention"""
+    _build = partial(_attention_fwd_bwd, args)
+
+    print(f"{'implementation':<40} {'time':>13} {'largest activation':>25}")
+    _report("causal_linear_attention", *time_mtf_fn(_build(causal_linear_attention), args.n_iters))
+    for chunk_size in args.chunk_sizes:
+        attn_fn = lambda q, k, v: chunked_causal_linear_attention(q, k, v, chunk_size=chunk_size)
+        _report(f"chunked_causal_linear_attention ({chunk_size})", *time_mtf_fn(_build(attn_fn), args.n_iters))
+
+
+def benchmark_global_attention(args):
+    """Forward + backward of causal dot-product attention vs blockwise_attention"""
+    _build = partial(_attention_fwd_bwd, args, memory_length_name="memory_length")
+
+    def dense_attention(q, k, v):
+        seq_dim, memory_length_dim, kv_dim = q.shape[1], k.shape[1], k.shape[-1]
+        bias = biasmask_attn_weights(q.mesh, seq_dim, memory_length_dim, mtf.VariableDType(tf.float32))
+        if args.broadcast_bias:
+            bias = mtf.broadcast(bias, [q.shape[0], q.shape[2], seq_dim, memory_length_dim])
+        return mtf_transformer.attention.attention(q, k, v, memory_length_dim, kv_dim, kv_dim, bias=bias)
+
+    print(f"{'implementation':<40} {'time':>13} {'largest activation':>25}")
+    _report("attention", *time_mtf_fn(_build(dense_attention), args.n_iters))
+    for block_size in args.block_sizes:
+        attn_fn = lambda q, k, v: blockwise_attention(q, k, v, k.shape[1], k.shape[-1], v.shape[-1],
+                                                      block_size=block_size, recompute=True)
+        _report(f"blockwise_attention ({block_size})", *time_mtf_fn(_build(attn_fn), args.n_iters))
+
+
+def benchmark_sampling(args):
+    """Per step latency of each sampling mode, on [batch_size, vocab_size] logits"""
+    batch_dim = mtf.Dimension("batch", args.batch_size)
+    vocab_dim = mtf.Dimension("vocab", args.vocab_size)
+
+    def _build(sample_fn):
+        def build_fn(mesh):
+            shape = mtf.Shape([batch_dim, vocab_dim])
+            logits = mtf.import_tf_tensor(mesh, tf.random.normal(shape.to_integer_list, stddev=3.), shape)
+            return [sample_fn(logits)]
+        return build_fn
+
+    def masked_top_k(logits):
+        # Top k by masking the whole vocab, as sample_autoregressive used to
+        k_largest = mtf.nth_largest_element(logits, n=args.top_k, reduced_dim=vocab_dim)
+        logits = mtf.where(mtf.less_equal(logits, k_largest), mtf.ones_like(logits) * -1e6, logits)
+        return mtf.sample_with_temperature(logits, vocab_dim, 0.9)
+
+    def cumsum_categorical(probs):
+        # Inverse cdf sampling, as sample_categorical used to
+        cdf = mtf.cumsum(probs, vocab_dim)
+        rand_uniform = mtf.random_uniform(probs.mesh, probs.shape - vocab_dim, minval=0, maxval=1)
+        return mtf.argmax(mtf.cast(mtf.greater(cdf, rand_uniform), tf.int32), vocab_dim)
+
+    modes = [
+        ("temperature", lambda x: sample_logits(x, vocab_dim)),
+        (f"top_k {args.top_k} (masked)", masked_top_k),
+        (f"top_k {args.top_k}", lambda x: sample_logits(x, vocab_dim, sampling_keep_top_k=args.top_k)),
+        (f"top_p {args.top_p}", lambda x: sample_logits(x, vocab_dim, sampling_top_p=args.top_p)),
+        (f"top_k {args.top_k} + top_p {args.top_p}",
+         lambda x: sample_logits(x, vocab_dim, sampling_keep_top_k=args.top_k, sampling_top_p=args.top_p)),
+        ("categorical (gumbel-max)", lambda x: sample_categorical(mtf.softmax(x, vocab_dim), vocab_dim)),
+        ("entmax", lambda x: sample_logits(x, vocab_dim, sampling_use_entmax=True)),
+    ]
+    # The cumsum is an einsum with a [vocab, vocab] mask, which doesn't fit in memory for real vocab sizes
+    if args.vocab_size <= 8192:
+        modes.append(("categorical (cumsum)", lambda x: cumsum_categorical(mtf.softmax(x, vocab_dim))))
+
+    print(f"{'mode':<40} {'time':>13} {'largest activation':>25}")
+    for name, sample_fn in modes:
+        _report(name, *time_mtf_fn(_build(sample_fn), args.n_iters))
+
+
+def benchmark_prefill(args):
+    """Prefill of a batch of full length prompts, in one first_part pass vs in chunks"""
+    params = defaultdict(lambda: None, {
+        "n_head": args.n_head, "n_embd": args.n_head * args.dim_head, "n_ctx": args.seq_len, "n_vocab": args.vocab_size,
+        "n_layer": args.n_layer, "attention_types": ["global"] * args.n_layer, "activation_function": "gelu",
+        "mode": "predict", "res_dropout": 0., "attn_dropout": 0., "embed_dropout": 0., "mesh_shape": [], "layout": {}
+    })
+    variable_dtype = mtf.VariableDType(tf.float32)
+    batch_dim = mtf.Dimension("batch", args.batch_size)
+    length_dim = mtf.Dimension("sequence", args.seq_len)
+    memory_length_dim = mtf.Dimension("memory_length", args.seq_len)
+
+    def _build(chunk_size):
+        def build_fn(mesh):
+            other_features = {
+                "attn_bias": biasmask_attn_weights(mesh, length_dim, memory_length_dim, variable_dtype),
+                "embd_dim": mtf.Dimension("embd", params["n_embd"]),
+                "vocab_dim": mtf.Dimension("vocab", params["n_vocab"]),
+                "embed_sequence_dim": mtf.Dimension("embed_sequence", args.seq_len),
+                "memory_length_dim": memory_length_dim
+            }
+            shape = mtf.Shape([batch_dim, length_dim])
+            inputs = mtf.import_tf_tensor(mesh, tf.random.uniform(shape.to_integer_list, 1, args.vocab_size, tf.int32),
+                                          shape)
+            initial_position = mtf.constant(mesh, args.seq_len, mtf.Shape([batch_dim]), tf.int32)
+            if chunk_size:
+                return prefill_in_chunks(inputs, other_features, params, initial_position, chunk_size, variable_dtype)
+            context = mtf_transformer.transformer.Context(
+                model=None, mesh=mesh, batch_dims=[batch_dim], length_dim=length_dim, variable_dtype=variable_dtype,
+                mode="first_part", position=mtf.range(mesh, length_dim, tf.int32), position_is_default=True,
+                new_states=[], initial_position=initial_position, inputs=inputs)
+            with tf.variable_scope("gpt2", reuse=tf.AUTO_REUSE):
+                gpt2.model({"inputs": inputs}, other_features, params, mesh, variable_dtype=variable_dtype,
+                           context=context)
+            return context.new_states
+        return build_fn
+
+    print(f"{'implementation':<40} {'time':>13} {'largest activation':>25}")
+    _report("first_part", *time_mtf_fn(_build(None), args.n_iters))
+    for chunk_size in args.chunk_sizes:
+        _report(f"prefill_in_chunks ({chunk_size})", *time_mtf_fn(_build(chunk_size), args.n_iters))
+
+
+def benchmark_records(args):
+    """Size and sequential_input read throughput of a synthetic shard, as tf.train.Examples vs packed records"""
+    n_records = args.n_records - args.n_records % args.batch_size
+    tokens = np.random.RandomState(0).randint(0, args.vocab_size, size=(n_records, args.seq_len + 1))
+    params = defaultdict(lambda: None, {"n_ctx": args.seq_len, "train_batch_size": args.batch_size, "iterations": 1,
+                                        "shuffle_input_filenames": False})
+
+    print(f"{'format':<40} {'size':>13} {'records / s':>25}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for packed_dtype in [None, "uint16", "uint32"]:
+            if packed_dtype == "uint16" and args.vocab_size > 2 ** 16:
+                continue
+            path = os.path.join(tmp_dir, f"shard{'_' + packed_dtype if packed_dtype else ''}_{n_records}.tfrecords")
+            with tf.io.TFRecordWriter(path) as writer:
+                for chunk in tokens:
+                    if packed_dtype:
+                        writer.write(chunk.astype(np.dtype(packed_dtype).newbyteorder("<")).tobytes())
+                    else:
+                        feature = {"text": tf.train.Feature(int64_list=tf.train.Int64List(value=chunk))}
+                        example = tf.train.Example(features=tf.train.Features(feature=feature))
+                        writer.write(example.SerializeToString())
+
+            with tf.Graph().as_default():
+                params["dataset_configs"] = {"shard": {"path": path}}
+                next_batch = tf.data.make_one_shot_iterator(sequential_input(params, global_step=0)).get_next()
+                n_batches = n_records // args.batch_size
+                with tf.Session() as sess:
+                    sess.run(next_batch)  # warmup
+                    start = time.time()
+                    for _ in range(args.n_iters * n_batches):
+                        sess.run(next_batch)
+                    seconds = time.time() - start
+            print(f"{packed_dtype or 'tf.train.Example':<40} {os.path.getsize(path) / 2 ** 20:>10.2f} MB "
+                  f"{args.n_iters * n_records / seconds:>25,.0f}")
+
+
+BENCHMARKS = {
+    "linear_attention": benchmark_linear_attention,
+    "global_attention": benchmark_global_attention,
+    "sampling": benchmark_sampling,
+    "prefill": benchmark_prefill,
+    "records": benchmark_records,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", type=str, choices=list(BENCHMARKS.keys()), help="Which benchmark to run.")
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--seq_len", type=int, default=512)
+    parser.add_argument("--n_head", type=int, default=4)
+    parser.add_argument("--dim_head", type=int, default=64)
+    parser.add_argument("--chunk_sizes", nargs="+", type=int, default=[32, 64, 128],
+                        help="Chunk sizes to benchmark chunked linear attention / chunked prefill with.")
+    parser.add_argument("--block_sizes", nargs="+", type=int, default=[128, 256, 512],
+                        help="Block sizes to benchmark blockwise global attention with.")
+    parser.add_argument("--broadcast_bias", action="store_true",
+                        help="Broadcast the causal bias across batch and heads before adding it to the attention "
+                             "logits (the pre-implicit-masking behaviour).")
+    parser.add_argument("--n_layer", type=int, default=2, help="Number of layers of the model to benchmark prefill with.")
+    parser.add_argument("--vocab_size", type=int, default=50257, help="Vocab size to benchmark sampling with.")
+    parser.add_argument("--top_k", type=int, default=40, help="k to benchmark top k sampling with.")
+    parser.add_argument("--top_p", type=float, default=0.9, help="p to benchmark top p sampling with.")
+    parser.add_argument("--n_records", type=int, default=1024, help="Number of records to benchmark reading with.")
+    parser.add_argument("--n_iters", type=int, default=10, help="Number of timed iterations.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    tf.disable_v2_behavior()
+    args = parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -1,8 +1,11 @@
 import argparse
+import hashlib
+import json
 import os
 from pathlib import Path
 
 import ftfy
+import numpy as np
 import tensorflow as tf
 from lm_dataformat import Reader
 from tokenizers import Tokenizer
@@ -10,7 +13,7 @@ from transformers import GPT2TokenizerFast
 from tqdm import tqdm
 import logging
 from multiprocessing import Pool, cpu_count
-from itertools import repeat
+from itertools import islice
 import re
 
 logging.getLogger("transformers").setLevel(logging.ERROR)
@@ -31,15 +34,30 @@ parser.add_argument("--separator", nargs="+", type=int, default=[50256],
                     help="separator to place between files in chunk mode")
 parser.add_argument("--chunk_size", type=int, default=2048, help="How big a chunk should be in chunk mode. "
                                                                  "Should equal your model's context size")
+parser.add_argument("--packed_dtype", type=str, default=None, choices=["uint16", "uint32"],
+                    help="If set, store each chunk as the raw little endian bytes of this dtype rather than as a "
+                         "tf.train.Example. Much smaller and faster to read, but only for chunk mode data.")
+parser.add_argument("--flat", action="store_true",
+                    help="Write each file as a flat .bin of tokens (in --packed_dtype, uint16 if unset) plus an .idx "
+                         "of chunk offsets, instead of a .tfrecords file. Read with inputs.flat_input / FlatTokenShards.")
 parser.add_argument("--write_dataset_config", action="store_true", help="Write the dataset config file on completion")
 parser.add_argument("--processes", type=int, default=0, help="Number of processes to use. Defaults to cpu count.")
-
-args = parser.parse_args()
-if not args.output_dir.endswith("/"):
-    args.output_dir = args.output_dir + "/"
-if not args.input_dir.endswith("/"):
-    args.input_dir = args.input_dir + "/"
-assert len(args.separator) == 1
+parser.add_argument("--tasks_per_process", type=int, default=4,
+                    help="With multiple processes, the input files are split into this many groups per process, which "
+                         "are handed to whichever process is idle.")
+parser.add_argument("--tokenize_batch_size", type=int, default=1024,
+                    help="Number of documents to tokenize at once. Batches are tokenized in parallel by the tokenizer.")
+
+
+def parse_args(argv=None):
+    args = parser.parse_args(argv)
+    if not args.output_dir.endswith("/"):
+        args.output_dir = args.output_dir + "/"
+    if not args.input_dir.endswith("/"):
+        args.input_dir = args.input_dir + "/"
+    assert len(args.separator) == 1
+    args.chunk_size += 1  # we shift the data by 1 to the right for targets, so increment the chunk size here
+    return args
 
 
 def wikitext_detokenizer(string):
@@ -83,15 +101,53 @@ def _int64_feature(value):
     return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
 
 
-def write_to_file(writer, data):
+def write_to_file(writer, data, packed_dtype=None, sha256=None):
+    """
+    writes data to tfrecord file, as a tf.train.Example or as the raw bytes of packed_dtype. If given, the record is
+    also added to the hashlib sha256
+    """
+    if packed_dtype is not None:
+        packed = np.asarray(data, dtype=np.dtype(packed_dtype).newbyteorder("<"))
+        if not np.array_equal(packed, data):
+            raise ValueError(f"Token ids don't fit in {packed_dtype}")
+        record = packed.tobytes()
+    else:
+        feature = {
+            "text": _int64_feature(data)
+        }
+        tf_example = tf.train.Example(features=tf.train.Features(feature=feature))
+        record = tf_example.SerializeToString()
+    if sha256 is not None:
+        sha256.update(record)
+    writer.write(record)
+
+
+def write_manifest(fp, n_records, sha256, packed_dtype=None):
+    """
+    writes the sidecar manifest <fp>.json of a finished tfrecords file: its number of records, size in bytes, the
+    sha256 hex digest of its records and its packed dtype. inputs.py goes by the manifest rather than the filename, so
+    files can be renamed along with it
+    """
+    manifest = {"n_records": n_records, "n_bytes": os.path.getsize(fp), "sha256": sha256,
+                "packed_dtype": packed_dtype}
+    with open(fp + ".json", "w") as f:
+        json.dump(manifest, f)
+
+
+def write_flat_file(fp, data, packed_dtype):
     """
-    writes data to tfrecord file
+    writes a list of chunks to <fp>.bin as a flat array of little endian packed_dtype tokens, and the token offsets of
+    the chunks (n_chunks + 1 int64s, as a .npy) to <fp>.idx - so any chunk can be read from a memmap of the .bin
     """
-    feature = {
-        "text": _int64_feature(data)
-    }
-    tf_example = tf.train.Example(features=tf.train.Features(feature=feature))
-    writer.write(tf_example.SerializeToString())
+    tokens = np.concatenate([np.asarray(chunk, dtype=np.int64) for chunk in data]) if data else np.zeros([0], np.int64)
+    packed = tokens.astype(np.dtype(packed_dtype).newbyteorder("<"))
+    if not np.array_equal(packed, tokens):
+        raise ValueError(f"Token ids don't fit in {packed_dtype}")
+    offsets = np.cumsum([0] + [len(chunk) for chunk in data], dtype=np.int64)
+    with open(fp + ".bin", "wb") as f:
+        f.write(packed.tobytes())
+    with open(fp + ".idx", "wb") as f:
+        np.save(f, offsets.astype(np.dtype("<i8")))
 
 
 def get_tokenizer(args):
@@ -101,27 +157,50 @@ def get_tokenizer(args):
         return Tokenizer.from_file(args.encoder_path)
 
 
+def encode_batch(encoder, docs):
+    # GPT2TokenizerFast and Tokenizer have different names for their batch encoding - both tokenize the batch in
+    # parallel, outside of python
+    if isinstance(encoder, Tokenizer):
+        return [encoding.ids for encoding in encoder.encode_batch(docs)]
+    return encoder(docs)["input_ids"]
+
+
 def split_list(l, n):
     # splits list/string into n size chunks
     return [l[i:i + n] for i in range(0, len(l), n)]
 
 
+def batched(iterable, n):
+    # yields lists of n items of iterable, the last one possibly shorter
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, n))
+        if not batch:
+            return
+        yield batch
+
+
 def archive_to_tokens(f, encoder, args, prefix=[]):
     # Generator that yields the contents of the files in an archive
     # if data_to_prepend is not None, prepend data_to_prepend + a EOS separator to the encoded data
     reader = Reader(f)
-    for doc in reader.stream_data(threaded=False):
+    for docs in batched(reader.stream_data(threaded=False), args.tokenize_batch_size):
         if args.ftfy:  # fix text with ftfy if specified
-            doc = ftfy.fix_text(doc, normalization='NFKC')
+            docs = [ftfy.fix_text(doc, normalization='NFKC') for doc in docs]
         if args.wikitext_detokenize:
-            doc = wikitext_detokenizer(doc)
-        doc = encoder.encode(doc) + args.separator  # read document from lmd and append separator token
-        yield split_list(prefix + doc, args.chunk_size)  # split into n_ctx + 1 size chunks
-        prefix = []
-
-
-def write_files(files, files_per, output_dir, out_name, start_no, write_remainder=False, process_no=None):
-    # writes a list of files to .tfrecords
+            docs = [wikitext_detokenizer(doc) for doc in docs]
+        for doc in encode_batch(encoder, docs):
+            doc = doc + args.separator  # append separator token
+            yield split_list(prefix + doc, args.chunk_size)  # split into n_ctx + 1 size chunks
+            prefix = []
+
+
+def write_files(files, files_per, output_dir, out_name, start_no, write_remainder=False, process_no=None,
+                packed_dtype=None, flat=False):
+    # writes a list of files to .tfrecords, each with a sidecar manifest, or to .bin / .idx pairs if flat. Packed
+    # and flat files are tagged with their dtype
+    if flat and packed_dtype is None:
+        packed_dtype = "uint16"
     if files == None:
         return
     chunks = split_list(files, files_per)
@@ -138,11 +217,19 @@ def write_files(files, files_per, output_dir, out_name, start_no, write_remainde
         fp = f"{output_dir}/{out_name}_{start_no}"
         if process_no is not None:
             fp += f"_{process_no}"
+        if packed_dtype is not None:
+            fp += f"_{packed_dtype}"
         fp += f"_{files_per}"  # add number of files in tfrecord to end of fp
+        if flat:
+            write_flat_file(fp, files, packed_dtype)
+            start_no += 1
+            continue
         fp += ".tfrecords"
+        sha256 = hashlib.sha256()
         with tf.io.TFRecordWriter(fp) as writer:
             for f in files:
-                write_to_file(writer, f)
+                write_to_file(writer, f, packed_dtype=packed_dtype, sha256=sha256)
+        write_manifest(fp, len(files), sha256.hexdigest(), packed_dtype=packed_dtype)
         start_no += 1
     return start_no, remainder
 
@@ -211,7 +298,8 @@ def create_tfrecords(params, write_remainder=True, write_every_n_files=1, save_c
             if len(tokenized_files_array) >= args.files_per * write_every_n_files:  # write every n files
                 _tfrecord_count, remainder = write_files(tokenized_files_array, files_per=args.files_per,
                                                          output_dir=args.output_dir, out_name=args.name,
-                                                         start_no=tfrecord_count, process_no=process_no)
+                                                         start_no=tfrecord_count, process_no=process_no,
+                                                         packed_dtype=args.packed_dtype, flat=args.flat)
                 pbar.update(_tfrecord_count - tfrecord_count)  # update progress bar
                 pbar.set_description(
                     f"Writing TFRecord Files to {args.output_dir}. Parsed {files_processed} input files. files_written ")
@@ -223,7 +311,8 @@ def create_tfrecords(params, write_remainder=True, write_every_n_files=1, save_c
     if len(tokenized_files_array) >= args.files_per:  # also write at end
         _tfrecord_count, remainder = write_files(tokenized_files_array, files_per=args.files_per,
                                                  output_dir=args.output_dir, out_name=args.name,
-                                                 start_no=tfrecord_count, process_no=process_no)
+                                                 start_no=tfrecord_count, process_no=process_no,
+                                                 packed_dtype=args.packed_dtype, flat=args.flat)
         pbar.update(_tfrecord_count - tfrecord_count)
         pbar.set_description(
             f"Writing TFRecord Files to {args.output_dir}. Parsed {files_processed} input files. files_written ")
@@ -236,28 +325,48 @@ def create_tfrecords(params, write_remainder=True, write_every_n_files=1, save_c
     if write_remainder:
         # write out the remaining files even if there's less than files_per
         write_files(remainder, files_per=args.files_per, output_dir=args.output_dir, out_name=args.name,
-                    start_no=tfrecord_count, write_remainder=True)
+                    start_no=tfrecord_count, write_remainder=True, process_no=process_no,
+                    packed_dtype=args.packed_dtype, flat=args.flat)
 
     successful_files = files_processed - discarded_files
     return {"discarded": discarded_files, "processed": files_processed, "successful": successful_files}
 
 
+def schedule_files(files, n_tasks):
+    # splits files into at most n_tasks groups of consecutive files of about the same total size, returned as
+    # (task_no, files) largest first
+    sizes = [os.path.getsize(f) for f in files]
+    target_size = sum(sizes) / n_tasks
+    tasks, task_files, task_size = [], [], 0
+    for f, size in zip(files, sizes):
+        if task_files and task_size + size > target_size and len(tasks) < n_tasks - 1:
+            tasks.append((task_size, len(tasks), task_files))
+            task_files, task_size = [], 0
+        task_files.append(f)
+        task_size += size
+    if task_files:
+        tasks.append((task_size, len(tasks), task_files))
+    return [(task_no, task_files) for _, task_no, task_files in sorted(tasks, key=lambda t: (-t[0], t[1]))]
+
+
 def create_tfrecords_mp(files, args):
-    files = split_list(files, len(files) // args.processes)
+    # idle processes take the next group of files from the pool's queue, so a slow archive only holds up its own
+    # process. Output files are numbered by group rather than by process, which keeps them deterministic
+    tasks = schedule_files(files, args.processes * args.tasks_per_process)
     with Pool(processes=args.processes) as pool:
-        pbar = tqdm(pool.imap(create_tfrecords, zip(files, repeat(args), range(len(files)))))
+        pbar = tqdm(pool.imap_unordered(create_tfrecords, [(task_files, args, task_no) for task_no, task_files in tasks]),
+                    total=len(tasks))
         meta = {"discarded": 0, "processed": 0, "successful": 0}
         for results in pbar:
-            pbar.update()
             for k, v in results.items():
                 meta[k] += v  # update metadata
         return meta
 
 
 if __name__ == "__main__":
+    args = parse_args()
     os.makedirs(args.output_dir, exist_ok=True)  # make output dir if it doesn't exist
     files = get_files(args.input_dir)
-    args.chunk_size += 1  # we shift the data by 1 to the right for targets, so increment the chunk size here
 
     if args.processes == 0:
         args.processes = cpu_count()
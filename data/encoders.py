@@ -26,3 +26,11 @@ def encode(encoder, text):
     if isinstance(result, list):
         return result
     return result.ids
+
+
+# GPT2TokenizerFast and Tokenizer have different names for their batch decoding
+def decode_batch(encoder, token_lists):
+    token_lists = [list(map(int, tokens)) for tokens in token_lists]
+    if hasattr(encoder, "batch_decode"):
+        return encoder.batch_decode(token_lists)
+    return encoder.decode_batch(token_lists)
@@ -1,11 +1,15 @@
 import numpy as np
 import tensorflow.compat.v1 as tf
 from functools import partial
-from data.encoders import encode
+from data.encoders import encode, decode_batch
 import random
 import re
+import json
+import os
 import logging
-from itertools import cycle
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from utils import natural_sort
 
 
@@ -18,6 +22,59 @@ def _get_number_of_documents(filename):
     return int(match.group(1)) if match is not None else match
 
 
+def _glob_input_files(path):
+    # globs the tfrecords files of a dataset path, leaving out the manifests create_tfrecords.py writes next to them
+    return [f for f in tf.io.gfile.glob(path) if not f.endswith(".json")]
+
+
+def _get_shard_manifest(filename):
+    # reads the sidecar manifest "<filename>.json" create_tfrecords.py writes next to each tfrecords file, with its
+    # number of records, size in bytes, sha256 of its records and packed dtype. The sha256 is informational - checking
+    # it would mean reading the whole file.
+    # Returns None for files without one, and for files whose name already gives their number of records (and
+    # packed dtype), so those cost no round trips
+    if _get_number_of_documents(filename) is not None:
+        return None
+    manifest_path = filename + ".json"
+    try:
+        with tf.io.gfile.GFile(manifest_path) as f:
+            manifest = json.load(f)
+    except tf.errors.NotFoundError:
+        return None
+    n_bytes = tf.io.gfile.stat(filename).length
+    if n_bytes != manifest["n_bytes"]:
+        raise ValueError(f"{filename} is {n_bytes} bytes, but its manifest {manifest_path} is for a file of "
+                         f"{manifest['n_bytes']} bytes")
+    return manifest
+
+
+def _get_shard_manifests(filenames):
+    # _get_shard_manifest of each of filenames, read in parallel as each one is a round trip on GCS
+    if not filenames:
+        return []
+    with ThreadPoolExecutor(max_workers=min(32, len(filenames))) as executor:
+        return list(executor.map(_get_shard_manifest, filenames))
+
+
+def _get_packed_dtype(filename, manifest=None):
+    # the dtype of packed records, from the file's manifest or else from a filename formatted
+    # "<name>_<dtype>_<num_documents>.tfrecords". returns None for tfrecords of tf.train.Examples
+    if manifest is not None:
+        return manifest["packed_dtype"]
+    match = re.search(r"_(uint16|uint32)_\d+\.tfrecords$", filename)
+    return match.group(1) if match is not None else None
+
+
+def _get_files_packed_dtype(filenames, manifests=None):
+    # the packed dtype shared by all of filenames - a dataset can't mix record formats
+    if manifests is None:
+        manifests = _get_shard_manifests(filenames)
+    packed_dtypes = set(_get_packed_dtype(f, manifest) for f, manifest in zip(filenames, manifests))
+    if len(packed_dtypes) > 1:
+        raise ValueError(f"Input files mix record formats: {packed_dtypes} (None is tf.train.Example)")
+    return packed_dtypes.pop() if packed_dtypes else None
+
+
 def _get_number_of_documents_by_iteration(filename):
     # extracts number of files from a tfrecord document in the event it doesn't have metadata in the filename
     # this could be very slow.
@@ -29,27 +86,35 @@ def _get_number_of_documents_by_iteration(filename):
     return count
 
 
-def _get_skip_index(all_files, n_batches):
-    prev_cumsum = 0
-    cumsum = 0
+def _get_numbers_of_documents(filenames, manifests):
+    # the number of records in each file - from its manifest, else from its filename. Files with neither are
+    # assumed to have as many records as the first of them, which is counted by iterating through it
+    counts = []
     global_n_documents = None
-    for count, f in cycle(enumerate(all_files)):
-        prev_cumsum = cumsum
-        if _get_number_of_documents(f) is not None:
-            cumsum += _get_number_of_documents(f)
-        elif global_n_documents is None:
-            global_n_documents = _get_number_of_documents_by_iteration(f)
-            cumsum += global_n_documents
+    for f, manifest in zip(filenames, manifests):
+        if manifest is not None:
+            counts.append(manifest["n_records"])
+        elif _get_number_of_documents(f) is not None:
+            counts.append(_get_number_of_documents(f))
         else:
-            cumsum += global_n_documents
-        if cumsum == n_batches:
-            remainder = 0
-            skip_idx = count + 1
-        elif cumsum > n_batches:
-            remainder = n_batches - prev_cumsum
-            skip_idx = count
-            break
-    return skip_idx, remainder
+            if global_n_documents is None:
+                global_n_documents = _get_number_of_documents_by_iteration(f)
+            counts.append(global_n_documents)
+    return counts
+
+
+def _get_skip_index(all_files, n_batches, manifests=None):
+    # returns the number of files to skip in the repeated list of all_files, and the number of records to skip in
+    # the next file, to skip n_batches records in total
+    if manifests is None:
+        manifests = _get_shard_manifests(all_files)
+    cumsum = np.cumsum(_get_numbers_of_documents(all_files, manifests))
+    if len(cumsum) == 0 or cumsum[-1] == 0:
+        raise ValueError(f"Input files have no records: {all_files}")
+    epochs, n_batches = divmod(n_batches, int(cumsum[-1]))
+    skip_idx = int(np.searchsorted(cumsum, n_batches, side="right"))
+    remainder = n_batches - (int(cumsum[skip_idx - 1]) if skip_idx > 0 else 0)
+    return epochs * len(all_files) + skip_idx, remainder
 
 
 def _parse_function(example_proto):
@@ -60,6 +125,20 @@ def _parse_function(example_proto):
     return tf.sparse.to_dense(parsed_features["text"], parsed_features["text"].dense_shape[0])
 
 
+def _decode_packed(records, packed_dtype):
+    # records (of any shape) of raw little endian token ids -> int32 tokens, with a trailing tokens dimension
+    # decode_raw has no uint32, but token ids are well below 2 ** 31 so their bytes read the same as an int32
+    out_type = tf.uint16 if packed_dtype == "uint16" else tf.int32
+    return tf.cast(tf.io.decode_raw(records, out_type, little_endian=True), tf.int32)
+
+
+def autoregressive_sample_text_batch(params, batch_size, x):
+    # autoregressive_sample_text for a [batch_size, chunk_size] batch
+    vals1 = tf.reshape(x[:, :params["n_ctx"]], [batch_size, params["n_ctx"]])
+    vals2 = tf.reshape(x[:, 1:params["n_ctx"] + 1], [batch_size, params["n_ctx"]])
+    return vals1, vals2
+
+
 def autoregressive_sample_text(params, x):
     vals1 = x[:params["n_ctx"]]
     vals2 = x[1:params["n_ctx"] + 1]
@@ -75,6 +154,10 @@ def sequential_input(params, global_step=None, eval=False):
     """
     Input fn that reads tfrecords encoded with a fixed chunk size (== n_ctx + 1), and that either:
 
+        - has a sidecar manifest <filename>.json, as written by create_tfrecords.py, with its number of documents.
+
+          OR
+
         - has the number of documents for each tfrecord file encoded in the title in the format
           <name>_<n_documents>.tfrecords.
 
@@ -90,6 +173,9 @@ def sequential_input(params, global_step=None, eval=False):
 
     If training is starting and stopping often, as with TPU pre-emption, reading the whole dataset sequentially appears to improve model
     performance, as it results in less repeated data.
+
+    Files written by create_tfrecords.py with --packed_dtype (named <name>_<dtype>_<n_documents>.tfrecords) are read
+    a batch at a time, with a single decode_raw.
     """
     if not eval:
         assert global_step is not None
@@ -102,7 +188,7 @@ def sequential_input(params, global_step=None, eval=False):
         path_key = 'path' if not eval else 'eval_path'
         path = dataset_config[path_key]
         filenames.extend(
-            tf.io.gfile.glob(path))  # then glob all files that fit the pattern specified in dataset_configs
+            _glob_input_files(path))  # then glob all files that fit the pattern specified in dataset_configs
 
     filenames = natural_sort(filenames)
     shuffle_filenames = params.get("shuffle_input_filenames", True)
@@ -110,13 +196,15 @@ def sequential_input(params, global_step=None, eval=False):
         seed = params.get('seed', 1)  # shuffle deterministically
         random.seed(seed)
         random.shuffle(filenames)
+    manifests = _get_shard_manifests(filenames)
+    packed_dtype = _get_files_packed_dtype(filenames, manifests)
 
     dataset = tf.data.Dataset.from_tensor_slices(filenames).repeat()  # repeat filenames to infinity
 
     if not eval:
         # skip forward first in the filenames list, then skip the remaining amount in the parsed tfrecords files
-        skip_idx, remainder = _get_skip_index(filenames, n_batches=global_step * params[
-            "train_batch_size"])  # TODO: fix for > 1 epoch
+        skip_idx, remainder = _get_skip_index(filenames, n_batches=global_step * params["train_batch_size"],
+                                              manifests=manifests)
         dataset = dataset.skip(skip_idx)  # skip to skip idx
 
         # read tfrecord examples and skip remainder
@@ -127,15 +215,135 @@ def sequential_input(params, global_step=None, eval=False):
         dataset = dataset.shuffle(len(filenames))
         dataset = dataset.apply(tf.data.TFRecordDataset)
 
-    # parse the tokenized data from the tfrecord files and shuffle
-    dataset = dataset.map(_parse_function, num_parallel_calls=1)
-    dataset = dataset.map(partial(autoregressive_sample_text, params), num_parallel_calls=1)
+    if packed_dtype is not None:
+        # packed records all have the same size, so a whole batch of them is decoded at once
+        dataset = dataset.batch(batch_size, drop_remainder=True)
+        dataset = dataset.map(lambda x: autoregressive_sample_text_batch(params, batch_size,
+                                                                         _decode_packed(x, packed_dtype)),
+                              num_parallel_calls=1)
+    else:
+        # parse the tokenized data from the tfrecord files and shuffle
+        dataset = dataset.map(_parse_function, num_parallel_calls=1)
+        dataset = dataset.map(partial(autoregressive_sample_text, params), num_parallel_calls=1)
 
-    # batch data and repeat to infinity
-    dataset = dataset.batch(batch_size, drop_remainder=True).prefetch(params["iterations"] * 2)
+        # batch data
+        dataset = dataset.batch(batch_size, drop_remainder=True)
+
+    # repeat to infinity
+    dataset = dataset.prefetch(params["iterations"] * 2)
     return dataset.repeat()
 
 
+def _get_flat_dtype(filename):
+    # extracts the token dtype from a flat shard filename formatted "<name>_<dtype>_<num_documents>.bin"
+    match = re.search(r"_(uint16|uint32)_\d+\.bin$", filename)
+    if match is None:
+        raise ValueError(f"{filename} isn't a flat token shard named <name>_<dtype>_<num_documents>.bin")
+    return match.group(1)
+
+
+class FlatTokenShards:
+    """
+    Chunks of the flat token shards (.bin + .idx pairs) written by create_tfrecords.py --flat, indexed as one
+    sequence across all files.
+
+    Both files of each shard are memory mapped, so opening the shards reads nothing but the .idx headers, and
+    `shards[i]` is a zero-copy view of chunk i: one binary search over the shards' chunk counts and one offset lookup.
+    """
+
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+        self.tokens = []
+        self.offsets = []
+        for filename in self.filenames:
+            dtype = np.dtype(_get_flat_dtype(filename)).newbyteorder("<")
+            # np.memmap can't map an empty file
+            self.tokens.append(np.memmap(filename, dtype=dtype, mode="r") if os.path.getsize(filename) > 0 else
+                               np.zeros([0], dtype))
+            self.offsets.append(np.load(filename[:-len(".bin")] + ".idx", mmap_mode="r"))
+        # ends[i] is the global index of the first chunk after file i
+        self.ends = np.cumsum([len(offsets) - 1 for offsets in self.offsets], dtype=np.int64)
+
+    def __len__(self):
+        return int(self.ends[-1]) if len(self.ends) else 0
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(f"Chunk {i} out of range for {len(self)} chunks")
+        file_idx = int(np.searchsorted(self.ends, i, side="right"))
+        local_idx = i - (int(self.ends[file_idx - 1]) if file_idx > 0 else 0)
+        offsets = self.offsets[file_idx]
+        return self.tokens[file_idx][offsets[local_idx]:offsets[local_idx + 1]]
+
+    def batches(self, n_ctx, batch_size, start=0):
+        """
+        Yields [batch_size, n_ctx] int32 (inputs, labels) batches of consecutive chunks forever, starting at chunk
+        `start` and wrapping around at the end of the shards.
+        """
+        n_chunks = len(self)
+        if n_chunks == 0:
+            raise ValueError("No chunks in flat token shards")
+        i = start % n_chunks
+        while True:
+            inputs = np.empty([batch_size, n_ctx], np.int32)
+            labels = np.empty([batch_size, n_ctx], np.int32)
+            for b in range(batch_size):
+                chunk = self[i]
+                if len(chunk) < n_ctx + 1:
+                    raise ValueError(f"Chunk {i} has {len(chunk)} tokens, but n_ctx + 1 = {n_ctx + 1} are needed")
+                inputs[b] = chunk[:n_ctx]
+                labels[b] = chunk[1:n_ctx + 1]
+                i = (i + 1) % n_chunks
+            yield inputs, labels
+
+
+def flat_input(params, global_step=None, eval=False):
+    """
+    Input fn for the flat token shards written by create_tfrecords.py --flat. Like sequential_input, chunks are read
+    in order and training resumes at chunk global_step * train_batch_size - but here that skip is exact and costs a
+    single index lookup.
+
+    Batches are assembled in numpy from memory mapped shards (see FlatTokenShards) and fed in with
+    tf.data.Dataset.from_generator, so this is meant for local files rather than GCS.
+    """
+    if not eval:
+        assert global_step is not None
+    batch_size = params['eval_batch_size' if eval else 'train_batch_size']
+    n_ctx = params["n_ctx"]
+
+    filenames = []
+    for dataset_config in params['dataset_configs'].values():
+        path = dataset_config['path' if not eval else 'eval_path']
+        filenames.extend(tf.io.gfile.glob(path))
+    shards = FlatTokenShards(natural_sort(filenames))
+
+    start = 0 if eval else global_step * batch_size
+    dataset = tf.data.Dataset.from_generator(lambda: shards.batches(n_ctx, batch_size, start=start),
+                                             output_types=(tf.int32, tf.int32),
+                                             output_shapes=([batch_size, n_ctx], [batch_size, n_ctx]))
+    return dataset.prefetch(params["iterations"] * 2)
+
+
+DEFAULT_PREDICT_LENGTH_BUCKETS = [256, 512, 1024]
+
+
+def get_prediction_length(params, n_prompt_tokens):
+    """
+    Picks the sequence length to build the prediction graph with: the smallest of `predict_length_buckets` (+ n_ctx)
+    that fits the prompt plus `predict_max_steps` generated tokens. Sampling cost scales with this length rather
+    than with n_ctx.
+
+    If `predict_max_steps` isn't set, sampling runs until the context is full, so this is always n_ctx.
+    """
+    n_ctx = params["n_ctx"]
+    if params["predict_max_steps"] is None:
+        return n_ctx
+    buckets = params["predict_length_buckets"] or DEFAULT_PREDICT_LENGTH_BUCKETS
+    buckets = sorted(b for b in buckets if b < n_ctx) + [n_ctx]
+    needed_length = n_prompt_tokens + params["predict_max_steps"]
+    return next(b for b in buckets if b >= needed_length or b == n_ctx)
+
+
 def pred_input(params, logger, enc=None,
                path_to_prompt=""):
     unicorns = "In a shocking finding, scientists discovered a herd of unicorns living in a remote, " \
@@ -148,9 +356,10 @@ def pred_input(params, logger, enc=None,
     if len(tokens) > params["n_ctx"]:
         logger.info("The length of your input prompt is longer than the model's context length - truncating input.")
         tokens = tokens[len(tokens) - params["n_ctx"]:]
-    if len(tokens) < params["n_ctx"]:
-        tokens = tf.pad(tokens, [[0, params["n_ctx"] - len(tokens)]], constant_values=params["padding_id"])
-    t = tf.broadcast_to(tokens, [params["batch_size"], params["n_ctx"]])
+    length = get_prediction_length(params, len(tokens))
+    if len(tokens) < length:
+        tokens = tf.pad(tokens, [[0, length - len(tokens)]], constant_values=params["padding_id"])
+    t = tf.broadcast_to(tokens, [params["batch_size"], length])
     dataset = tf.data.Dataset.from_tensors(t)
 
     def _dummy_labels(x):
@@ -160,27 +369,170 @@ def pred_input(params, logger, enc=None,
     return dataset
 
 
+def load_prompts(params, logger, enc, path_to_prompts):
+    """
+    Reads a .jsonl file of prompts to predict from. Each line is a json object with a "prompt" (or "text") field and
+    an optional "id" field, which defaults to the line number.
+
+    :return: list of (prompt_id, tokens)
+    """
+    prompts = []
+    with tf.io.gfile.GFile(path_to_prompts, "r") as f:
+        for line_no, line in enumerate(f):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            tokens = encode(enc, record["prompt"] if "prompt" in record else record["text"])
+            prompt_id = record.get("id", line_no)
+            if len(tokens) > params["n_ctx"]:
+                logger.info(f"Prompt {prompt_id} is longer than the model's context length - truncating input.")
+                tokens = tokens[len(tokens) - params["n_ctx"]:]
+            prompts.append((prompt_id, tokens))
+    return prompts
+
+
+def batch_prompts(params, prompts):
+    """
+    Groups distinct prompts by prediction length bucket (see get_prediction_length) and sorts them by length, so a
+    batch of `predict_batch_size` prompts can share one graph per bucket.
+
+    Each bucket's list is padded to a whole number of batches by repeating its last prompt with a prompt_id of None.
+
+    :return: dict of {length: list of (prompt_id, tokens)}
+    """
+    batch_size = params["predict_batch_size"]
+    buckets = {}
+    for prompt_id, tokens in sorted(prompts, key=lambda p: len(p[1])):
+        length = get_prediction_length(params, len(tokens))
+        buckets.setdefault(length, []).append((prompt_id, tokens))
+    for bucket in buckets.values():
+        n_padding = -len(bucket) % batch_size
+        bucket.extend([(None, bucket[-1][1])] * n_padding)
+    return buckets
+
+
+def prompts_pred_input(params, prompts, length):
+    """
+    Input fn serving the batches of one bucket from batch_prompts, each prompt padded to `length`.
+    """
+    tokens = np.full((len(prompts), length), params["padding_id"], dtype=np.int32)
+    for i, (_, prompt_tokens) in enumerate(prompts):
+        tokens[i, :len(prompt_tokens)] = prompt_tokens
+    dataset = tf.data.Dataset.from_tensor_slices(tokens)
+    dataset = dataset.batch(params["batch_size"], drop_remainder=True)
+
+    def _dummy_labels(x):
+        return x, x
+
+    dataset = dataset.map(_dummy_labels)
+    return dataset
+
+
+def _remove_eos_and_padding(p, params):
+    # truncate output at the first eos or padding id
+    stop = np.flatnonzero((p == params['eos_id']) | (p == params['padding_id']))
+    return p[:stop[0]] if len(stop) > 0 else p
+
+
+class PredictionWriter:
+    """
+    Writes predictions to a .jsonl file from a background thread, so the prediction loop never waits on
+    detokenization, file I/O or logging.
+
+    Queued predictions are decoded `batch_size` at a time with the tokenizer's batch API, and each batch is written
+    with a single buffered write. Use as a context manager - the file is complete once the block exits.
+    """
+
+    def __init__(self, path, enc, logger, batch_size=64):
+        self.path = path
+        self.enc = enc
+        self.logger = logger
+        self.batch_size = batch_size
+        self.n_written = 0
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            if exc_info[0] is not None:
+                # don't hide the error the with block is already raising
+                self.logger.error(f"Writing predictions to {self.path} failed: {self._error!r}")
+                return False
+            raise self._error
+        self.logger.info(f"Wrote {self.n_written} predictions to {self.path}")
+
+    def write(self, record, **tokens):
+        """
+        Queues a prediction. Each keyword argument is an array of token ids to be decoded into that field of record.
+        """
+        self._queue.put((record, tokens))
+
+    def _next_batch(self):
+        # Blocks for the first item, then takes whatever else is already queued, up to batch_size
+        batch = [self._queue.get()]
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        done = False
+        try:
+            with tf.io.gfile.GFile(self.path, "w") as f:
+                while not done:
+                    batch = self._next_batch()
+                    if batch[-1] is None:
+                        done = True
+                        batch = batch[:-1]
+                    if not batch:
+                        continue
+
+                    records = [dict(record) for record, _ in batch]
+                    for field in batch[0][1].keys():
+                        texts = decode_batch(self.enc, [tokens[field] for _, tokens in batch])
+                        for record, text in zip(records, texts):
+                            record[field] = text
+
+                    f.write("".join(json.dumps(record) + "\n" for record in records))
+                    self.n_written += len(records)
+                    self.logger.info(f"{self.n_written} predictions written to {self.path}")
+        except Exception as e:
+            self._error = e
+            # Keep draining so the producer never blocks on a dead writer - unless the end of input was already taken
+            while not done and self._queue.get() is not None:
+                pass
+
+
 def handle_pred_output(predictions, logger, enc, params, out_name="test"):
-    with tf.gfile.Open(f"{out_name}.txt", "w") as f:
+    """
+    Writes each sample to <out_name>.jsonl as a {"id", "text"} json object.
+    """
+    with PredictionWriter(f"{out_name}.jsonl", enc, logger) as writer:
         for i, p in enumerate(predictions):
-            p = p["outputs"]
+            writer.write({"id": i}, text=_remove_eos_and_padding(p["outputs"], params))
 
-            # remove eos + padding ids from output
-            idx = np.argmax(p == params['eos_id'])
-            if idx > 0:
-                p = p[:idx]
-            idx = np.argmax(p == params['padding_id'])
-            if idx > 0:
-                p = p[:idx]
 
-            text = enc.decode(p)
-            f.write("=" * 40 + " SAMPLE " + str(i) + " " + "=" * 40 + "\n")
-            f.write(text)
-            f.write("\n" + "=" * 80 + "\n")
-
-            logger.info("=" * 40 + " SAMPLE " + str(i) + " " + "=" * 40 + "\n")
-            logger.info(text)
-            logger.info("\n" + "=" * 80 + "\n")
+def handle_prompts_pred_output(predictions, params, prompts, writer):
+    """
+    Queues the completions of one bucket of batch_prompts on a PredictionWriter, as {"id", "prompt", "completion"}
+    json objects. Padding slots are skipped.
+    """
+    for (prompt_id, prompt_tokens), p in zip(prompts, predictions):
+        if prompt_id is None:
+            continue
+        p = p["outputs"]
+        if not params["remove_partial_sequences"]:
+            p = p[len(prompt_tokens):]
+        writer.write({"id": prompt_id}, prompt=prompt_tokens, completion=_remove_eos_and_padding(p, params))
 
 
 ### DEPRECATED ###
@@ -203,7 +555,7 @@ def generic_text(params, eval=False, sample_text_fn=None, **kwargs):
         path = dataset_config[path_key]
 
         datasets.append(text_dataset(
-            tf.io.gfile.glob(path),
+            _glob_input_files(path),
             params,
             stitch=stitch,
             datatype=datatype,
@@ -234,7 +586,13 @@ def text_dataset(files, params, stitch, datatype, batch=True, sample_text_fn=Non
         dataset = dataset.apply(
             tf.data.experimental.parallel_interleave(tf.data.TFRecordDataset, cycle_length=4, sloppy=False))
 
-    if "documents" in datatype:
+    packed_dtype = _get_files_packed_dtype(files)
+    if packed_dtype is not None:
+        # packed records are decoded into the same sparse tensors as parsed tf.train.Examples
+        def _parse_function(record):
+            text = tf.sparse.from_dense(tf.cast(_decode_packed(record, packed_dtype), tf.int64))
+            return (text, text.dense_shape[0]) if "documents" in datatype else text
+    elif "documents" in datatype:
         def _parse_function(example_proto):
             features = {
                 # "hash": tf.VarLenFeature(tf.string),
@@ -7,7 +7,8 @@ from tensorflow.python.tpu import tpu_config, tpu_estimator
 from tensorflow_estimator.python.estimator import estimator as estimator_lib
 from utils import save_config, expand_attention_types_params, yes_or_no, remove_gs_or_filepath, setup_logging, \
     check_dataset
-from inputs import sequential_input, pred_input, handle_pred_output, mlm_sample_text, generic_text
+from inputs import sequential_input, flat_input, pred_input, handle_pred_output, mlm_sample_text, generic_text, load_prompts, \
+    batch_prompts, prompts_pred_input, handle_prompts_pred_output, PredictionWriter
 from export import export_model
 from model_fns import model_fn
 from data.encoders import fetch_encoder
@@ -35,13 +36,25 @@ def parse_args():
                                                            "starts a new training run")
     parser.add_argument("--predict", action="store_true", help="If set, uses the model to predict rather than train.")
     parser.add_argument("--eval", action="store_true", help="If set, run model in evaluation mode.")
-    parser.add_argument("--prompt", type=str, help="path to .txt file containing a prompt for prediction. If empty, "
-                                                   "defaults to unicorns.",
+    parser.add_argument("--prompt", type=str, help="path to .txt file containing a prompt for prediction, or to a "
+                                                   ".jsonl file of many prompts (one {\"id\": ..., \"prompt\": ...} "
+                                                   "object per line) to predict in batches. If empty, defaults to "
+                                                   "unicorns.",
                         default="")
     parser.add_argument("--check_dataset", action="store_true",
                         help="If set, outputs sample from the dataset and quits.")
     parser.add_argument("--sacred_id", type=str, default="nosacred", help="Sacred run id.")
     parser.add_argument("--entmax_sampling", action="store_true", help="(experimental) use entmax sampling")
+    parser.add_argument("--sampling_temperature", type=float, default=None,
+                        help="Sampling temperature for prediction, 0 is greedy. Overrides the config.")
+    parser.add_argument("--sampling_top_k", type=int, default=None,
+                        help="If set, only sample from the k most likely tokens. Overrides the config.")
+    parser.add_argument("--sampling_top_p", type=float, default=None,
+                        help="If set, only sample from the most likely tokens whose probability adds up to p (nucleus "
+                             "sampling). Overrides the config.")
+    parser.add_argument("--draft_model", type=str, default=None,
+                        help="JSON file of a small model to sample with speculative decoding, using its checkpoint in "
+                             "its model_path. Overrides the config.")
     parser.add_argument("--export", action="store_true", help="If set, will export the model.")
     args = parser.parse_args()
     assert args.model is not None, "Model must be set"
@@ -61,6 +74,8 @@ def main(args):
         input_fn = sequential_input
     elif input_fn == "generic_text":
         input_fn = generic_text
+    elif input_fn == "flat_input":
+        input_fn = flat_input
     pred_input_fn = pred_input
     handle_pred_output_fn = handle_pred_output
 
@@ -111,10 +126,13 @@ def main(args):
     params["export"] = args.export
     # Set sampling parameters
     params["sampling_use_entmax"] = args.entmax_sampling
-
-    # Sample quality of MoE models suffers when using the faster sampling method, so default to slow_sampling if
-    # moe layers are present
-    params["slow_sampling"] = True if params["moe_layers"] is not None else False
+    for key in ["sampling_temperature", "sampling_top_k", "sampling_top_p", "draft_model"]:
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    if params.get("draft_model") is not None:
+        draft_params = fetch_model_params(params["draft_model"])
+        draft_params["attention_types"] = expand_attention_types_params(draft_params["attention_types"])
+        params["draft_params"] = draft_params
 
     logger.info(f"params = {params}")
 
@@ -176,6 +194,17 @@ def main(args):
         export_model(estimator, "export", params)
         return
 
+    if args.predict and args.prompt.endswith(".jsonl"):
+        # Predict from many prompts, batching distinct prompts together - one graph per length bucket
+        prompts = load_prompts(params, logger, encoder, args.prompt)
+        out_name = f"predictions_{args.sacred_id}_{current_step}"
+        with PredictionWriter(f"{out_name}.jsonl", encoder, logger) as writer:
+            for length, bucket in sorted(batch_prompts(params, prompts).items()):
+                logger.info(f"Predicting {len(bucket)} prompts with sequence length {length}")
+                predictions = estimator.predict(input_fn=partial(prompts_pred_input, prompts=bucket, length=length))
+                handle_prompts_pred_output(predictions, params, bucket, writer)
+        return
+
     if args.predict:
         # Predict
         predictions = estimator.predict(input_fn=pred_input_fn)
@@ -4,10 +4,10 @@ from tensorflow.python.tpu import tpu_estimator
 import mesh_tensorflow.transformer as mtf_transformer
 from optimizers import get_optimizer
 from utils import (create_host_call, get_graph_info, remove_batch_from_layout, simd_mesh_setup, add_mode_to_params,
-                   get_batch_size, auto_layout, auto_layout_and_mesh_shape)
+                   get_batch_size, auto_layout, auto_layout_and_mesh_shape, ScopedRestoreHook)
 from models.utils import biasmask_attn_weights
 from tensorflow.python.ops import resources
-from sample import sample_autoregressive
+from sample import sample_autoregressive, speculative_sample_autoregressive, beam_search_autoregressive
 from models.gpt2 import gpt2
 import math
 
@@ -44,7 +44,13 @@ def model_fn(features, labels, mode, params):
     # Build mtf_features & seq length dict for getting number of microbatches
     # We need to pack inputs into a dict to pass into serialize_training_step
     features_dict = {"inputs": features, "labels": labels}
-    sequence_length_dict = {"inputs": params["n_ctx"], "labels": params["n_ctx"]}
+    feature_length = params["n_ctx"]
+    if mode == tf.estimator.ModeKeys.PREDICT and not params.get("export", False):
+        # Prediction inputs are padded to a length bucket rather than n_ctx (see inputs.get_prediction_length),
+        # so one graph is built per bucket
+        inputs = features["feature"] if type(features) == dict else features
+        feature_length = inputs.shape.as_list()[-1]
+    sequence_length_dict = {"inputs": feature_length, "labels": feature_length}
 
     params = add_mode_to_params(params, mode)
     batch_size = get_batch_size(params)
@@ -94,12 +100,43 @@ def model_fn(features, labels, mode, params):
             params["remove_partial_sequences"] = False
 
         export = params.get("export", False)
+        draft_params = params.get("draft_params")
+        beam_size = params.get("predict_beam_size", 1)
+
+        if not export and beam_size > 1:
+            if draft_params is not None:
+                raise ValueError("Beam search and speculative decoding can't be combined")
+            mtf_samples = beam_search_autoregressive(
+                inputs, other_features, params, beam_size=beam_size, variable_dtype=variable_dtype,
+                remove_partial_sequences=params["remove_partial_sequences"], stop_at_token=params["eos_id"],
+                max_steps=params["predict_max_steps"], length_penalty=params.get("predict_length_penalty", 0.6),
+                prefill_chunk_size=params.get("predict_prefill_chunk_size"))
+
+        elif not export and draft_params is not None:
+            # Speculative decoding - the draft model lives under the "draft" variable scope, and is restored from its
+            # own checkpoint
+            draft_params = add_mode_to_params(draft_params, mode)
+            draft_other_features = dict(other_features,
+                                        embd_dim=mtf.Dimension("embd", draft_params["n_embd"]),
+                                        embed_sequence_dim=mtf.Dimension("embed_sequence", draft_params["n_ctx"]))
+            mtf_samples = speculative_sample_autoregressive(
+                inputs, other_features, params, draft_other_features, draft_params, variable_dtype=variable_dtype,
+                remove_partial_sequences=params["remove_partial_sequences"], stop_at_token=params["eos_id"],
+                max_steps=params["predict_max_steps"], temperature=params.get("sampling_temperature", 0.9),
+                num_speculative_tokens=params.get("num_speculative_tokens", 4))
 
-        if not export:
+        elif not export:
             mtf_samples = sample_autoregressive(
                 inputs, other_features=other_features, params=params, variable_dtype=variable_dtype,
                 remove_partial_sequences=params["remove_partial_sequences"], stop_at_token=params["eos_id"],
-                sampling_use_entmax=params['sampling_use_entmax'], max_steps=params["predict_max_steps"])
+                sampling_use_entmax=params['sampling_use_entmax'], max_steps=params["predict_max_steps"],
+                compact_batch=params.get("predict_compact_batch", False),
+                sliding_window_stride=params.get("predict_sliding_window_stride"),
+                prefill_chunk_size=params.get("predict_prefill_chunk_size"),
+                temperature=params.get("sampling_temperature", 0.9),
+                sampling_keep_top_k=params.get("sampling_top_k", -1),
+                sampling_top_p=params.get("sampling_top_p"),
+                sampling_top_p_candidates=params.get("sampling_top_p_candidates", 256))
 
         else:
             with mtf.utils.outside_all_rewrites():
@@ -116,23 +153,34 @@ def model_fn(features, labels, mode, params):
             "inputs": inputs,
             "outputs": outputs}
 
+        # The draft model's variables aren't in the model's checkpoint. They're initialized here, then restored from
+        # the draft model's checkpoint by a hook
+        draft_vars = [v for v in tf.global_variables() if v.op.name.startswith("draft/")]
+        model_vars = [v for v in tf.global_variables() if not v.op.name.startswith("draft/")]
+        prediction_hooks = [mtf.MtfRestoreHook(lowering)]
+        if draft_vars:
+            prediction_hooks.insert(0, ScopedRestoreHook(draft_params["model_path"], "draft"))
+
         def scaffold_fn():
             return tf.train.Scaffold(
                 local_init_op=tf.group(
                     tf.train.Scaffold.default_local_init_op(),
+                    tf.variables_initializer(draft_vars),
                     lowering.copy_masters_to_slices(),
                     name="mtf_local_init_op"),
+                ready_for_local_init_op=tf.report_uninitialized_variables(model_vars) if draft_vars else None,
                 ready_op=tf.concat(
                     [tf.report_uninitialized_variables(),
                      resources.report_uninitialized_resources()],
                     axis=0,
-                    name="mtf_ready_op"))
+                    name="mtf_ready_op"),
+                saver=tf.train.Saver(model_vars, sharded=True) if draft_vars else None)
 
         return tpu_estimator.TPUEstimatorSpec(
             mode=tf.estimator.ModeKeys.PREDICT,
             predictions=predictions,
             scaffold_fn=scaffold_fn,
-            prediction_hooks=[mtf.MtfRestoreHook(lowering)])
+            prediction_hooks=prediction_hooks)
 
     # We're not predicting, so we better be training or evaluating
     assert mode in [tf.estimator.ModeKeys.TRAIN, tf.estimator.ModeKeys.EVAL]
@@ -65,6 +65,11 @@ def block(params, scope, layer_num, bias, sequence_dim, memory_length_dim, pos_e
                 for k, v in params["moe_params"].items():
                     moe_params.add_hparam(k, v)
 
+                if is_incremental_inference(context):
+                    # When decoding, route each token on its own. Tokens of one group compete for the capacity of
+                    # each expert, so in a group of the batch's tokens some could be dropped
+                    moe_params.moe_group_size = 1
+
                 moe_train = params["mode"] == "train"
 
                 m, aux_loss = mtf.transformer.moe.transformer_moe_layer_v1(res_x, x.shape[-1], moe_params,
@@ -102,9 +107,10 @@ def model(mtf_features, other_features, params, mesh, variable_dtype, context=No
     x, batch_dim, sequence_dim, embd_dim, vocab_dim, embed_sequence_dim = parse_inputs(mtf_features, other_features)
 
     if is_incremental_inference(context):
-        # reshape inputs if in inference mode
+        # reshape inputs if in inference mode. position is usually [batch], or [batch, window] when a window of
+        # tokens is decoded at once
         x = mtf.gather(x, context.position - 1, sequence_dim)
-        x = mtf.reshape(x, [batch_dim])
+        x = mtf.reshape(x, context.position.shape)
 
     use_axial_pos_emb = exists(params["axial_pos_emb"])
     use_rotary_emb = exists(params["rotary_emb"])
@@ -169,6 +175,10 @@ def model(mtf_features, other_features, params, mesh, variable_dtype, context=No
         h, loss = block_fn(h) if not recompute_grad else mtf.recompute_grad(block_fn, [h])
         aux_losses += loss
 
+    if exists(context) and context.mode == "first_part":
+        # Prefill only needs to populate the attention states in context - skip the [batch, sequence, vocab] projection
+        return None, None, None
+
     no_weight_tie_emb = params["no_weight_tie"] == True
     if no_weight_tie_emb:
         with tf.variable_scope("wte_final_linear"):
@@ -176,10 +186,13 @@ def model(mtf_features, other_features, params, mesh, variable_dtype, context=No
     else:
         # Layer normalize & affine transform
         h = layer_norm(h, "ln_f", variable_dtype=variable_dtype)
-        seq_dim = sequence_dim if not is_incremental_inference(context) else mtf.Dimension("sequence", 1)
+        if not is_incremental_inference(context):
+            logits_shape = [batch_dim, sequence_dim, vocab_dim]
+        else:
+            logits_shape = context.position.shape.dims + [mtf.Dimension("sequence", 1), vocab_dim]
         with tf.variable_scope("wte_final_einsum"):
             # Equivalent to tf.matmul
-            logits = mtf.einsum([h, wte], output_shape=[batch_dim, seq_dim, vocab_dim])
+            logits = mtf.einsum([h, wte], output_shape=logits_shape)
 
     if params["mode"] in ["train", "eval"]:
         labels = mtf_features["labels"]
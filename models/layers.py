@@ -1,6 +1,7 @@
 import mesh_tensorflow as mtf
 import tensorflow.compat.v1 as tf
 import math
+from functools import partial
 import mesh_tensorflow.transformer as mtf_transformer
 
 from models.activations import get_activation_fn
@@ -108,6 +109,312 @@ def causal_linear_attention(q, k, v, eps = 1e-6):
     return attn
 
 
+def chunked_causal_linear_attention(q, k, v, chunk_size=64, eps=1e-6):
+    """causal_linear_attention computed chunk by chunk.
+
+    Within a chunk the (masked) q k^T products are used directly, and the k v^T sums of all previous chunks are carried
+    as one [heads, dim_in, dim_out] state per chunk. Activation memory is O(n * d + n / chunk_size * d^2) rather than
+    the O(n * d^2) of materializing k v^T at every position.
+    """
+    batch_dim, seq_dim, head_dim, dim_out = (v.shape[0], v.shape[1], v.shape[2], v.shape[3])
+    q = mtf.rename_dimension(q, "features_per_head", "features_per_head_in")
+    k = mtf.rename_dimension(k, "features_per_head", "features_per_head_in")
+
+    dim_in = k.shape[-1]
+
+    q = mtf.softmax(q, dim_in)
+    k = mtf.exp(k)
+
+    chunk_size = _largest_divisor(seq_dim.size, chunk_size)
+    # The chunks dimension keeps the name of the sequence dimension, so it will be split in the same way
+    dim_chunks = mtf.Dimension(seq_dim.name, seq_dim.size // chunk_size)
+    dim_chunk = mtf.Dimension("chunk", chunk_size)
+    dim_memory_chunk = mtf.Dimension("memory_chunk", chunk_size)
+
+    q = mtf.replace_dimensions(q, seq_dim, [dim_chunks, dim_chunk])
+    k, v = map(lambda t: mtf.replace_dimensions(t, seq_dim, [dim_chunks, dim_memory_chunk]), (k, v))
+
+    # Intra-chunk: quadratic in the chunk size
+    visible = mtf.greater_equal(mtf.range(q.mesh, dim_chunk, tf.int32), mtf.range(q.mesh, dim_memory_chunk, tf.int32))
+    weights = mtf.einsum([q, k, mtf.cast(visible, q.dtype)],
+                         output_shape=[batch_dim, dim_chunks, dim_chunk, dim_memory_chunk, head_dim])
+    attn = mtf.einsum([weights, v], output_shape=[batch_dim, dim_chunks, dim_chunk, head_dim, dim_out])
+    normalizer = mtf.reduce_sum(weights, reduced_dim=dim_memory_chunk)
+
+    # Inter-chunk: the k v^T and k sums of all previous chunks
+    context = mtf.einsum([k, v], output_shape=[batch_dim, dim_chunks, head_dim, dim_in, dim_out])
+    context = mtf.cumsum(context, dim_chunks, exclusive=True)
+    cumulative_k = mtf.reduce_sum(k, reduced_dim=dim_memory_chunk)
+    cumulative_k = mtf.cumsum(cumulative_k, dim_chunks, exclusive=True)
+
+    attn += mtf.einsum([q, context], output_shape=attn.shape)
+    normalizer += mtf.einsum([q, cumulative_k], output_shape=normalizer.shape)
+
+    attn = attn / (normalizer + eps)
+    return mtf.replace_dimensions(attn, [dim_chunks, dim_chunk], seq_dim)
+
+
+def causal_linear_attention_state(k, v, initial_position):
+    """Running sums of exp(k) v^T and exp(k) over the positions before initial_position - 1.
+
+    This is the recurrent state incremental_causal_linear_attention starts decoding from.
+    """
+    batch_dim, seq_dim, head_dim, dim_out = (v.shape[0], v.shape[1], v.shape[2], v.shape[3])
+    k = mtf.rename_dimension(k, "features_per_head", "features_per_head_in")
+
+    dim_in = k.shape[-1]
+
+    visible = mtf.less(mtf.range(k.mesh, seq_dim, tf.int32), initial_position - 1)
+    k = mtf.exp(k) * mtf.cast(visible, k.dtype)
+
+    context = mtf.einsum([k, v], output_shape=[batch_dim, head_dim, dim_in, dim_out])
+    cumulative_k = mtf.reduce_sum(k, output_shape=[batch_dim, head_dim, dim_in])
+    return [context, cumulative_k]
+
+
+def incremental_causal_linear_attention(q, k, v, context, cumulative_k, eps=1e-6):
+    """causal_linear_attention for a single position, carrying the running sums as recurrent state.
+
+    Costs O(d^2) per token and per head, independent of the sequence length.
+    """
+    q = mtf.rename_dimension(q, "features_per_head", "features_per_head_in")
+    k = mtf.rename_dimension(k, "features_per_head", "features_per_head_in")
+
+    dim_in = k.shape[-1]
+
+    q = mtf.softmax(q, dim_in)
+    k = mtf.exp(k)
+
+    context += mtf.einsum([k, v], output_shape=context.shape)
+    cumulative_k += k
+    D_inv = 1. / mtf.einsum([q, cumulative_k + eps], output_shape=q.shape - dim_in)
+
+    attn = mtf.einsum([q, context, D_inv], output_shape=v.shape)
+    return attn, [context, cumulative_k]
+
+
+def incremental_causal_linear_window_attention(q, k, v, context, cumulative_k, write, eps=1e-6):
+    """incremental_causal_linear_attention for a window of consecutive positions.
+
+    Within the window the masked q k^T products are used directly, as for one chunk of chunked_causal_linear_attention.
+    Only the positions where write is set are added to the running sums.
+    """
+    window_dim = v.shape[1]
+    memory_window_dim = mtf.Dimension("memory_window", window_dim.size)
+    q = mtf.rename_dimension(q, "features_per_head", "features_per_head_in")
+    k = mtf.rename_dimension(k, "features_per_head", "features_per_head_in")
+
+    dim_in = k.shape[-1]
+
+    q = mtf.softmax(q, dim_in)
+    k = mtf.exp(k) * mtf.cast(write, k.dtype)
+
+    memory_k, memory_v = [mtf.rename_dimension(t, window_dim.name, memory_window_dim.name) for t in (k, v)]
+    causal = mtf.less_equal(mtf.range(q.mesh, memory_window_dim, tf.int32), mtf.range(q.mesh, window_dim, tf.int32))
+    window_scores = mtf.einsum([q, memory_k], output_shape=q.shape - dim_in + memory_window_dim)
+    window_scores *= mtf.cast(causal, window_scores.dtype)
+
+    numerator = mtf.einsum([q, context], output_shape=v.shape) + \
+        mtf.einsum([window_scores, memory_v], output_shape=v.shape)
+    denominator = mtf.einsum([q, cumulative_k], output_shape=q.shape - dim_in) + \
+        mtf.reduce_sum(window_scores, reduced_dim=memory_window_dim) + eps
+
+    context += mtf.einsum([k, v], output_shape=context.shape)
+    cumulative_k += mtf.reduce_sum(k, reduced_dim=window_dim)
+    return numerator / denominator, [context, cumulative_k]
+
+
+def write_to_cache(cache, x, position, dim):
+    """Writes x into cache at the per-sequence index position along dim.
+
+    Only the written slots are touched (a scatter, rather than a one-hot blend over the whole of dim), so decoding a
+    token costs O(1) cache writes. cache must be laid out as its batch dims + [dim] + the remaining dims of x. position
+    may have dims besides the batch dims (i.e a window of positions to write), which x then shares.
+    """
+    batch_dims = [d for d in position.shape.dims if d in cache.shape.dims]
+    window_dims = [d for d in position.shape.dims if d not in cache.shape.dims]
+    batch_ndims = len(batch_dims)
+    position = mtf.transpose(position, batch_dims + window_dims)
+    x = mtf.cast(mtf.transpose(x, batch_dims + window_dims + (cache.shape - batch_dims - dim).dims), cache.dtype)
+
+    def _tf_write(tf_cache, tf_x, tf_position):
+        cache_shape = tf.shape(tf_cache)
+        flat_cache = tf.reshape(tf_cache, tf.concat([[-1], cache_shape[batch_ndims:]], axis=0))
+        n_rows = tf.shape(flat_cache)[0]
+        flat_position = tf.clip_by_value(tf.reshape(tf_position, [n_rows, -1]), 0, dim.size - 1)
+        flat_x = tf.reshape(tf_x, tf.concat([tf.shape(flat_position), cache_shape[batch_ndims + 1:]], axis=0))
+        rows = tf.broadcast_to(tf.range(n_rows)[:, None], tf.shape(flat_position))
+        indices = tf.stack([rows, flat_position], axis=-1)
+        return tf.reshape(tf.tensor_scatter_nd_update(flat_cache, indices, flat_x), cache_shape)
+
+    return mtf.slicewise(_tf_write, [cache, x, position], output_shape=cache.shape, output_dtype=cache.dtype,
+                         splittable_dims=batch_dims + (cache.shape - batch_dims - dim).dims,
+                         name="write_to_cache")
+
+
+def incremental_causal_bias(position, memory_length_dim, num_mem_kv, dtype):
+    """Attention bias for queries at position - 1, built from position indices rather than a dense mask.
+
+    Masks out the cache slots that have not been written yet. Memory key / values occupy the first num_mem_kv slots
+    and are always visible.
+    """
+    j = mtf.range(position.mesh, memory_length_dim, tf.int32) - num_mem_kv
+    return mtf.cast(mtf.greater(j, position - 1), dtype) * -1e10
+
+
+def local_attention_cache(x, dim_seq, initial_position, radius):
+    """Builds the ring buffer of the last radius keys / values up to and including initial_position - 1.
+
+    Position p lives in slot p % radius, so that decoding can overwrite the oldest entry in place.
+    """
+    dim_cache = mtf.Dimension("local_cache", min(radius, dim_seq.size))
+    slots = mtf.range(x.mesh, dim_cache, tf.int32)
+    last_position = initial_position - 1
+    cache_positions = last_position - mtf.mod(last_position - slots, dim_cache.size)
+    return mtf.gather(x, cache_positions, dim_seq,
+                      output_shape=initial_position.shape + [dim_cache] + (x.shape - initial_position.shape - dim_seq))
+
+
+def incremental_local_attention(q, k_cache, v_cache, position, dim_kv):
+    """Attention for a single query at position - 1 over a ring buffer built by local_attention_cache.
+
+    Costs O(radius) per token, independent of the sequence length.
+    """
+    dim_cache = k_cache.shape[1]
+    slots = mtf.range(q.mesh, dim_cache, tf.int32)
+    last_position = position - 1
+    cache_positions = last_position - mtf.mod(last_position - slots, dim_cache.size)
+    bias = mtf.cast(mtf.less(cache_positions, 0), q.dtype) * -1e10
+    return mtf_transformer.attention.attention(q, k_cache, v_cache, memory_length_dim=dim_cache, key_dim=dim_kv,
+                                               value_dim=dim_kv, bias=bias)
+
+
+def incremental_local_window_attention(q, k, v, k_cache, v_cache, position, write_end, dim_kv):
+    """incremental_local_attention for a window of consecutive positions [batch, window].
+
+    The queries attend to the ring buffer and to the window's own keys / values. Returns the attention and the ring
+    buffers with the keys / values of the window before position write_end - 1 written in.
+    """
+    window_dim = position.shape.dims[-1]
+    dim_cache = k_cache.shape[1]
+    memory_dim = mtf.Dimension("local_memory", dim_cache.size + window_dim.size)
+    first_position = mtf.reduce_min(position, reduced_dim=window_dim) - 1
+
+    # The ring buffer holds the positions before the window
+    slots = mtf.range(q.mesh, dim_cache, tf.int32)
+    cache_positions = first_position - 1 - mtf.mod(first_position - 1 - slots, dim_cache.size)
+    memory_positions = mtf.concat([mtf.rename_dimension(cache_positions, dim_cache.name, memory_dim.name),
+                                   mtf.rename_dimension(position - 1, window_dim.name, memory_dim.name)],
+                                  memory_dim.name)
+    k_memory, v_memory = [mtf.concat([mtf.rename_dimension(cache, dim_cache.name, memory_dim.name),
+                                      mtf.rename_dimension(mtf.cast(t, cache.dtype), window_dim.name,
+                                                           memory_dim.name)], memory_dim.name)
+                          for cache, t in ((k_cache, k), (v_cache, v))]
+    query_positions = position - 1
+    visible = mtf.logical_and(mtf.greater_equal(memory_positions, 0),
+                              mtf.logical_and(mtf.less_equal(memory_positions, query_positions),
+                                              mtf.greater(memory_positions, query_positions - dim_cache.size)))
+    bias = mtf.cast(mtf.logical_not(visible), q.dtype) * -1e10
+    a = mtf_transformer.attention.attention(q, k_memory, v_memory, memory_length_dim=memory_dim, key_dim=dim_kv,
+                                            value_dim=dim_kv, bias=bias)
+
+    # Each slot takes the last written position of the window that maps to it, if there is one
+    last_position = mtf.minimum(mtf.reduce_max(position, reduced_dim=window_dim), write_end - 1) - 1
+    slot_positions = last_position - mtf.mod(last_position - slots, dim_cache.size)
+    window_index = slot_positions - first_position
+    from_window = mtf.greater_equal(window_index, 0)
+    window_index = mtf.minimum(mtf.maximum(window_index, 0), window_dim.size - 1)
+    new_caches = []
+    for cache, t in ((k_cache, k), (v_cache, v)):
+        written = mtf.gather(mtf.cast(t, cache.dtype), window_index, window_dim,
+                             output_shape=window_index.shape + (t.shape - window_index.shape - window_dim))
+        new_caches.append(mtf.where(from_window, written, cache, output_shape=cache.shape))
+    return a, new_caches
+
+
+def _largest_divisor(n, max_divisor):
+    # The greatest divisor of n less than or equal to max_divisor
+    divisor = min(n, max_divisor)
+    while n % divisor != 0:
+        divisor -= 1
+    return divisor
+
+
+def blockwise_attention(q, k, v, memory_length_dim, key_dim, value_dim, block_size, causal=True, dropout_rate=0.0,
+                        recompute=False):
+    """Dot-product attention over tiles of queries and keys, with a running max / sum (online) softmax.
+
+    Equivalent to mtf_transformer.attention.attention with the causal bias from biasmask_attn_weights, but only ever
+    holds one [query block, key block] tile of logits, and skips the tiles that are entirely masked out. With
+    recompute=True each query block is recomputed on the backward pass, so the tiles are not kept for the gradients
+    either.
+
+    q: [batch, sequence, heads, key_dim], k / v: [batch, memory_length, heads, key_dim / value_dim]
+    """
+    dim_seq = q.shape.get_dim_by_name("sequence")
+    # Any memory key / values occupy the first slots of memory_length and are visible to every query
+    offset = memory_length_dim.size - dim_seq.size
+
+    q_block_size = _largest_divisor(dim_seq.size, block_size)
+    k_block_size = _largest_divisor(memory_length_dim.size, block_size)
+    n_k_blocks = memory_length_dim.size // k_block_size
+
+    def _query_block_attention(q_begin, q_block, k, v):
+        q_block = mtf.cast(q_block, tf.float32)
+        k = mtf.cast(k, tf.float32)
+        dim_q_block = q_block.shape.get_dim_by_name("sequence")
+        q_positions = mtf.range(q.mesh, dim_q_block, tf.int32) + q_begin + offset
+
+        max_logits = normalizer = outputs = None
+        for k_begin in range(0, n_k_blocks * k_block_size, k_block_size):
+            if causal and k_begin > q_begin + q_block_size - 1 + offset:
+                break  # this and all following key blocks are masked out for every query in the block
+
+            k_block = mtf.slice(k, k_begin, k_block_size, memory_length_dim.name)
+            v_block = mtf.slice(v, k_begin, k_block_size, memory_length_dim.name)
+            dim_k_block = k_block.shape.get_dim_by_name(memory_length_dim.name)
+
+            logits = mtf.layers.us_einsum([q_block, k_block], reduced_dims=[key_dim])
+            if causal and k_begin + k_block_size - 1 > q_begin + offset:
+                # Partially masked block - build the mask from position indices
+                k_positions = mtf.range(q.mesh, dim_k_block, tf.int32) + k_begin
+                logits += mtf.cast(mtf.greater(k_positions, q_positions), logits.dtype) * -1e10
+
+            block_max = mtf.stop_gradient(mtf.reduce_max(logits, reduced_dim=dim_k_block))
+            if max_logits is None:
+                new_max = block_max
+            else:
+                new_max = mtf.maximum(max_logits, block_max)
+            weights = mtf.exp(logits - new_max)
+            block_normalizer = mtf.reduce_sum(weights, reduced_dim=dim_k_block)
+
+            if dropout_rate != 0.0:
+                weights = mtf.dropout(weights, 1.0 - dropout_rate)
+            block_outputs = mtf.einsum([mtf.cast(weights, v_block.dtype), v_block],
+                                       output_shape=q_block.shape - key_dim + value_dim)
+            block_outputs = mtf.cast(block_outputs, tf.float32)
+
+            if max_logits is None:
+                normalizer, outputs = block_normalizer, block_outputs
+            else:
+                correction = mtf.exp(max_logits - new_max)
+                normalizer = normalizer * correction + block_normalizer
+                outputs = outputs * correction + block_outputs
+            max_logits = new_max
+
+        return mtf.cast(outputs / normalizer, v.dtype)
+
+    outputs = []
+    for q_begin in range(0, dim_seq.size, q_block_size):
+        q_block = mtf.slice(q, q_begin, q_block_size, dim_seq.name)
+        fn = partial(_query_block_attention, q_begin)
+        if recompute:
+            outputs.append(mtf.recompute_grad(fn, [q_block, k, v]))
+        else:
+            outputs.append(fn(q_block, k, v))
+    return mtf.concat(outputs, dim_seq.name)
+
+
 def linear(x, scope, nf, *, w_init_stdev=0.02, variable_dtype, params=None, scale=False):
     # nf = number of features
     if params["scale_by_depth"] and scale:
@@ -179,60 +486,84 @@ def attn(x, scope, n_state, *, attention_type, params, bias, dim_seq, memory_len
         k = mtfparams.compute_k(x)
         v = mtfparams.compute_v(x)
 
-        if is_incremental_inference(context):
-            one_hot = mtf.one_hot(context.position - 1, dim_seq, dtype=variable_dtype.master_dtype)
-            inv_one_hot = 1.0 - one_hot
-            old_k, old_v = context.get_states(2)
-            k = old_k * inv_one_hot + k * one_hot
-            v = old_v * inv_one_hot + v * one_hot
-
-        if exists(context):
-            context.record_new_states([k, v])
-
         if exists(pos_emb):
             cos, sin = pos_emb
-            k = apply_rotary_emb(k, cos, sin)
 
             if is_incremental_inference(context):
                 seq_dim = cos.shape.get_dim_by_name('sequence')
                 cos = mtf.gather(cos, context.position - 1, seq_dim)
                 sin = mtf.gather(sin, context.position - 1, seq_dim)
 
+            # Keys are cached after rotation, so each decode step only has to rotate the new key
             q = apply_rotary_emb(q, cos, sin)
+            k = apply_rotary_emb(k, cos, sin)
+
+        radius = params.get("local_attention_radius", 256)
+
+        # A window of positions [batch, window] is decoded at once when prefilling in chunks or verifying speculative
+        # tokens. Local and linear attention states only take the positions of the window before initial_position
+        decode_window = is_incremental_inference(context) and context.position.shape.ndims > 1
+
+        if attention_type in ["linear", "chunked_linear"]:
+            # Linear attention is a recurrence, its decoding state is recorded below instead of a key / value cache
+            pass
+        elif decode_window and attention_type == "local":
+            # The window attends to the ring buffer before it's written to, below
+            pass
+        elif is_incremental_inference(context):
+            # Write the new key / value into its slot of the preallocated cache. Local attention only keeps the last
+            # `radius` key / values, in a ring buffer.
+            old_k, old_v = context.get_states(2)
+            cache_dim = old_k.shape[1]
+            cache_position = context.position - 1
+            if attention_type == "local":
+                cache_position = mtf.mod(cache_position, cache_dim.size)
+            k = write_to_cache(old_k, k, cache_position, cache_dim)
+            v = write_to_cache(old_v, v, cache_position, cache_dim)
+            context.record_new_states([k, v])
+        elif exists(context):
+            if attention_type == "local":
+                context.record_new_states([local_attention_cache(t, dim_seq, context.initial_position, radius)
+                                           for t in (k, v)])
+            else:
+                context.record_new_states([k, v])
 
         with tf.variable_scope("attention"):
             if attention_type == "local":
-                # `local_attention_1d` has built in autoregressive masking, so we don't need mask_attn_weights.
-                radius = params.get("local_attention_radius", 256)
-
-                if is_incremental_inference(context):
-                    q *= one_hot
-
-                a = mtf_transformer.attention.local_attention_1d(
-                    q, k, v,
-                    length_dim=k.shape[1],
-                    key_dim=dim_kv,
-                    value_dim=dim_kv,
-                    radius=radius,
-                    length_dim_num_splits=1,
-                    fully_autoregressive=params["causal"],
-                    attention_kwargs={},
-                )
-
-                if is_incremental_inference(context):
-                    a = mtf.gather(a, context.position - 1, dim_seq)
+                if decode_window:
+                    a, states = incremental_local_window_attention(q, k, v, *context.get_states(2), context.position,
+                                                                   context.initial_position, dim_kv)
+                    context.record_new_states(states)
+                elif is_incremental_inference(context):
+                    a = incremental_local_attention(q, k, v, context.position, dim_kv)
+                else:
+                    # `local_attention_1d` has built in autoregressive masking, so we don't need mask_attn_weights.
+                    a = mtf_transformer.attention.local_attention_1d(
+                        q, k, v,
+                        length_dim=k.shape[1],
+                        key_dim=dim_kv,
+                        value_dim=dim_kv,
+                        radius=radius,
+                        length_dim_num_splits=1,
+                        fully_autoregressive=params["causal"],
+                        attention_kwargs={},
+                    )
 
             elif attention_type == "global":
 
+                attention_block_size = params.get("attention_block_size")
+                use_blockwise_attention = exists(attention_block_size) and not is_incremental_inference(context)
+
                 # TODO: pass in fake context
-                # Broadcast mask bias across batch and heads
-                if exists(bias):
+                # The [sequence, memory_length] mask bias is shared by all layers, and is broadcast across batch and
+                # heads as it is added to the attention logits, rather than materialized per layer
+                attn_bias = None
+                if exists(bias) and not use_blockwise_attention:
                     if not is_incremental_inference(context):
-                        broadcasted_bias = mtf.broadcast(bias, [dim_batch, dim_heads, bias.shape[-2], bias.shape[-1]])
+                        attn_bias = bias
                     else:
-                        # In the incremental case, a custom mask needs to be built that masks out all key/values that are greater than the current position
-                        bias = mtf.gather(bias, context.position - 1, dim_seq)
-                        broadcasted_bias = mtf.broadcast(bias, [dim_batch, dim_heads, bias.shape[-1]])
+                        # In the incremental case, only the slots of the cache that have been written to are visible
+                        attn_bias = incremental_causal_bias(context.position, memory_length_dim, num_mem_kv, q.dtype)
 
                 # memory key / values, from all-attention paper
                 if use_num_mem_kv:
@@ -243,18 +574,47 @@ def attn(x, scope, n_state, *, attention_type, params, bias, dim_seq, memory_len
 
                 attn_dropout_rate = params["attn_dropout"] if params["mode"] == "train" else 0
 
-                a = mtf_transformer.attention.attention(
-                    q, k, v,
-                    memory_length_dim=memory_length_dim,
-                    key_dim=dim_kv,
-                    value_dim=dim_kv,
-                    bias=broadcasted_bias,
-                    dropout_rate=attn_dropout_rate
-                )
-
-            elif attention_type == "linear":
-                linear_attn_fn = causal_linear_attention if params["causal"] else linear_attention
-                a = linear_attn_fn(q, k, v)
+                if use_blockwise_attention:
+                    # Causal masking is built from position indices inside the attention computation
+                    a = blockwise_attention(
+                        q, k, v,
+                        memory_length_dim=memory_length_dim,
+                        key_dim=dim_kv,
+                        value_dim=dim_kv,
+                        block_size=attention_block_size,
+                        causal=exists(bias),
+                        dropout_rate=attn_dropout_rate,
+                        recompute=params["mode"] == "train"
+                    )
+                else:
+                    a = mtf_transformer.attention.attention(
+                        q, k, v,
+                        memory_length_dim=memory_length_dim,
+                        key_dim=dim_kv,
+                        value_dim=dim_kv,
+                        bias=attn_bias,
+                        dropout_rate=attn_dropout_rate
+                    )
+
+            elif attention_type in ["linear", "chunked_linear"]:
+                if decode_window:
+                    write = mtf.less(context.position, context.initial_position)
+                    a, states = incremental_causal_linear_window_attention(q, k, v, *context.get_states(2), write)
+                    context.record_new_states(states)
+                elif is_incremental_inference(context):
+                    a, states = incremental_causal_linear_attention(q, k, v, *context.get_states(2))
+                    context.record_new_states(states)
+                else:
+                    if not params["causal"]:
+                        linear_attn_fn = linear_attention
+                    elif attention_type == "chunked_linear":
+                        linear_attn_fn = partial(chunked_causal_linear_attention,
+                                                 chunk_size=params.get("linear_attention_chunk_size", 64))
+                    else:
+                        linear_attn_fn = causal_linear_attention
+                    a = linear_attn_fn(q, k, v)
+                    if exists(context):
+                        context.record_new_states(causal_linear_attention_state(k, v, context.initial_position))
 
             else:
                 raise NotImplementedError("Unknown attention type {}!".format(attention_type))
@@ -327,7 +687,8 @@ def axial_positional_emb(embd_dim, mesh, params, variable_dtype):
 
     return wpe
 
-def rotary_positional_emb(mesh, sequence_dim, params, variable_dtype):
+def rotary_positional_emb(mesh, sequence_dim, params, variable_dtype, offset=None):
+    """cos / sin of the rotary embedding at each position of sequence_dim, or at the single position offset."""
     dtype = variable_dtype.master_dtype
     dim_head = params["n_embd"] // params["n_head"]
 
@@ -337,8 +698,11 @@ def rotary_positional_emb(mesh, sequence_dim, params, variable_dtype):
     dim_range = mtf.range(mesh, half_dim_head, dtype) * 2 / dim_head.size
     half_freqs = 1. / mtf.pow(mtf.constant(mesh, 10000, dtype = dtype), dim_range)
 
-    seq = mtf.range(mesh, sequence_dim, dtype)
-    half_freqs = mtf.einsum([half_freqs, seq], [sequence_dim, half_dim_head])
+    if offset is None:
+        seq = mtf.range(mesh, sequence_dim, dtype)
+        half_freqs = mtf.einsum([half_freqs, seq], [sequence_dim, half_dim_head])
+    else:
+        half_freqs = half_freqs * offset
 
     freqs = mtf.concat((half_freqs, half_freqs), half_dim_head.name)
     freqs = mtf.rename_dimension(freqs, half_dim_head.name, dim_head.name)
@@ -355,3 +719,86 @@ def rotate_half(x):
 def apply_rotary_emb(x, cos, sin):
     rotated_x = rotate_half(x)
     return x * cos + rotated_x * sin
+
+
+def slide_cache(cache, slide, stride, wrap=False, rotary=None):
+    """Moves the cache entries of the rows where slide is set back by stride positions along its second dim.
+
+    Plain caches drop their first stride entries, ring buffers (wrap=True) are rotated so each entry lives in the slot
+    of its new position. If rotary is (cos, sin) of the rotary embedding at -stride, entries are also rotated back by
+    stride positions. The work is skipped entirely when no row of a slice slides.
+    """
+    axis = 1
+    head_axis = cache.shape.dims.index(cache.shape.get_dim_by_name("features_per_head")) if rotary else None
+    inputs = [cache, slide] + (list(rotary) if rotary else [])
+
+    def _tf_slide(tf_cache, tf_slide, *tf_rotary):
+        def _slid():
+            slid = tf.roll(tf_cache, -stride, axis=axis)
+            if not wrap:
+                # Zero the entries that wrapped around - they are past the rebased position and masked out anyway
+                keep = tf.range(tf.shape(tf_cache)[axis]) < tf.shape(tf_cache)[axis] - stride
+                slid *= tf.cast(tf.reshape(keep, [1, -1] + [1] * (tf_cache.shape.ndims - 2)), slid.dtype)
+            if tf_rotary:
+                cos, sin = [tf.reshape(t, [-1 if i == head_axis else 1 for i in range(tf_cache.shape.ndims)])
+                            for t in tf_rotary]
+                x1, x2 = tf.split(slid, 2, axis=head_axis)
+                slid = slid * cos + tf.concat([-x2, x1], axis=head_axis) * sin
+            row_slides = tf.reshape(tf_slide, [-1] + [1] * (tf_cache.shape.ndims - 1))
+            return tf.where(tf.broadcast_to(row_slides, tf.shape(tf_cache)), slid, tf_cache)
+
+        return tf.cond(tf.reduce_any(tf_slide), _slid, lambda: tf_cache)
+
+    unsplittable = [cache.shape.dims[axis]] + ([cache.shape.dims[head_axis]] if rotary else [])
+    return mtf.slicewise(_tf_slide, inputs, output_shape=cache.shape, output_dtype=cache.dtype,
+                         splittable_dims=[d for d in cache.shape.dims if d not in unsplittable], name="slide_cache")
+
+
+def slide_attention_states(states, slide, stride, params, variable_dtype):
+    """Moves the incremental attention states of the rows where slide is set back by stride positions.
+
+    Used to keep decoding once the context is full. Keys are re-rotated for models with rotary embeddings, so they are
+    consistent with the rebased positions. Keys of models with learned position embeddings keep the positions they
+    were computed at.
+    """
+    rotary = None
+    if exists(params["rotary_emb"]):
+        rotary = rotary_positional_emb(slide.mesh, None, params, variable_dtype, offset=-stride)
+        rotary = [mtf.cast(t, states[0].dtype) for t in rotary]
+
+    new_states = []
+    states = list(states)
+    for attention_type in params["attention_types"]:
+        if attention_type == "none":
+            continue
+        if attention_type not in ["global", "local"]:
+            raise NotImplementedError(f"Sliding the context isn't supported for {attention_type} attention")
+        k, v = states.pop(0), states.pop(0)
+        wrap = attention_type == "local"
+        new_states += [slide_cache(k, slide, stride, wrap=wrap, rotary=rotary), slide_cache(v, slide, stride, wrap=wrap)]
+    return new_states
+
+
+def empty_attention_states(batch_dims, length_dim, params, variable_dtype, mesh):
+    """Zeroed incremental attention states, as a first_part pass over length_dim records them.
+
+    They are filled in by incremental decoding, e.g. when prefilling a prompt one chunk at a time.
+    """
+    dtype = variable_dtype.activation_dtype
+    heads_dim = mtf.Dimension("heads", params["n_head"])
+    kv_dim = mtf.Dimension("features_per_head", params["n_embd"] // params["n_head"])
+    kv_in_dim = mtf.Dimension("features_per_head_in", kv_dim.size)
+    radius = params.get("local_attention_radius", 256)
+
+    states = []
+    for attention_type in params["attention_types"]:
+        if attention_type == "none":
+            continue
+        if attention_type in ["linear", "chunked_linear"]:
+            shapes = [batch_dims + [heads_dim, kv_in_dim, kv_dim], batch_dims + [heads_dim, kv_in_dim]]
+        else:
+            cache_dim = length_dim if attention_type == "global" else \
+                mtf.Dimension("local_cache", min(radius, length_dim.size))
+            shapes = [batch_dims + [cache_dim, heads_dim, kv_dim]] * 2
+        states += [mtf.zeros(mesh, mtf.Shape(shape), dtype=dtype) for shape in shapes]
+    return states
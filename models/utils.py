@@ -88,12 +88,12 @@ def entmax_cross_entropy_with_logits(logits, targets, vocab_dim, z_loss=0.0):
 
 
 def sample_categorical(x, dim=None):
+    # Samples from the probabilities x with the gumbel-max trick. Unlike inverting the cdf, this needs no cumsum, which
+    # in mtf is an einsum with a [dim, dim] mask
     dim = x.shape[-1] if dim is None else dim
-
-    cdf = mtf.cumsum(x, dim)
-    rand_uniform = mtf.random_uniform(x.mesh, x.shape - dim, minval=0, maxval=1)
-    mask = mtf.cast(mtf.greater(cdf, rand_uniform), tf.int32)
-    return mtf.argmax(mask, dim)
+    x = mtf.cast(x, tf.float32)
+    gumbel = -mtf.log(-mtf.log(mtf.random_uniform(x.mesh, x.shape, minval=1e-9, maxval=1., dtype=tf.float32)))
+    return mtf.argmax(mtf.log(x) + gumbel, dim)
 
 
 def biasmask_attn_weights(mesh, nd, ns, variable_dtype):
@@ -1,10 +1,151 @@
+from functools import partial
+
 import mesh_tensorflow as mtf
 import tensorflow.compat.v1 as tf
 import mesh_tensorflow.transformer as mtf_transformer
 
 from models.utils import entmax, sample_categorical
+from models.layers import slide_attention_states, empty_attention_states
 from models.gpt2 import gpt2
 
+def sample_logits(logits, vocab_dim, temperature=0.9, sampling_keep_top_k=-1, sampling_use_entmax=False,
+                  sampling_top_p=None, sampling_top_p_candidates=256):
+    """Samples one id per position from logits - see sample_autoregressive for the meaning of the arguments."""
+    if sampling_use_entmax:
+        return sample_categorical(entmax(logits))
+
+    # By default, do top_k sampling of 0.9
+    if sampling_keep_top_k == -2:
+        sampling_keep_top_k = int(logits.shape[-1].size * 0.1)
+
+    if sampling_keep_top_k != -1 and sampling_keep_top_k <= 0:
+        raise ValueError("sampling_keep_top_k must either be -1 or positive.")
+    if sampling_top_p is not None and not 0 < sampling_top_p <= 1:
+        raise ValueError("sampling_top_p must be in (0, 1].")
+
+    if temperature == 0.0 or (sampling_keep_top_k == -1 and sampling_top_p is None):
+        return mtf.sample_with_temperature(logits, vocab_dim, temperature)
+
+    # Only the top candidates can be sampled, so pick among them instead of masking and sampling over the whole vocab.
+    # Top p sampling only considers the first sampling_top_p_candidates tokens of the nucleus.
+    n_candidates = sampling_keep_top_k if sampling_keep_top_k != -1 else sampling_top_p_candidates
+    candidates_dim = mtf.Dimension("sampling_candidates", min(n_candidates, vocab_dim.size))
+    logits = mtf.cast(logits, tf.float32) / temperature
+    candidate_logits, candidate_ids = mtf.top_k(logits, reduced_dim=vocab_dim, k_dim=candidates_dim)
+
+    if sampling_top_p is not None:
+        # Keep the most likely candidates until their probability reaches sampling_top_p
+        candidate_probs = mtf.exp(candidate_logits - mtf.reduce_logsumexp(logits, reduced_dim=vocab_dim))
+        probs_before = mtf.cumsum(candidate_probs, candidates_dim, exclusive=True)
+        candidate_logits = mtf.where(mtf.less(probs_before, sampling_top_p), candidate_logits,
+                                     mtf.ones_like(candidate_logits) * -1e9)
+
+    choice = mtf.sample_with_temperature(candidate_logits, candidates_dim, 1.0)
+    return mtf.gather(candidate_ids, choice, candidates_dim)
+
+
+def batch_num_splits(batch_dim, params):
+    """Number of slices the layout splits batch_dim into over the mesh."""
+    mesh_shape = mtf.convert_to_shape(params["mesh_shape"])
+    layout_rules = mtf.convert_to_layout_rules(params["layout"])
+    mesh_axis = layout_rules.tensor_dimension_to_mesh_axis(batch_dim, mesh_shape)
+    return mesh_shape.dims[mesh_axis].size if mesh_axis is not None else 1
+
+
+def compacted_batch_sizes(batch_dim, params):
+    """Batch sizes to decode with when compacting - the batch is halved while it still splits evenly over the mesh."""
+    num_splits = batch_num_splits(batch_dim, params)
+    batch_sizes = [batch_dim.size]
+    while batch_sizes[-1] % 2 == 0 and (batch_sizes[-1] // 2) % num_splits == 0:
+        batch_sizes.append(batch_sizes[-1] // 2)
+    return batch_sizes
+
+
+def running_first_selection(done, batch_size):
+    """
+    One-hot [compact_batch, batch] matrix taking batch_size rows of a batch, those of still running sequences first.
+    """
+    batch_dim = done.shape.dims[0]
+    # Rank of each row when sorted by (done, row index)
+    key = mtf.to_int32(done) * batch_dim.size + mtf.range(done.mesh, batch_dim, tf.int32)
+    other_key = mtf.rename_dimension(key, batch_dim.name, "other_batch")
+    rank = mtf.reduce_sum(mtf.to_int32(mtf.less(other_key, key)), reduced_dim=other_key.shape.dims[0])
+    compact_range = mtf.range(done.mesh, mtf.Dimension("compact_batch", batch_size), tf.int32)
+    return mtf.to_int32(mtf.equal(compact_range, rank))
+
+
+def compact(x, selection):
+    """Takes the rows of x picked by a running_first_selection, as a smaller batch dimension of the same name."""
+    compact_dim = selection.shape.get_dim_by_name("compact_batch")
+    batch_dim, = [d for d in selection.shape.dims if d != compact_dim]
+    is_bool = x.dtype == tf.bool
+    if is_bool:
+        x = mtf.to_int32(x)
+    x = mtf.einsum([mtf.cast(selection, x.dtype), x],
+                   output_shape=[compact_dim if d == batch_dim else d for d in x.shape.dims])
+    x = mtf.rename_dimension(x, compact_dim.name, batch_dim.name)
+    return mtf.cast(x, tf.bool) if is_bool else x
+
+
+def uncompact(x, selection, compacted):
+    """Writes the rows of compacted, taken from x by compact(x, selection), back into x."""
+    compact_dim = selection.shape.get_dim_by_name("compact_batch")
+    compacted = mtf.rename_dimension(compacted, x.shape.dims[0].name, compact_dim.name)
+    taken = mtf.reduce_sum(selection, reduced_dim=compact_dim)
+    return x * (1 - taken) + mtf.einsum([selection, compacted], output_shape=x.shape)
+
+
+def prefill_in_chunks(inputs, other_features, params, initial_position, chunk_size, variable_dtype, states=None,
+                      start_position=None):
+    """Records the attention states of the prompts in inputs, decoding chunk_size positions at a time.
+
+    Gives the same states as a first_part pass over the whole of inputs, but activations only ever span one chunk of
+    the sequence. Chunks past the longest prompt are skipped.
+
+    If states already hold the first start_position (a [batch] tensor) tokens of each prompt, only the rest of the
+    prompts is decoded.
+    """
+    mesh = inputs.mesh
+    batch_dims = inputs.shape.dims[:-1]
+    length_dim = inputs.shape.dims[-1]
+    chunk_dim = mtf.Dimension("prefill_chunk", chunk_size)
+    chunk_range = mtf.broadcast(mtf.range(mesh, chunk_dim, tf.int32), batch_dims + [chunk_dim])
+    if start_position is not None:
+        chunk_range += start_position
+    # The first decoding step processes the last token of each prompt, the chunks cover the tokens before it
+    n_prefill = mtf.reduce_max(initial_position if start_position is None else initial_position - start_position) - 1
+
+    def cond_fn(chunk_start, *unused_states):
+        return mtf.less(chunk_start, n_prefill)
+
+    def body_fn(chunk_start, *states):
+        # Positions past the end of the sequence only occur in rows whose prompt has already ended
+        position = mtf.minimum(chunk_range + chunk_start + 1, length_dim.size)
+        context = mtf_transformer.transformer.Context(
+            model=None,
+            mesh=mesh,
+            batch_dims=batch_dims,
+            length_dim=length_dim,
+            variable_dtype=variable_dtype,
+            mode="incremental",
+            position=position,
+            position_is_default=True,
+            states=states,
+            new_states=[],
+            initial_position=initial_position,
+            inputs=inputs)
+        with tf.variable_scope("gpt2", reuse=tf.AUTO_REUSE):
+            gpt2.model({"inputs": inputs}, other_features, params, mesh, variable_dtype=variable_dtype,
+                       context=context)
+        # The logits of the chunk aren't used, so they are pruned from the lowered graph
+        return [chunk_start + chunk_size] + context.new_states
+
+    if states is None:
+        states = empty_attention_states(batch_dims, length_dim, params, variable_dtype, mesh)
+    _, *states = mtf.while_loop(cond_fn, body_fn, [mtf.zeros(mesh, [], tf.int32)] + states)
+    return states
+
+
 def sample_autoregressive(partial_sequences,
                           other_features,
                           params,
@@ -22,7 +163,12 @@ def sample_autoregressive(partial_sequences,
                           remove_partial_sequences=False,
                           sampling_keep_top_k=-1,
                           sampling_use_entmax = False,
+                          sampling_top_p=None,
+                          sampling_top_p_candidates=256,
                           bos_id=50256,
+                          compact_batch=False,
+                          sliding_window_stride=None,
+                          prefill_chunk_size=None,
                           ):
     """Sample randomly one token at a time.
 
@@ -54,7 +200,20 @@ def sample_autoregressive(partial_sequences,
         sequences from the output
         sampling_keep_top_k: an integer - if not -1, only sample from the top k
         logits.
+        sampling_use_entmax: a boolean - if set, sample from entmax(logits)
+        sampling_top_p: an optional float - if set, only sample from the smallest
+        set of most likely tokens whose probability reaches top p (nucleus
+        sampling). Combines with sampling_keep_top_k.
+        sampling_top_p_candidates: an integer - the most tokens top p sampling
+        considers, when sampling_keep_top_k is not set.
         bos_id: beginning of sequence id
+        compact_batch: a boolean - if set, once at most half the sequences are still running they continue in a batch
+        of half the size, so finished sequences stop costing compute
+        sliding_window_stride: an optional integer - if set, decoding continues past the end of length_dim: when a
+        sequence fills the context, its cached keys / values are shifted back by this many positions, dropping the
+        oldest. Needs max_steps, the output is then max_steps longer than partial_sequences.
+        prefill_chunk_size: an optional integer - if set, the partial sequences are prefilled this many positions at a
+        time, so the activation memory of the prefill scales with it rather than with length_dim
 
     Returns:
         a Tensor with shape [<batch_dims>, length_dim]
@@ -65,6 +224,14 @@ def sample_autoregressive(partial_sequences,
     length_dim = inputs.shape.dims[-1]
     padding_id = params.get("padding_id", 0)
     slow_sampling = params.get("slow_sampling", False)
+    sliding = sliding_window_stride is not None
+    if sliding:
+        if slow_sampling:
+            raise ValueError("sliding_window_stride needs the incremental sampling path")
+        if not max_steps:
+            raise ValueError("sliding_window_stride needs max_steps")
+        if not 0 < sliding_window_stride < length_dim.size:
+            raise ValueError("sliding_window_stride must be between 0 and the sequence length")
 
 
     initial_position = mtf.reduce_sum(
@@ -83,7 +250,13 @@ def sample_autoregressive(partial_sequences,
     # Builds context to pass around internally
     # The 'first part' context records initial states of k / v / x
 
-    if not slow_sampling:
+    if not slow_sampling and prefill_chunk_size:
+        if has_partial_sequences:
+            initial_states = prefill_in_chunks(inputs, other_features, params, initial_position, prefill_chunk_size,
+                                               variable_dtype)
+        else:
+            initial_states = empty_attention_states(batch_dims, length_dim, params, variable_dtype, inputs.mesh)
+    elif not slow_sampling:
         context_first_part = mtf_transformer.transformer.Context(
             model=None,
             mesh=inputs.mesh,
@@ -106,8 +279,9 @@ def sample_autoregressive(partial_sequences,
             inputs=inputs,
             encoder_inputs=encoder_inputs)
 
+        # Prefill - only records the attention states, no logits are computed
         with tf.variable_scope("gpt2"):
-            logits, _, _ = gpt2.model({"inputs": inputs}, other_features, params, inputs.mesh, variable_dtype=variable_dtype, context=context_first_part)
+            gpt2.model({"inputs": inputs}, other_features, params, inputs.mesh, variable_dtype=variable_dtype, context=context_first_part)
 
         if not has_partial_sequences:
             initial_states = [mtf.zeros_like(t) for t in context_first_part.new_states]
@@ -116,103 +290,489 @@ def sample_autoregressive(partial_sequences,
     else:
         initial_states = []
 
-    if not has_partial_sequences:
-        partial_sequences_eos_count = 0
+    def is_done(position, start_position):
+        if sliding:
+            # The context slides rather than filling up, so only max_steps ends a sequence
+            return mtf.greater_equal(position - start_position, max_steps)
+        done = mtf.greater_equal(position, length_dim.size)
+        if max_steps:
+            done = mtf.logical_or(done, mtf.greater_equal(position - start_position, max_steps))
+        return done
+
+    def decode(batch_dims, position, ids, done, window, states, start_position, max_running=0):
+        """Decodes until at most max_running sequences of the batch are not done.
+
+        window is [offset, outputs] with a sliding window (how far each sequence's window has moved, and the whole
+        sequences), otherwise empty.
+        """
+        n_window = len(window)
+
+        def cond_fn(position, ids, done, *unused_states):
+            """Should we run another loop iteration?"""
+            n_running = mtf.reduce_sum(mtf.to_int32(mtf.logical_not(done)))
+            return mtf.greater(n_running, max_running)
+
+        def body_fn(position, ids, done, *states):
+            """One step in the decode loop."""
+            window, states = states[:n_window], states[n_window:]
+            if sliding:
+                # Make room in the context of the sequences that filled it
+                offset, outputs = window
+                slide = mtf.logical_and(mtf.greater_equal(position, length_dim.size), mtf.logical_not(done))
+                shift = sliding_window_stride * mtf.to_int32(slide)
+                ids = mtf.where(slide, mtf.shift(ids, -sliding_window_stride, length_dim, wrap=False), ids)
+                states = slide_attention_states(states, slide, sliding_window_stride, params, variable_dtype)
+                position, offset = position - shift, offset + shift
+                # Positions in the context are now relative to the start of its window
+                length_range_gt_start = mtf.to_int32(mtf.greater(length_range, start_position - offset))
+            else:
+                length_range_gt_start = mtf.to_int32(mtf.greater(length_range, start_position))
+
+            context = mtf_transformer.transformer.Context(
+                model=None,
+                mesh=inputs.mesh,
+                batch_dims=batch_dims,
+                length_dim=length_dim,
+                variable_dtype=variable_dtype,
+                mode="incremental",
+                position=position,
+                position_is_default=True,
+                states=states,
+                new_states=[],
+                initial_position=position,
+                sequence_id=None,
+                encoder_output=encoder_output,
+                encoder_sequence_id=encoder_sequence_id,
+                shared_params=shared_params,
+                encoder_layer_outputs=encoder_layer_outputs,
+                write_priority=length_range * length_range_gt_start,
+                read_priority=length_range * length_range_gt_start,
+                inputs=ids,
+                encoder_inputs=encoder_inputs) if not slow_sampling else None
+
+            with tf.variable_scope("gpt2", reuse=tf.AUTO_REUSE):
+                logits, _, _ = gpt2.model({"inputs": ids}, other_features, params, inputs.mesh, variable_dtype=variable_dtype, context = context)
+
+            ids_this_step = sample_logits(logits, other_features["vocab_dim"], temperature=temperature,
+                                          sampling_keep_top_k=sampling_keep_top_k,
+                                          sampling_use_entmax=sampling_use_entmax,
+                                          sampling_top_p=sampling_top_p,
+                                          sampling_top_p_candidates=sampling_top_p_candidates)
+
+            one_hot = mtf.one_hot(position, length_dim, dtype=tf.int32)
+            if slow_sampling:
+                ids_this_step = mtf.shift(ids_this_step, offset=1, dim=length_dim, wrap=False)
+                ids_this_step = mtf.reduce_sum(ids_this_step * one_hot, reduced_dim=length_dim)
+            else:
+                ids_this_step = mtf.reshape(ids_this_step, (batch_dims))
 
-    if stop_at_token is not None:
-        partial_sequences_eos_count = mtf.reduce_sum(
-            mtf.to_int32(mtf.equal(partial_sequences, stop_at_token)),
+            # Finished sequences keep their ids and position
+            running = mtf.to_int32(mtf.logical_not(done))
+            one_hot *= running
+            new_ids = (1 - one_hot) * ids + ids_this_step * one_hot
+            new_position = position + running
+
+            new_done = mtf.logical_or(done, is_done(new_position + offset if sliding else new_position, start_position))
+            if stop_at_token is not None:
+                new_done = mtf.logical_or(new_done, mtf.equal(ids_this_step, stop_at_token))
+
+            ret = [new_position, new_ids, new_done]
+            if sliding:
+                output_one_hot = mtf.one_hot(position + offset, outputs.shape.dims[-1], dtype=tf.int32) * running
+                ret += [offset, (1 - output_one_hot) * outputs + ids_this_step * output_one_hot]
+            if context is not None:
+                ret += context.new_states
+            return ret
+
+        position, ids, done, *states = mtf.while_loop(cond_fn, body_fn, [position, ids, done] + window + states)
+        return position, ids, done, states[:n_window], states[n_window:]
+
+    done = is_done(initial_position, initial_position)
+    position, ids, states, start_position = initial_position, inputs, initial_states, initial_position
+    # The whole sequences are kept apart from the context when it slides
+    window = [mtf.zeros_like(initial_position), mtf.pad(inputs, [0, max_steps], length_dim.name)] if sliding else []
+    stage_batch_dims = batch_dims
+    batch_sizes = compacted_batch_sizes(batch_dims[0], params) if compact_batch else [batch_dims[0].size]
+    compactions = []
+    for next_batch_size in batch_sizes[1:] + [0]:
+        position, ids, done, window, states = decode(stage_batch_dims, position, ids, done, window, states,
+                                                     start_position, max_running=next_batch_size)
+        if next_batch_size > 0:
+            # Continue decoding the sequences that are still running in a smaller batch
+            selection = running_first_selection(done, next_batch_size)
+            compactions.append((selection, window[-1] if sliding else ids))
+            position, ids, done, start_position = [compact(t, selection) for t in (position, ids, done, start_position)]
+            window = [compact(t, selection) for t in window]
+            states = [compact(t, selection) for t in states]
+            stage_batch_dims = [ids.shape.dims[0]]
+
+    # Write the sequences of each smaller batch back into the rows they were taken from
+    outputs = window[-1] if sliding else ids
+    for selection, stage_outputs in reversed(compactions):
+        outputs = uncompact(stage_outputs, selection, outputs)
+
+    if has_partial_sequences and remove_partial_sequences:
+        # Remove partial sequences from outputs
+        partial_length = mtf.reduce_sum(
+            mtf.to_int32(mtf.not_equal(partial_sequences, padding_id)),
             reduced_dim=length_dim)
+        outputs = mtf.dynamic_shift(
+            outputs, -partial_length, outputs.shape.dims[-1], wrap=False)
+    return outputs
 
-    def cond_fn(position, ids, *unused_states):
-        """Should we run another loop iteration?"""
-        past_end = mtf.greater_equal(position, length_dim.size)
-        if max_steps:
-            past_end = mtf.logical_or(
-                past_end, mtf.greater_equal(position - initial_position, max_steps))
 
-        is_done = past_end
-        if stop_at_token is not None:
-            eos_count = mtf.reduce_sum(
-                mtf.to_int32(mtf.equal(ids, stop_at_token)),
-                reduced_dim=length_dim)
-            has_additional_eos = mtf.greater(eos_count, partial_sequences_eos_count)
-            is_done = mtf.logical_or(is_done, has_additional_eos)
-        all_done = mtf.reduce_all(is_done)
-        return mtf.logical_not(all_done)
-
-    def body_fn(position, ids, *states):
-        """One step in the decode loop."""
-        nonlocal sampling_keep_top_k
+def speculative_sample_autoregressive(partial_sequences,
+                                      other_features,
+                                      params,
+                                      draft_other_features,
+                                      draft_params,
+                                      stop_at_token=50256,
+                                      max_steps=None,
+                                      temperature=0.9,
+                                      num_speculative_tokens=4,
+                                      variable_dtype=mtf.VariableDType(tf.float32),
+                                      remove_partial_sequences=False,
+                                      ):
+    """Samples with speculative decoding - a small draft model proposes tokens, which the model verifies at once.
+
+    Each round the draft model (under the "draft" variable scope) samples num_speculative_tokens tokens one at a time,
+    then the model scores all of them in a single forward pass over a window of positions. Draft tokens are accepted
+    with probability min(1, p / q), and the first rejected one is resampled from the residual max(0, p - q), so the
+    samples follow the model's own distribution (with temperature 0, the draft tokens are accepted while they match
+    the model's argmax). Each round commits between 1 and num_speculative_tokens + 1 tokens.
+
+    The key / value caches are indexed by position, so rejected tokens are rolled back by moving the position back -
+    their cache entries are masked out and overwritten by the next round. Both models must therefore only have global
+    attention layers.
+
+    Args:
+        partial_sequences: an int32 Tensor with shape [<batch_dims>, length_dim]
+        other_features: the model's other_features
+        params: the model's params
+        draft_other_features: the draft model's other_features. The vocab must be the same as the model's.
+        draft_params: the draft model's params
+        stop_at_token: an optional integer eos id.  Stop when we produce it.
+        max_steps: an optional integer, the max number of tokens to decode.
+        temperature: a float - 0.0 means argmax, 1.0 means sample according to the predicted distribution.
+        num_speculative_tokens: an integer - the number of tokens the draft model proposes each round
+        variable_dtype: a mtf.VariableDType
+        remove_partial_sequences: a boolean - whether to remove the partial sequences from the output
+
+    Returns:
+        a Tensor with shape [<batch_dims>, length_dim]
+    """
+    if num_speculative_tokens < 1:
+        raise ValueError("num_speculative_tokens must be positive.")
+    for model_params in (params, draft_params):
+        if any(t != "global" for t in model_params["attention_types"]):
+            raise NotImplementedError("Speculative decoding needs models with only global attention layers")
+    if draft_other_features["vocab_dim"] != other_features["vocab_dim"]:
+        raise ValueError("The draft model must have the same vocab as the model.")
+
+    inputs = partial_sequences
+    mesh = inputs.mesh
+    batch_dims = inputs.shape.dims[:-1]
+    length_dim = inputs.shape.dims[-1]
+    vocab_dim = other_features["vocab_dim"]
+    padding_id = params.get("padding_id", 0)
+    k = num_speculative_tokens
+
+    initial_position = mtf.reduce_sum(
+        mtf.to_int32(mtf.not_equal(inputs, padding_id)), reduced_dim=length_dim)
 
+    def run_model(scope, model_params, model_other_features, ids, mode, position, states=None):
+        """Runs a model in first_part or incremental mode, returns its logits and the new attention states"""
         context = mtf_transformer.transformer.Context(
             model=None,
-            mesh=inputs.mesh,
+            mesh=mesh,
             batch_dims=batch_dims,
             length_dim=length_dim,
             variable_dtype=variable_dtype,
+            mode=mode,
+            position=position,
+            position_is_default=True,
+            states=states,
+            new_states=[],
+            initial_position=initial_position if mode == "first_part" else position,
+            inputs=ids)
+        with tf.variable_scope(scope, reuse=tf.AUTO_REUSE):
+            logits, _, _ = gpt2.model({"inputs": ids}, model_other_features, model_params, mesh,
+                                      variable_dtype=variable_dtype, context=context)
+        return logits, context.new_states
+
+    run_target = partial(run_model, "gpt2", params, other_features)
+    run_draft = partial(run_model, "draft/gpt2", draft_params, draft_other_features)
+
+    # Prefill both models
+    length_range = mtf.range(mesh, length_dim, tf.int32)
+    _, target_states = run_target(inputs, "first_part", length_range)
+    _, draft_states = run_draft(inputs, "first_part", length_range)
+    n_target_states = len(target_states)
+
+    def is_done(position):
+        done = mtf.greater_equal(position, length_dim.size)
+        if max_steps:
+            done = mtf.logical_or(done, mtf.greater_equal(position - initial_position, max_steps))
+        return done
+
+    def to_vocab_logits(logits, dims):
+        # Drops the size 1 sequence dim of incremental logits
+        return mtf.cast(mtf.reshape(logits, dims + [vocab_dim]), tf.float32)
+
+    def cond_fn(position, ids, done, *unused_states):
+        return mtf.reduce_any(mtf.logical_not(done))
+
+    def body_fn(position, ids, done, *states):
+        target_states, draft_states = states[:n_target_states], states[n_target_states:]
+
+        # Draft k tokens. The extra last step only adds the last draft token to the draft cache, for when all of them
+        # are accepted
+        draft_ids, draft_tokens, draft_probs = ids, [], []
+        for i in range(k + 1):
+            logits, draft_states = run_draft(draft_ids, "incremental", position + i, draft_states)
+            if i == k:
+                break
+            logits = to_vocab_logits(logits, batch_dims)
+            token = mtf.sample_with_temperature(logits, vocab_dim, temperature)
+            one_hot = mtf.one_hot(position + i, length_dim, dtype=tf.int32)
+            draft_ids = (1 - one_hot) * draft_ids + token * one_hot
+            draft_tokens.append(token)
+            draft_probs.append(mtf.softmax(logits / temperature, vocab_dim) if temperature != 0.0 else None)
+
+        # Score the last known token and all the draft tokens in one forward pass of the model
+        window_dim = mtf.Dimension("speculative_window", k + 1)
+        window_position = position + mtf.range(mesh, window_dim, tf.int32)
+        logits, target_states = run_target(draft_ids, "incremental", window_position, target_states)
+        target_logits = mtf.unstack(to_vocab_logits(logits, batch_dims + [window_dim]), window_dim)
+
+        # Count the leading accepted draft tokens, and pick the token replacing the first rejected one
+        n_accepted = mtf.zeros(mesh, batch_dims, dtype=tf.int32)
+        all_accepted = mtf.ones(mesh, batch_dims, dtype=tf.int32)
+        new_tokens = []
+        for i in range(k):
+            if temperature == 0.0:
+                target_token = mtf.argmax(target_logits[i], vocab_dim)
+                accept = mtf.equal(draft_tokens[i], target_token)
+                correction = target_token
+            else:
+                p = mtf.softmax(target_logits[i] / temperature, vocab_dim)
+                q = draft_probs[i]
+                one_hot = mtf.one_hot(draft_tokens[i], vocab_dim, dtype=tf.float32)
+                p_token = mtf.reduce_sum(p * one_hot, reduced_dim=vocab_dim)
+                q_token = mtf.reduce_sum(q * one_hot, reduced_dim=vocab_dim)
+                accept = mtf.less(mtf.random_uniform(mesh, batch_dims) * q_token, p_token)
+                correction = mtf.sample_with_temperature(mtf.log(mtf.maximum(p - q, 1e-20)), vocab_dim, 1.0)
+            all_accepted *= mtf.to_int32(accept)
+            n_accepted += all_accepted
+            new_tokens.append(mtf.where(mtf.greater(n_accepted, i), draft_tokens[i], correction))
+        # If all draft tokens are accepted, the model's prediction after the last one comes for free
+        new_tokens.append(mtf.sample_with_temperature(target_logits[k], vocab_dim, temperature))
+
+        # Commit the accepted tokens and the correction, up to the end of the sequence
+        new_ids, new_position, new_done = ids, position, done
+        for i, token in enumerate(new_tokens):
+            write = mtf.logical_and(mtf.logical_not(new_done), mtf.greater_equal(n_accepted, i))
+            one_hot = mtf.one_hot(position + i, length_dim, dtype=tf.int32) * mtf.to_int32(write)
+            new_ids = (1 - one_hot) * new_ids + token * one_hot
+            new_position += mtf.to_int32(write)
+            new_done = mtf.logical_or(new_done, is_done(new_position))
+            if stop_at_token is not None:
+                new_done = mtf.logical_or(new_done, mtf.logical_and(write, mtf.equal(token, stop_at_token)))
+
+        # Caches past new_position - 1 hold rejected tokens, they are masked out and overwritten next round
+        return [new_position, new_ids, new_done] + target_states + draft_states
+
+    done = is_done(initial_position)
+    _, outputs, *_ = mtf.while_loop(cond_fn, body_fn, [initial_position, inputs, done] + target_states + draft_states)
+
+    if remove_partial_sequences:
+        outputs = mtf.dynamic_shift(outputs, -initial_position, length_dim, wrap=False)
+    return outputs
+
+
+def reorder_beams(x, beam_index, beam_size):
+    """Reorders the rows of x so each row takes the row of beam beam_index of its own sequence.
+
+    x and beam_index share a flat batch dim, made of beam_size consecutive rows (beams) per sequence. The gather is
+    done slice by slice, so each slice must hold a multiple of beam_size rows - beam_search_autoregressive checks this.
+    """
+    batch_dim = beam_index.shape.dims[0]
+    axis = x.shape.dims.index(batch_dim)
+
+    def _tf_reorder(tf_x, tf_beam_index):
+        rows = tf.range(tf.shape(tf_beam_index)[0])
+        return tf.gather(tf_x, rows - rows % beam_size + tf_beam_index, axis=axis)
+
+    return mtf.slicewise(_tf_reorder, [x, beam_index], output_shape=x.shape, output_dtype=x.dtype,
+                         splittable_dims=x.shape.dims, name="reorder_beams")
+
+
+def beam_search_autoregressive(partial_sequences,
+                               other_features,
+                               params,
+                               beam_size=4,
+                               stop_at_token=50256,
+                               max_steps=None,
+                               length_penalty=0.6,
+                               variable_dtype=mtf.VariableDType(tf.float32),
+                               remove_partial_sequences=False,
+                               prefill_chunk_size=None,
+                               ):
+    """Beam search decoding, reusing the incremental attention states.
+
+    The beam_size beams of each sequence are decoded as consecutive rows of one flat batch. The prompts are prefilled
+    once and their attention states copied to each beam. Each step every beam proposes its beam_size best
+    continuations, and the beam_size best of those (by length normalized log probability) become the new beams - their
+    attention states are reordered with a gather rather than recomputed.
+
+    A beam that produces stop_at_token, or reaches the end of the sequence or max_steps, is finished - it keeps its
+    score and length, and competes with the running beams until every beam of the sequence is finished.
+
+    Args:
+        partial_sequences: an int32 Tensor with shape [batch_dim, length_dim]
+        other_features: the model's other_features
+        params: the model's params
+        beam_size: an integer - the number of beams per sequence
+        stop_at_token: an optional integer eos id.  A beam is finished when it produces it.
+        max_steps: an optional integer, the max number of tokens to decode.
+        length_penalty: a float - log probabilities are divided by ((5 + length) / 6) ** length_penalty, where length
+        is the number of decoded tokens. 0.0 ranks beams by their log probability alone, higher values favour longer
+        sequences.
+        variable_dtype: a mtf.VariableDType
+        remove_partial_sequences: a boolean - whether to remove the partial sequences from the output
+        prefill_chunk_size: an optional integer - if set, the prompts are prefilled this many positions at a time
+
+    Returns:
+        a Tensor with shape [batch_dim, length_dim], the best beam of each sequence
+    """
+    inputs = partial_sequences
+    mesh = inputs.mesh
+    batch_dim, length_dim = inputs.shape.dims
+    vocab_dim = other_features["vocab_dim"]
+    padding_id = params.get("padding_id", 0)
+    if beam_size > vocab_dim.size:
+        raise ValueError("beam_size can't be larger than the vocab.")
+
+    beam_dim = mtf.Dimension("beam", beam_size)
+    flat_batch_dim = mtf.Dimension(batch_dim.name, batch_dim.size * beam_size)
+    # reorder_beams gathers within each slice of the flat batch, so every slice has to hold whole sequences' beams
+    num_splits = batch_num_splits(flat_batch_dim, params)
+    if batch_dim.size % num_splits != 0:
+        raise ValueError(f"Beam search needs a batch size divisible by the {num_splits} slices the batch is split "
+                         f"into over the mesh, so the beams of a sequence are on one device. Got {batch_dim.size}.")
+    candidates_dim = mtf.Dimension("beam_candidates", beam_size)
+    choices_dim = mtf.Dimension("beam_choices", beam_size * beam_size)
+
+    def expand(x):
+        # [batch, ...] -> [batch * beam, ...], beam_size copies of each row
+        x = mtf.broadcast(x, [batch_dim, beam_dim] + (x.shape - batch_dim).dims)
+        return mtf.reshape(x, [flat_batch_dim] + (x.shape - batch_dim - beam_dim).dims)
+
+    def unflatten(x):
+        # [batch * beam, ...] -> [batch, beam, ...]
+        return mtf.reshape(x, [batch_dim, beam_dim] + (x.shape - flat_batch_dim).dims)
+
+    def flatten(x):
+        return mtf.reshape(x, [flat_batch_dim] + (x.shape - batch_dim - beam_dim).dims)
+
+    def normalizer(length):
+        return mtf.pow(mtf.cast(length + 5, tf.float32) / 6., length_penalty)
+
+    # Prefill the prompts once, then copy their states to each beam
+    initial_position = mtf.reduce_sum(mtf.to_int32(mtf.not_equal(inputs, padding_id)), reduced_dim=length_dim)
+    if prefill_chunk_size:
+        prompt_states = prefill_in_chunks(inputs, other_features, params, initial_position, prefill_chunk_size,
+                                          variable_dtype)
+    else:
+        context_first_part = mtf_transformer.transformer.Context(
+            model=None,
+            mesh=mesh,
+            batch_dims=[batch_dim],
+            length_dim=length_dim,
+            variable_dtype=variable_dtype,
+            mode="first_part",
+            position=mtf.range(mesh, length_dim, tf.int32),
+            position_is_default=True,
+            new_states=[],
+            initial_position=initial_position,
+            inputs=inputs)
+        with tf.variable_scope("gpt2", reuse=tf.AUTO_REUSE):
+            gpt2.model({"inputs": inputs}, other_features, params, mesh, variable_dtype=variable_dtype,
+                       context=context_first_part)
+        prompt_states = context_first_part.new_states
+
+    start_position = expand(initial_position)
+    beam_index = mtf.mod(mtf.range(mesh, flat_batch_dim, tf.int32), beam_size)
+
+    def is_done(position):
+        done = mtf.greater_equal(position, length_dim.size)
+        if max_steps:
+            done = mtf.logical_or(done, mtf.greater_equal(position - start_position, max_steps))
+        return done
+
+    def cond_fn(position, ids, scores, finished, *unused_states):
+        return mtf.reduce_any(mtf.logical_not(finished))
+
+    def body_fn(position, ids, scores, finished, *states):
+        context = mtf_transformer.transformer.Context(
+            model=None,
+            mesh=mesh,
+            batch_dims=[flat_batch_dim],
+            length_dim=length_dim,
+            variable_dtype=variable_dtype,
             mode="incremental",
             position=position,
             position_is_default=True,
             states=states,
             new_states=[],
             initial_position=position,
-            sequence_id=None,
-            encoder_output=encoder_output,
-            encoder_sequence_id=encoder_sequence_id,
-            shared_params=shared_params,
-            encoder_layer_outputs=encoder_layer_outputs,
-            write_priority=write_priority,
-            read_priority=read_priority,
-            inputs=ids,
-            encoder_inputs=encoder_inputs) if not slow_sampling else None
-
+            inputs=ids)
         with tf.variable_scope("gpt2", reuse=tf.AUTO_REUSE):
-            logits, _, _ = gpt2.model({"inputs": ids}, other_features, params, inputs.mesh, variable_dtype=variable_dtype, context = context)
-
-        if not sampling_use_entmax:
-            # By default, do top_k sampling of 0.9
-            if sampling_keep_top_k == -2:
-                sampling_keep_top_k = int(logits.shape[-1].size * 0.1)
-
-            if sampling_keep_top_k != -1:
-                if sampling_keep_top_k <= 0:
-                    raise ValueError("sampling_keep_top_k must either be -1 or positive.")
-                k_largest = mtf.nth_largest_element(
-                    logits, n=sampling_keep_top_k,
-                    reduced_dim=other_features["vocab_dim"])
-                logits = mtf.where(mtf.less_equal(logits, k_largest),
-                                   mtf.ones_like(logits) * -1e6, logits)
-
-            ids_this_step = mtf.sample_with_temperature(
-                logits, other_features["vocab_dim"], temperature)
-        else:
-            ids_this_step = sample_categorical(entmax(logits))
+            logits, _, _ = gpt2.model({"inputs": ids}, other_features, params, mesh, variable_dtype=variable_dtype,
+                                      context=context)
+        logits = mtf.cast(mtf.reshape(logits, [flat_batch_dim, vocab_dim]), tf.float32)
+        log_probs = logits - mtf.reduce_logsumexp(logits, reduced_dim=vocab_dim)
 
-        if slow_sampling:
-            ids_this_step = mtf.shift(ids_this_step, offset=1, dim=length_dim, wrap=False)
-        else:
-            ids_this_step = mtf.reshape(ids_this_step, (batch_dims))
-
-        one_hot = mtf.one_hot(position, length_dim, dtype=tf.int32)
-        one_new_id = ids_this_step * one_hot
-        new_ids = (1 - one_hot) * ids + one_new_id
-        new_position = position + 1
-
-        ret = [new_position, new_ids]
-        if context is not None:
-            ret += context.new_states
-        return ret
-
-    while_loop_inputs = [initial_position, inputs] + initial_states
-    final_position, outputs = mtf.while_loop(
-        cond_fn, body_fn, while_loop_inputs)[:2]
-    del final_position
-    if has_partial_sequences and remove_partial_sequences:
-        # Remove partial sequences from outputs
-        partial_length = mtf.reduce_sum(
-            mtf.to_int32(mtf.not_equal(partial_sequences, padding_id)),
-            reduced_dim=length_dim)
-        outputs = mtf.dynamic_shift(
-            outputs, -partial_length, length_dim, wrap=False)
+        # A finished beam only continues as itself, with padding and the same score
+        finished_log_probs = mtf.cast(mtf.not_equal(mtf.range(mesh, vocab_dim, tf.int32), padding_id), tf.float32) * -1e9
+        log_probs = mtf.where(finished, finished_log_probs, log_probs, output_shape=log_probs.shape)
+        length = position - start_position + 1 - mtf.to_int32(finished)
+        candidate_scores = scores + log_probs
+
+        # Each beam's best continuations, then the best of those for each sequence
+        normalized_scores, best_tokens = mtf.top_k(candidate_scores / normalizer(length), reduced_dim=vocab_dim,
+                                                   k_dim=candidates_dim)
+        best_scores = normalized_scores * normalizer(length)
+        normalized_scores, best_scores, best_tokens = [
+            mtf.reshape(t, [batch_dim, choices_dim]) for t in (normalized_scores, best_scores, best_tokens)]
+        _, choice = mtf.top_k(normalized_scores, reduced_dim=choices_dim, k_dim=beam_dim)
+        new_scores, tokens = [flatten(mtf.gather(t, choice, choices_dim)) for t in (best_scores, best_tokens)]
+        parent = flatten(mtf.floordiv(choice, beam_size))
+
+        # Reorder the beams and their attention states by parent, then append the chosen tokens
+        position, ids, finished = [reorder_beams(t, parent, beam_size) for t in (position, ids, finished)]
+        states = [reorder_beams(t, parent, beam_size) for t in context.new_states]
+        running = mtf.to_int32(mtf.logical_not(finished))
+        one_hot = mtf.one_hot(position, length_dim, dtype=tf.int32) * running
+        new_ids = (1 - one_hot) * ids + tokens * one_hot
+        new_position = position + running
+        new_finished = mtf.logical_or(finished, is_done(new_position))
+        if stop_at_token is not None:
+            new_finished = mtf.logical_or(new_finished, mtf.logical_and(mtf.logical_not(finished),
+                                                                        mtf.equal(tokens, stop_at_token)))
+        return [new_position, new_ids, new_scores, new_finished] + states
+
+    # Beams of a sequence start out the same, so only the first one may be continued on the first step
+    initial_scores = mtf.cast(mtf.not_equal(beam_index, 0), tf.float32) * -1e9
+    initial_states = [expand(t) for t in prompt_states]
+    position, ids, scores, finished, *_ = mtf.while_loop(
+        cond_fn, body_fn, [start_position, expand(inputs), initial_scores, is_done(start_position)] + initial_states)
+
+    # Pick the best beam of each sequence
+    final_scores = unflatten(scores / normalizer(position - start_position))
+    best_beam = mtf.argmax(final_scores, beam_dim)
+    outputs = mtf.gather(unflatten(ids), best_beam, beam_dim)
+
+    if remove_partial_sequences:
+        outputs = mtf.dynamic_shift(outputs, -initial_position, length_dim, wrap=False)
     return outputs
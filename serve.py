@@ -0,0 +1,666 @@
+"""Continuous-batching inference server for GPT models on CPU / GPU.
+
+Keeps the model and a fixed number of decoding slots resident in one session. New requests are prefilled into free
+slots while the other slots keep decoding, so requests with different prompt lengths and max_steps share the batch.
+
+Usage:
+    python3 serve.py --model <config_name> --gpu_ids device:GPU:0 --port 8000
+    curl -d '{"prompt": "Hello", "max_steps": 64}' localhost:8000/generate
+"""
+import argparse
+import collections
+import hashlib
+import json
+import logging
+import os
+import queue
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import mesh_tensorflow as mtf
+import numpy as np
+import tensorflow.compat.v1 as tf
+import mesh_tensorflow.transformer as mtf_transformer
+from mesh_tensorflow import placement_mesh_impl
+
+from configs import fetch_model_params
+from data.encoders import fetch_encoder, encode, decode_batch
+from models.gpt2 import gpt2
+from models.utils import biasmask_attn_weights
+from sample import sample_logits, prefill_in_chunks
+from utils import expand_attention_types_params
+
+logger = logging.getLogger(__name__)
+
+
+def _scatter_rows(x, axis, rows, updates):
+    # Replaces x[..., rows, ...] (indexing along axis) with updates
+    perm = [axis] + [i for i in range(len(x.shape)) if i != axis]
+    inverse_perm = np.argsort(perm).tolist()
+    x = tf.tensor_scatter_nd_update(tf.transpose(x, perm), rows[:, None], tf.transpose(updates, perm))
+    return tf.transpose(x, inverse_perm)
+
+
+class InferenceEngine:
+    """
+    A batch of `batch_size` decoding slots for the incremental (kv cached) model.
+
+    The tokens, position and attention states of every slot live in tf Variables, so admitting new sequences
+    (`prefill`) and decoding one more token for every slot (`step`) are separate runs of one lowered graph - a slot can
+    be refilled without disturbing the sequences decoding in the others.
+
+    Free slots are still decoded by `step`, but are clamped at the end of the context and their outputs are ignored.
+    """
+
+    def __init__(self, params, batch_size, prefill_batch_size=1, gpu_ids=("",), checkpoint=None, temperature=0.9,
+                 sampling_keep_top_k=-1, sampling_top_p=None, restore_chunk_size=64):
+        self.params = params
+        self.batch_size = batch_size
+        self.prefill_batch_size = prefill_batch_size
+        self.n_ctx = params["n_ctx"]
+        self.restore_chunk_size = min(restore_chunk_size, self.n_ctx)
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._build(gpu_ids, temperature, sampling_keep_top_k, sampling_top_p)
+            self._session = tf.Session()
+            self._session.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+            if checkpoint is not None:
+                tf.train.Saver(tf.global_variables()).restore(self._session, checkpoint)
+            self._session.run(self._lowering.copy_masters_to_slices())
+
+    def _build(self, gpu_ids, temperature, sampling_keep_top_k, sampling_top_p):
+        params = self.params
+        graph = mtf.Graph()
+        mesh = mtf.Mesh(graph, "my_mesh")
+        mesh_impl = placement_mesh_impl.PlacementMeshImpl(
+            mtf.convert_to_shape(params["mesh_shape"]), mtf.convert_to_layout_rules(params["layout"]), list(gpu_ids))
+
+        if params["precision"] == "bfloat16":
+            variable_dtype = mtf.VariableDType(master_dtype=tf.bfloat16, slice_dtype=tf.float32,
+                                               activation_dtype=tf.bfloat16)
+        else:
+            variable_dtype = mtf.VariableDType(master_dtype=tf.float32, slice_dtype=tf.float32,
+                                               activation_dtype=tf.float32)
+
+        length_dim = mtf.Dimension("sequence", self.n_ctx)
+        memory_length_dim = mtf.Dimension("memory_length", self.n_ctx)
+        other_features = {
+            "attn_bias": biasmask_attn_weights(mesh, length_dim, memory_length_dim, variable_dtype),
+            "embd_dim": mtf.Dimension("embd", params["n_embd"]),
+            "vocab_dim": mtf.Dimension("vocab", params["n_vocab"]),
+            "embed_sequence_dim": mtf.Dimension("embed_sequence", self.n_ctx),
+            "memory_length_dim": memory_length_dim
+        }
+
+        def _context(batch_dim, mode, inputs, **kwargs):
+            return mtf_transformer.transformer.Context(
+                model=None, mesh=mesh, batch_dims=[batch_dim], length_dim=length_dim, variable_dtype=variable_dtype,
+                mode=mode, position_is_default=True, new_states=[], sequence_id=None, inputs=inputs, **kwargs)
+
+        # Prefill - records the attention states of prefill_batch_size prompts
+        prefill_batch_dim = mtf.Dimension("batch", self.prefill_batch_size)
+        self._prefill_tokens = tf.placeholder(tf.int32, [self.prefill_batch_size, self.n_ctx])
+        self._prefill_lengths = tf.placeholder(tf.int32, [self.prefill_batch_size])
+        self._prefill_slots = tf.placeholder(tf.int32, [self.prefill_batch_size])
+        prefill_inputs = mtf.import_tf_tensor(mesh, self._prefill_tokens, mtf.Shape([prefill_batch_dim, length_dim]))
+        prefill_lengths = mtf.import_tf_tensor(mesh, self._prefill_lengths, mtf.Shape([prefill_batch_dim]))
+        context = _context(prefill_batch_dim, "first_part", prefill_inputs,
+                           position=mtf.range(mesh, length_dim, tf.int32), initial_position=prefill_lengths)
+        with tf.variable_scope("gpt2"):
+            gpt2.model({"inputs": prefill_inputs}, other_features, params, mesh, variable_dtype=variable_dtype,
+                       context=context)
+        prefill_states = context.new_states
+
+        # Per-slot state, carried between steps
+        def _slot_variable(shape, dtype):
+            return tf.Variable(tf.zeros(shape, dtype), trainable=False, use_resource=True,
+                               collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+        batch_dim = mtf.Dimension("batch", self.batch_size)
+        state_shapes = [mtf.Shape([batch_dim if d == prefill_batch_dim else d for d in s.shape.dims])
+                        for s in prefill_states]
+        tokens_var = _slot_variable([self.batch_size, self.n_ctx], tf.int32)
+        position_var = _slot_variable([self.batch_size], tf.int32)
+        state_vars = [_slot_variable(shape.to_integer_list, s.dtype) for s, shape in zip(prefill_states, state_shapes)]
+        batch_axes = [shape.dims.index(batch_dim) for shape in state_shapes]
+        # Axis of the per-slot states that is indexed by position, if any (the key / value caches of global attention)
+        self.state_sequence_axes = [
+            [d.name for d in shape.dims if d != batch_dim].index(length_dim.name) if length_dim in shape.dims
+            else None for shape in state_shapes]
+
+        # Step - one incremental decoding step for every slot
+        tokens = mtf.import_tf_tensor(mesh, tokens_var.read_value(), mtf.Shape([batch_dim, length_dim]))
+        position = mtf.import_tf_tensor(mesh, position_var.read_value(), mtf.Shape([batch_dim]))
+        states = [mtf.import_tf_tensor(mesh, v.read_value(), shape) for v, shape in zip(state_vars, state_shapes)]
+        context = _context(batch_dim, "incremental", tokens, position=position, initial_position=position,
+                           states=states)
+        with tf.variable_scope("gpt2", reuse=tf.AUTO_REUSE):
+            logits, _, _ = gpt2.model({"inputs": tokens}, other_features, params, mesh, variable_dtype=variable_dtype,
+                                      context=context)
+        ids = sample_logits(logits, other_features["vocab_dim"], temperature=temperature,
+                            sampling_keep_top_k=sampling_keep_top_k,
+                            sampling_use_entmax=params.get("sampling_use_entmax", False),
+                            sampling_top_p=sampling_top_p)
+        ids = mtf.reshape(ids, [batch_dim])
+
+        # Suffix prefill - prefills the rest of restored prompts from the states of their cached prefix, a chunk of
+        # restore_chunk_size positions at a time
+        self._prefill_starts = tf.placeholder(tf.int32, [self.prefill_batch_size])
+        prefill_starts = mtf.import_tf_tensor(mesh, self._prefill_starts, mtf.Shape([prefill_batch_dim]))
+        restored_states = [mtf.import_tf_tensor(mesh, tf.gather(v.read_value(), self._prefill_slots, axis=axis),
+                                                s.shape)
+                           for v, s, axis in zip(state_vars, prefill_states, batch_axes)]
+        suffix_states = prefill_in_chunks(prefill_inputs, other_features, params, prefill_lengths,
+                                          self.restore_chunk_size, variable_dtype, states=restored_states,
+                                          start_position=prefill_starts)
+
+        self._lowering = mtf.Lowering(graph, {mesh: mesh_impl}, autostack=True)
+        export = self._lowering.export_to_tf_tensor
+
+        slots = self._prefill_slots
+        prefill_updates = [tokens_var.assign(tf.tensor_scatter_nd_update(tokens_var, slots[:, None],
+                                                                         self._prefill_tokens)),
+                           position_var.assign(tf.tensor_scatter_nd_update(position_var, slots[:, None],
+                                                                           self._prefill_lengths))]
+        suffix_updates = list(prefill_updates)
+        for v, state, suffix_state, axis in zip(state_vars, prefill_states, suffix_states, batch_axes):
+            prefill_updates.append(v.assign(_scatter_rows(v, axis, slots, export(state))))
+            suffix_updates.append(v.assign(_scatter_rows(v, axis, slots, export(suffix_state))))
+        self._prefill_op = tf.group(prefill_updates)
+        self._suffix_prefill_op = tf.group(suffix_updates)
+
+        # Reading and restoring the states of one slot, for prefix caching
+        self._slot = tf.placeholder(tf.int32, [])
+        self._read_slot = [tf.gather(v, self._slot, axis=axis) for v, axis in zip(state_vars, batch_axes)]
+
+        self._restore_states = []
+        restore_updates = []
+        for v, axis, sequence_axis, row in zip(state_vars, batch_axes, self.state_sequence_axes, self._read_slot):
+            shape = row.shape.as_list()
+            if sequence_axis is not None:
+                shape[sequence_axis] = None
+            state = tf.placeholder(v.dtype, shape)
+            self._restore_states.append(state)
+            if sequence_axis is not None:
+                # Positions past the prefix are masked until they are written
+                padding = [[0, 0]] * len(shape)
+                padding[sequence_axis] = [0, self.n_ctx - tf.shape(state)[sequence_axis]]
+                state = tf.pad(state, padding)
+            restore_updates.append(v.assign(_scatter_rows(v, axis, self._slot[None], tf.expand_dims(state, axis))))
+        self._restore_op = tf.group(restore_updates)
+
+        ids = export(ids)
+        step_position = position_var.read_value()
+        one_hot = tf.one_hot(step_position, self.n_ctx, dtype=tf.int32)
+        new_tokens = tokens_var.read_value() * (1 - one_hot) + ids[:, None] * one_hot
+        new_states = [export(s) for s in context.new_states]
+        with tf.control_dependencies([ids, new_tokens] + new_states):
+            step_updates = [tokens_var.assign(new_tokens),
+                            position_var.assign(tf.minimum(step_position + 1, self.n_ctx))]
+            step_updates += [v.assign(s) for v, s in zip(state_vars, new_states)]
+        with tf.control_dependencies(step_updates):
+            self._step_ids = tf.identity(ids)
+
+    def prefill(self, slots, prompts):
+        """
+        Starts decoding each prompt (a list of at most n_ctx - 1 token ids) in the matching slot.
+
+        Up to prefill_batch_size prompts are prefilled per run; shorter groups are padded by repeating the last prompt.
+        """
+        self._run_prefill(self._prefill_op, slots, prompts)
+
+    def _run_prefill(self, op, slots, prompts, starts=None):
+        # Runs op for groups of prefill_batch_size prompts
+        starts = starts if starts is not None else [0] * len(slots)
+        for start in range(0, len(slots), self.prefill_batch_size):
+            group = list(zip(slots, prompts, starts))[start:start + self.prefill_batch_size]
+            group += group[-1:] * (self.prefill_batch_size - len(group))
+            tokens = np.zeros([self.prefill_batch_size, self.n_ctx], dtype=np.int32)
+            for i, (_, prompt, _) in enumerate(group):
+                tokens[i, :len(prompt)] = prompt
+            feed_dict = {self._prefill_tokens: tokens,
+                         self._prefill_lengths: [len(prompt) for _, prompt, _ in group],
+                         self._prefill_slots: [slot for slot, _, _ in group]}
+            if op is self._suffix_prefill_op:
+                feed_dict[self._prefill_starts] = [prefix_start for _, _, prefix_start in group]
+            self._session.run(op, feed_dict=feed_dict)
+
+    def read_states(self, slot):
+        """:return: list of numpy arrays, the attention states of slot"""
+        return self._session.run(self._read_slot, feed_dict={self._slot: slot})
+
+    def restore(self, slots, prompts, prefix_lengths, states):
+        """
+        Starts decoding each prompt in the matching slot from the states of its first prefix_length tokens, as
+        returned by read_states and cut to prefix_length along their state_sequence_axes.
+
+        The rest of each prompt is then prefilled like `prefill` does, restore_chunk_size positions per pass.
+        """
+        for slot, slot_states in zip(slots, states):
+            feed_dict = {self._slot: slot}
+            feed_dict.update(zip(self._restore_states, slot_states))
+            self._session.run(self._restore_op, feed_dict=feed_dict)
+        self._run_prefill(self._suffix_prefill_op, slots, prompts, prefix_lengths)
+
+    def step(self):
+        """Decodes one token for every slot. :return: int array of shape [batch_size]"""
+        return self._session.run(self._step_ids)
+
+
+class PrefixCache:
+    """
+    LRU cache of the attention states of prompt prefixes, so prompts sharing a prefix (i.e a long instruction preamble)
+    only have to process the rest of the prompt.
+
+    Prefixes are cut at multiples of `block_size` tokens and keyed by a hash of their token ids. One entry holds the
+    states of a whole prefix, and is also found through the keys of each of its shorter block-aligned prefixes. The
+    least recently used entries are evicted to keep the total size under `max_bytes`.
+    """
+
+    def __init__(self, max_bytes, block_size=64):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.bytes = 0
+        self.lookups = 0
+        self.hits = 0
+        self.tokens_saved = 0
+        self.bytes_saved = 0
+        self._entries = collections.OrderedDict()  # entry id -> (keys, states, length, nbytes)
+        self._index = {}  # prefix hash -> entry id
+        self._next_id = 0
+
+    def _prefix_hashes(self, tokens, max_length):
+        # Yields (length, hash) of each block-aligned prefix of tokens up to max_length
+        h = hashlib.sha1()
+        for end in range(self.block_size, max_length + 1, self.block_size):
+            h.update(np.asarray(tokens[end - self.block_size:end], dtype=np.int32).tobytes())
+            yield end, h.hexdigest()
+
+    def prefix_length(self, tokens):
+        # Longest block-aligned prefix that leaves at least one token of the prompt to process
+        return (len(tokens) - 1) // self.block_size * self.block_size
+
+    def lookup(self, tokens, sequence_axes):
+        """
+        :return: (prefix length, states cut to that length) of the longest cached prefix of tokens, or (0, None)
+        """
+        self.lookups += 1
+        for length, key in reversed(list(self._prefix_hashes(tokens, self.prefix_length(tokens)))):
+            if key in self._index:
+                entry_id = self._index[key]
+                self._entries.move_to_end(entry_id)
+                states = self._entries[entry_id][1]
+                self.hits += 1
+                self.tokens_saved += length
+                self.bytes_saved += sum(s.nbytes * length // s.shape[axis]
+                                        for s, axis in zip(states, sequence_axes))
+                return length, [_cut(s, axis, length) for s, axis in zip(states, sequence_axes)]
+        return 0, None
+
+    def insert(self, tokens, states, sequence_axes):
+        """Caches the states of a prompt (as returned by InferenceEngine.read_states) under its prefixes."""
+        length = self.prefix_length(tokens)
+        if length == 0:
+            return
+        states = [_cut(s, axis, length).copy() for s, axis in zip(states, sequence_axes)]
+        nbytes = sum(s.nbytes for s in states)
+        if nbytes > self.max_bytes:
+            return
+
+        entry_id = self._next_id
+        self._next_id += 1
+        keys = [key for _, key in self._prefix_hashes(tokens, length)]
+        for key in keys:
+            self._index[key] = entry_id
+        self._entries[entry_id] = (keys, states, length, nbytes)
+        self.bytes += nbytes
+
+        while self.bytes > self.max_bytes:
+            evicted_id, (evicted_keys, _, _, evicted_bytes) = self._entries.popitem(last=False)
+            for key in evicted_keys:
+                if self._index.get(key) == evicted_id:
+                    del self._index[key]
+            self.bytes -= evicted_bytes
+
+    def stats(self):
+        return {"lookups": self.lookups, "hits": self.hits, "hit_rate": self.hits / max(self.lookups, 1),
+                "tokens_saved": self.tokens_saved, "bytes_saved": self.bytes_saved, "bytes": self.bytes,
+                "entries": len(self._entries)}
+
+
+def _cut(state, axis, length):
+    # First length positions of a state along its sequence axis
+    return state[(slice(None),) * axis + (slice(0, length),)]
+
+
+class GenerationRequest:
+    def __init__(self, tokens, max_steps):
+        self.tokens = tokens
+        self.max_steps = max_steps
+        self.completion = []
+        self.position = len(tokens)
+        self.error = None
+        self.cancelled = False
+        self._done = threading.Event()
+        self._stream = queue.Queue()
+
+    def append(self, token):
+        self.completion.append(token)
+        self._stream.put(token)
+
+    def cancel(self):
+        """Stops generating, i.e when the client has gone away. The completion so far is kept."""
+        self.cancelled = True
+
+    def finish(self, error=None):
+        self.error = error
+        self._done.set()
+        self._stream.put(None)
+
+    def stream(self, timeout=None):
+        """Yields each completion token id as soon as it is sampled. Can only be consumed once."""
+        while True:
+            try:
+                token = self._stream.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError("No token was generated in time")
+            if token is None:
+                break
+            yield token
+        if self.error is not None:
+            raise self.error
+
+    def stream_text(self, encoder, timeout=None):
+        """
+        Yields the completion as text deltas, as its tokens are sampled. Tokens that end partway through a multi-byte
+        character are held back until the character is complete.
+        """
+        tokens, text = [], ""
+        for token in self.stream(timeout):
+            tokens.append(token)
+            decoded = decode_batch(encoder, [tokens])[0]
+            if decoded.endswith("\ufffd") or decoded == text:
+                continue
+            yield decoded[len(text):]
+            text = decoded
+
+    def result(self, timeout=None):
+        """Blocks until the request is finished. :return: list of completion token ids"""
+        if not self._done.wait(timeout):
+            raise TimeoutError("Generation did not finish in time")
+        if self.error is not None:
+            raise self.error
+        return self.completion
+
+
+class ContinuousBatcher:
+    """
+    Schedules requests onto the slots of an InferenceEngine from a background thread.
+
+    Between steps, waiting requests are admitted into free slots, so a slot freed by a finished sequence is reused
+    straight away instead of waiting for the whole batch to finish. A sequence finishes when it samples `eos_id`,
+    reaches its max_steps, or reaches the end of the context.
+
+    With a PrefixCache, prompts with a cached prefix are restored from it, and only the rest of the prompt is
+    prefilled.
+    """
+
+    def __init__(self, engine, eos_id, prefix_cache=None):
+        if prefix_cache is not None and None in engine.state_sequence_axes:
+            raise ValueError("Prefix caching needs position-indexed key / value caches - it is only supported for "
+                             "models with only global attention layers")
+        self.engine = engine
+        self.eos_id = eos_id
+        self.prefix_cache = prefix_cache
+        self._queue = queue.Queue()
+        self._waiting = collections.deque()
+        self._slots = [None] * engine.batch_size
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, tokens, max_steps):
+        """Queues a prompt for generation. :return: a GenerationRequest"""
+        if self._error is not None:
+            raise self._error
+        if len(tokens) == 0:
+            raise ValueError("Prompt must contain at least one token")
+        # Leave room for at least one generated token
+        request = GenerationRequest(tokens[-(self.engine.n_ctx - 1):], max_steps)
+        self._queue.put(request)
+        return request
+
+    def _admit(self):
+        # Block for new requests only if nothing is decoding
+        if all(request is None for request in self._slots) and not self._waiting:
+            self._waiting.append(self._queue.get())
+        while True:
+            try:
+                self._waiting.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        free = [slot for slot, request in enumerate(self._slots) if request is None]
+        admitted = []
+        while free and self._waiting:
+            request = self._waiting.popleft()
+            if request.max_steps <= 0 or request.cancelled:
+                request.finish()
+                continue
+            slot = free.pop(0)
+            self._slots[slot] = request
+            admitted.append((slot, request))
+
+        sequence_axes = self.engine.state_sequence_axes
+        if self.prefix_cache is not None:
+            to_prefill, to_restore = [], []
+            for slot, request in admitted:
+                prefix_length, states = self.prefix_cache.lookup(request.tokens, sequence_axes)
+                if prefix_length > 0:
+                    to_restore.append((slot, request, prefix_length, states))
+                else:
+                    to_prefill.append((slot, request))
+            if to_restore:
+                slots, requests, prefix_lengths, states = zip(*to_restore)
+                self.engine.restore(slots, [request.tokens for request in requests], prefix_lengths, states)
+            admitted = to_prefill
+
+        if admitted:
+            self.engine.prefill([slot for slot, _ in admitted], [request.tokens for _, request in admitted])
+            if self.prefix_cache is not None:
+                for slot, request in admitted:
+                    self.prefix_cache.insert(request.tokens, self.engine.read_states(slot), sequence_axes)
+
+    def _update(self, ids):
+        for slot, request in enumerate(self._slots):
+            if request is None:
+                continue
+            request.position += 1
+            if request.cancelled:
+                self._slots[slot] = None
+                request.finish()
+                continue
+            token = int(ids[slot])
+            if token == self.eos_id:
+                done = True
+            else:
+                request.append(token)
+                done = len(request.completion) >= request.max_steps or request.position >= self.engine.n_ctx
+            if done:
+                self._slots[slot] = None
+                request.finish()
+
+    def stats(self):
+        stats = {"active": sum(request is not None for request in self._slots),
+                 "waiting": len(self._waiting) + self._queue.qsize()}
+        if self.prefix_cache is not None:
+            stats["prefix_cache"] = self.prefix_cache.stats()
+        return stats
+
+    def _run(self):
+        try:
+            while True:
+                self._admit()
+                if any(request is not None for request in self._slots):
+                    self._update(self.engine.step())
+        except Exception as e:
+            logger.exception("Inference loop failed")
+            self._error = e
+            pending = [r for r in self._slots if r is not None] + list(self._waiting)
+            while not self._queue.empty():
+                pending.append(self._queue.get_nowait())
+            for request in pending:
+                request.finish(e)
+
+
+class GenerateHandler(BaseHTTPRequestHandler):
+    """
+    POST /generate with {"prompt": str, "max_steps": int} -> {"completion": str, ...}
+    POST /generate with {"prompt": str, "max_steps": int, "stream": true} -> one {"text": str} json line per new
+    piece of text, followed by a {"completion_tokens": int} line
+    GET /stats -> batch occupancy and prefix cache counters
+    """
+
+    def do_GET(self):
+        if self.path != "/stats":
+            return self._respond(404, {"error": f"Unknown path {self.path}"})
+        self._respond(200, self.server.batcher.stats())
+
+    def do_POST(self):
+        if self.path != "/generate":
+            return self._respond(404, {"error": f"Unknown path {self.path}"})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            prompt = body["prompt"]
+            max_steps = int(body.get("max_steps", self.server.max_steps))
+            tokens = encode(self.server.encoder, prompt)
+            request = self.server.batcher.submit(tokens, max_steps)
+        except KeyError as e:
+            return self._respond(400, {"error": f"Missing field {e}"})
+        except (ValueError, TypeError) as e:
+            return self._respond(400, {"error": str(e)})
+
+        if body.get("stream", False):
+            return self._stream(request)
+
+        try:
+            completion = request.result()
+        except Exception as e:
+            return self._respond(500, {"error": str(e)})
+        self._respond(200, {"completion": decode_batch(self.server.encoder, [completion])[0],
+                            "prompt_tokens": len(request.tokens),
+                            "completion_tokens": len(completion)})
+
+    def _stream(self, request):
+        # HTTP/1.0 - the body ends when the connection is closed
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            try:
+                for delta in request.stream_text(self.server.encoder):
+                    self._write_line({"text": delta})
+            except (BrokenPipeError, ConnectionResetError):
+                raise
+            except Exception as e:
+                return self._write_line({"error": str(e)})
+            self._write_line({"prompt_tokens": len(request.tokens), "completion_tokens": len(request.completion)})
+        except (BrokenPipeError, ConnectionResetError):
+            request.cancel()
+
+    def _write_line(self, body):
+        self.wfile.write((json.dumps(body) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def _respond(self, code, body):
+        body = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is python 3.7+
+    daemon_threads = True
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default=None, help="JSON file that contains model parameters.")
+    parser.add_argument("--gpu_ids", nargs="+", type=str, default=["device:GPU:0"],
+                        help="Devices to run on, i.e 'device:GPU:0 device:GPU:1'. Pass '' to run on CPU.")
+    parser.add_argument("--checkpoint", type=str, default=None,
+                        help="Checkpoint to serve. Defaults to the latest checkpoint in the model_path.")
+    parser.add_argument("--batch_size", type=int, default=8, help="Number of sequences decoded together.")
+    parser.add_argument("--prefill_batch_size", type=int, default=1,
+                        help="Number of waiting prompts prefilled together when slots free up.")
+    parser.add_argument("--prefix_cache_bytes", type=int, default=0,
+                        help="Memory budget of the cache of prompt prefix attention states. 0 disables the cache.")
+    parser.add_argument("--prefix_cache_block_size", type=int, default=64,
+                        help="Prompt prefixes are cached at multiples of this many tokens.")
+    parser.add_argument("--restore_chunk_size", type=int, default=64,
+                        help="Positions per pass when prefilling the rest of a prompt with a cached prefix.")
+    parser.add_argument("--max_steps", type=int, default=None,
+                        help="Default number of tokens to generate per request. Defaults to predict_max_steps.")
+    parser.add_argument("--temperature", type=float, default=0.9)
+    parser.add_argument("--top_k", type=int, default=-1, help="If set, only sample from the k most likely tokens.")
+    parser.add_argument("--top_p", type=float, default=None,
+                        help="If set, only sample from the most likely tokens whose probability adds up to p.")
+    parser.add_argument("--entmax_sampling", action="store_true", help="(experimental) use entmax sampling")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--socket", type=str, default=None, help="If set, listen on this unix socket instead.")
+    args = parser.parse_args()
+    assert args.model is not None, "Model must be set"
+    return args
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO)
+    tf.disable_v2_behavior()
+
+    params = fetch_model_params(args.model)
+    params["attention_types"] = expand_attention_types_params(params["attention_types"])
+    params["mode"] = "predict"
+    params["sampling_use_entmax"] = args.entmax_sampling
+
+    checkpoint = args.checkpoint or tf.train.latest_checkpoint(params["model_path"])
+    logger.info(f"Loading {checkpoint}")
+    engine = InferenceEngine(params, args.batch_size, prefill_batch_size=args.prefill_batch_size,
+                             gpu_ids=args.gpu_ids, checkpoint=checkpoint, temperature=args.temperature,
+                             sampling_keep_top_k=args.top_k, sampling_top_p=args.top_p,
+                             restore_chunk_size=args.restore_chunk_size)
+
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, GenerateHandler)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), GenerateHandler)
+    prefix_cache = PrefixCache(args.prefix_cache_bytes, args.prefix_cache_block_size) \
+        if args.prefix_cache_bytes > 0 else None
+    server.batcher = ContinuousBatcher(engine, params["eos_id"], prefix_cache=prefix_cache)
+    server.encoder = fetch_encoder(params)
+    server.max_steps = args.max_steps or params.get("predict_max_steps") or params["n_ctx"]
+
+    logger.info(f"Serving on {args.socket or f'{args.host}:{args.port}'}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -1,19 +1,39 @@
 import pytest
 import traceback
 import logging
+import json
+import itertools
+import collections
+import os
+import shutil
+import threading
+import time
 from collections import defaultdict
 from contextlib import contextmanager
 
+import numpy as np
 import tensorflow as tf
 tf.compat.v1.enable_eager_execution()
 import mesh_tensorflow as mtf
+import mesh_tensorflow.transformer as mtf_transformer
 from mesh_tensorflow import placement_mesh_impl
 
-from inputs import mlm_sample_text
+from inputs import mlm_sample_text, get_prediction_length, batch_prompts, handle_prompts_pred_output, \
+    PredictionWriter, sequential_input, text_dataset, FlatTokenShards, flat_input
 from models.gpt2 import gpt2
+from models.layers import blockwise_attention
 from models.utils import biasmask_attn_weights, entmax, sample_categorical
 
-from sample import sample_autoregressive
+from sample import sample_autoregressive, sample_logits, prefill_in_chunks, speculative_sample_autoregressive, beam_search_autoregressive
+from serve import InferenceEngine, ContinuousBatcher, PrefixCache, GenerationRequest
+from data.create_tfrecords import parse_args, archive_to_tokens, split_list, get_files, schedule_files, \
+    create_tfrecords, create_tfrecords_mp
+from utils import natural_sort
+
+from lm_dataformat import Archive
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
 
 # helper functions
 
@@ -135,6 +155,505 @@ def test_sampling():
         lowering = mtf.Lowering(graph, {mesh: mesh_impl})
         samples = lowering.export_to_tf_tensor(samples)
 
+@pytest.mark.parametrize("stop_at_token", [None, 3])
+def test_sampling_compact_batch(stop_at_token):
+    sample_params = defaultdict(lambda: None, {
+        "n_head": 2,
+        "n_ctx": 8,
+        "n_embd": 8,
+        "n_vocab": 8,
+        "embed_dropout": 0.,
+        "n_layer": 2,
+        "num_microbatches": 1,
+        "causal": True,
+        "attention_types": ["global", "local"],
+        "res_dropout": 0.,
+        "attn_dropout": 0.,
+        "activation_function": "gelu",
+        "mesh_shape": [],
+        "layout": {},
+        "local_attention_radius": 4,
+        "mode": "predict"
+    })
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    variable_dtype = mtf.VariableDType(tf.float32, tf.float32, tf.float32)
+
+    batch_dim = mtf.Dimension("batch", 4)
+    length_dim = mtf.Dimension("sequence", sample_params["n_ctx"])
+    memory_length_dim = mtf.Dimension("memory_length", sample_params["n_ctx"])
+    other_features = {
+        "attn_bias": biasmask_attn_weights(mesh, length_dim, memory_length_dim, variable_dtype),
+        "embd_dim": mtf.Dimension("embd", sample_params["n_embd"]),
+        "vocab_dim": mtf.Dimension("vocab", sample_params["n_vocab"]),
+        "embed_sequence_dim": mtf.Dimension("embed_sequence", sample_params["n_ctx"]),
+        "memory_length_dim": memory_length_dim
+    }
+
+    # sequences finish at different steps as their prompts have different lengths
+    prompts = np.array([[1, 0, 0, 0, 0, 0, 0, 0],
+                        [4, 2, 0, 0, 0, 0, 0, 0],
+                        [5, 6, 7, 1, 2, 0, 0, 0],
+                        [2, 4, 6, 1, 5, 7, 0, 0]], dtype=np.int32)
+    inputs = mtf.import_tf_tensor(mesh, tf.constant(prompts), mtf.Shape([batch_dim, length_dim]))
+
+    samples = []
+    for compact_batch in [False, True]:
+        with tf.compat.v1.variable_scope("", reuse=tf.compat.v1.AUTO_REUSE):
+            samples.append(sample_autoregressive(
+                inputs, other_features=other_features, params=sample_params, variable_dtype=variable_dtype,
+                temperature=0.0, stop_at_token=stop_at_token, compact_batch=compact_batch))
+
+    mesh_impl = placement_mesh_impl.PlacementMeshImpl(shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    samples, compacted_samples = [lowering.export_to_tf_tensor(s).numpy() for s in samples]
+
+    assert (samples[prompts != 0] == prompts[prompts != 0]).all()
+    assert (samples == compacted_samples).all()
+
+def speculative_sampling_setup(batch_size, n_ctx, n_vocab):
+    sample_params = defaultdict(lambda: None, {
+        "n_head": 2,
+        "n_ctx": n_ctx,
+        "n_embd": 8,
+        "n_vocab": n_vocab,
+        "embed_dropout": 0.,
+        "n_layer": 2,
+        "num_microbatches": 1,
+        "causal": True,
+        "attention_types": ["global", "global"],
+        "res_dropout": 0.,
+        "attn_dropout": 0.,
+        "activation_function": "gelu",
+        "mesh_shape": [],
+        "layout": {},
+        "rotary_emb": True,
+        "mode": "predict"
+    })
+    draft_params = defaultdict(lambda: None, dict(sample_params, n_embd=4, n_layer=1, attention_types=["global"]))
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    variable_dtype = mtf.VariableDType(tf.float32, tf.float32, tf.float32)
+
+    batch_dim = mtf.Dimension("batch", batch_size)
+    length_dim = mtf.Dimension("sequence", sample_params["n_ctx"])
+    memory_length_dim = mtf.Dimension("memory_length", sample_params["n_ctx"])
+    other_features = {
+        "attn_bias": biasmask_attn_weights(mesh, length_dim, memory_length_dim, variable_dtype),
+        "embd_dim": mtf.Dimension("embd", sample_params["n_embd"]),
+        "vocab_dim": mtf.Dimension("vocab", sample_params["n_vocab"]),
+        "embed_sequence_dim": mtf.Dimension("embed_sequence", sample_params["n_ctx"]),
+        "memory_length_dim": memory_length_dim
+    }
+    draft_other_features = dict(other_features, embd_dim=mtf.Dimension("embd", draft_params["n_embd"]))
+    return (sample_params, draft_params, graph, mesh, variable_dtype, other_features, draft_other_features,
+            mtf.Shape([batch_dim, length_dim]))
+
+
+@pytest.mark.parametrize("temperature,stop_at_token,max_steps", [(0.0, None, None), (0.0, 3, 4), (0.9, None, None)])
+def test_speculative_sampling(temperature, stop_at_token, max_steps):
+    sample_params, draft_params, graph, mesh, variable_dtype, other_features, draft_other_features, shape = \
+        speculative_sampling_setup(batch_size=3, n_ctx=12, n_vocab=8)
+
+    prompts = np.zeros([3, sample_params["n_ctx"]], dtype=np.int32)
+    prompts[0, :1] = [1]
+    prompts[1, :3] = [4, 2, 5]
+    prompts[2, :6] = [5, 6, 7, 1, 2, 4]
+    inputs = mtf.import_tf_tensor(mesh, tf.constant(prompts), shape)
+
+    with tf.compat.v1.variable_scope("", reuse=tf.compat.v1.AUTO_REUSE):
+        samples = [speculative_sample_autoregressive(
+            inputs, other_features, sample_params, draft_other_features, draft_params, temperature=temperature,
+            stop_at_token=stop_at_token, max_steps=max_steps, num_speculative_tokens=3,
+            variable_dtype=variable_dtype)]
+        if temperature == 0.0:
+            samples.append(sample_autoregressive(
+                inputs, other_features=other_features, params=sample_params, variable_dtype=variable_dtype,
+                temperature=0.0, stop_at_token=stop_at_token, max_steps=max_steps))
+
+    mesh_impl = placement_mesh_impl.PlacementMeshImpl(shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    samples = [lowering.export_to_tf_tensor(s).numpy() for s in samples]
+
+    assert (samples[0][prompts != 0] == prompts[prompts != 0]).all()
+    if temperature == 0.0:
+        # Greedy speculative decoding gives exactly the model's own greedy samples
+        assert (samples[0] == samples[1]).all()
+
+def test_speculative_sampling_distribution():
+    # Many copies of one prompt, sampled with a low temperature so the (randomly initialized) model and draft model
+    # have sharp and very different next token distributions
+    tf.random.set_seed(0)
+    n_samples, n_vocab, max_steps = 4000, 4, 4
+    sample_params, draft_params, graph, mesh, variable_dtype, other_features, draft_other_features, shape = \
+        speculative_sampling_setup(batch_size=n_samples, n_ctx=6, n_vocab=n_vocab)
+    prompts = np.zeros([n_samples, sample_params["n_ctx"]], dtype=np.int32)
+    prompts[:, 0] = 1
+    inputs = mtf.import_tf_tensor(mesh, tf.constant(prompts), shape)
+
+    sampling_kwargs = dict(temperature=0.035, stop_at_token=None, max_steps=max_steps, variable_dtype=variable_dtype)
+    with tf.compat.v1.variable_scope("", reuse=tf.compat.v1.AUTO_REUSE):
+        samples = [speculative_sample_autoregressive(inputs, other_features, sample_params, draft_other_features,
+                                                     draft_params, num_speculative_tokens=2, **sampling_kwargs),
+                   sample_autoregressive(inputs, other_features=other_features, params=sample_params,
+                                         **sampling_kwargs)]
+        with tf.compat.v1.variable_scope("draft"):
+            samples.append(sample_autoregressive(inputs, other_features=draft_other_features, params=draft_params,
+                                                 **sampling_kwargs))
+
+    mesh_impl = placement_mesh_impl.PlacementMeshImpl(shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    speculative, target, draft = [
+        np.stack([np.bincount(s[:, p], minlength=n_vocab) / n_samples for p in range(1, max_steps + 1)])
+        for s in (lowering.export_to_tf_tensor(s).numpy() for s in samples)]
+
+    # the token frequencies at each position follow the model's, not the draft model's
+    assert np.abs(draft - target).max() > 0.2
+    assert np.abs(speculative - target).max() < 0.05
+
+def beam_search_setup(attention_types, n_vocab):
+    sample_params = defaultdict(lambda: None, {
+        "n_head": 2,
+        "n_ctx": 8,
+        "n_embd": 8,
+        "n_vocab": n_vocab,
+        "embed_dropout": 0.,
+        "n_layer": len(attention_types),
+        "num_microbatches": 1,
+        "causal": True,
+        "attention_types": attention_types,
+        "res_dropout": 0.,
+        "attn_dropout": 0.,
+        "activation_function": "gelu",
+        "mesh_shape": [],
+        "layout": {},
+        "local_attention_radius": 4,
+        "mode": "predict"
+    })
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    variable_dtype = mtf.VariableDType(tf.float32, tf.float32, tf.float32)
+    length_dim = mtf.Dimension("sequence", sample_params["n_ctx"])
+    memory_length_dim = mtf.Dimension("memory_length", sample_params["n_ctx"])
+    other_features = {
+        "attn_bias": biasmask_attn_weights(mesh, length_dim, memory_length_dim, variable_dtype),
+        "embd_dim": mtf.Dimension("embd", sample_params["n_embd"]),
+        "vocab_dim": mtf.Dimension("vocab", sample_params["n_vocab"]),
+        "embed_sequence_dim": mtf.Dimension("embed_sequence", sample_params["n_ctx"]),
+        "memory_length_dim": memory_length_dim
+    }
+    return sample_params, graph, mesh, variable_dtype, other_features
+
+
+def test_beam_search_one_beam_is_greedy():
+    sample_params, graph, mesh, variable_dtype, other_features = beam_search_setup(["global", "local"], 8)
+    prompts = np.array([[1, 0, 0, 0, 0, 0, 0, 0],
+                        [4, 2, 0, 0, 0, 0, 0, 0],
+                        [5, 6, 7, 1, 2, 0, 0, 0]], dtype=np.int32)
+    inputs = mtf.import_tf_tensor(mesh, tf.constant(prompts), mtf.Shape([mtf.Dimension("batch", 3),
+                                                                        mtf.Dimension("sequence", 8)]))
+
+    with tf.compat.v1.variable_scope("", reuse=tf.compat.v1.AUTO_REUSE):
+        samples = [
+            beam_search_autoregressive(inputs, other_features, sample_params, beam_size=1, stop_at_token=3,
+                                       variable_dtype=variable_dtype),
+            sample_autoregressive(inputs, other_features=other_features, params=sample_params,
+                                  variable_dtype=variable_dtype, temperature=0.0, stop_at_token=3)]
+
+    mesh_impl = placement_mesh_impl.PlacementMeshImpl(shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    beam_samples, greedy_samples = [lowering.export_to_tf_tensor(s).numpy() for s in samples]
+    assert (beam_samples == greedy_samples).all()
+
+
+def test_beam_search_batch_split():
+    # with the batch split in two, a batch of one sequence would put its beams on different devices
+    sample_params, graph, mesh, variable_dtype, other_features = beam_search_setup(["global", "global"], 8)
+    sample_params.update({"mesh_shape": "all:2", "layout": "batch:all"})
+    inputs = mtf.import_tf_tensor(mesh, tf.constant([[1, 0, 0, 0, 0, 0, 0, 0]], dtype=tf.int32),
+                                  mtf.Shape([mtf.Dimension("batch", 1), mtf.Dimension("sequence", 8)]))
+
+    with tf.compat.v1.variable_scope("", reuse=tf.compat.v1.AUTO_REUSE):
+        with pytest.raises(ValueError, match="divisible"):
+            beam_search_autoregressive(inputs, other_features, sample_params, beam_size=2,
+                                       variable_dtype=variable_dtype)
+
+
+def test_beam_search_finds_best_sequence():
+    # With as many beams as tokens in the vocab, two steps of beam search are an exhaustive search
+    n_vocab, prompt_length = 4, 2
+    sample_params, graph, mesh, variable_dtype, other_features = beam_search_setup(["global", "global"], n_vocab)
+    length_dim = mtf.Dimension("sequence", 8)
+    prompts = np.array([[2, 1, 0, 0, 0, 0, 0, 0]], dtype=np.int32)
+    inputs = mtf.import_tf_tensor(mesh, tf.constant(prompts), mtf.Shape([mtf.Dimension("batch", 1), length_dim]))
+
+    continuations = np.array(list(itertools.product(range(n_vocab), repeat=2)), dtype=np.int32)
+    candidates = np.tile(prompts, [len(continuations), 1])
+    candidates[:, prompt_length:prompt_length + 2] = continuations
+    candidates_dim = mtf.Dimension("batch", len(candidates))
+    mtf_candidates = mtf.import_tf_tensor(mesh, tf.constant(candidates), mtf.Shape([candidates_dim, length_dim]))
+
+    with tf.compat.v1.variable_scope("", reuse=tf.compat.v1.AUTO_REUSE):
+        samples = beam_search_autoregressive(inputs, other_features, sample_params, beam_size=n_vocab,
+                                             stop_at_token=None, max_steps=2, length_penalty=0.,
+                                             variable_dtype=variable_dtype)
+        with tf.compat.v1.variable_scope("gpt2"):
+            logits, _, _ = gpt2.model({"inputs": mtf_candidates}, other_features, sample_params, mesh,
+                                      variable_dtype=variable_dtype)
+
+    mesh_impl = placement_mesh_impl.PlacementMeshImpl(shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    samples = lowering.export_to_tf_tensor(samples).numpy()
+    log_probs = tf.nn.log_softmax(lowering.export_to_tf_tensor(logits)).numpy()
+
+    positions = np.arange(prompt_length, prompt_length + 2)
+    scores = log_probs[:, positions - 1][np.arange(len(candidates))[:, None], np.arange(2), continuations].sum(-1)
+    assert (samples[0] == candidates[np.argmax(scores)]).all()
+
+@pytest.mark.parametrize("attention_types", [["global"], ["local"]])
+def test_sliding_window_sampling(attention_types):
+    # With a single rotary layer the rebased cache is exactly what a forward pass over the window would compute, so
+    # every token sampled past n_ctx must be the greedy choice given the last window of tokens
+    n_ctx, stride, max_steps = 8, 3, 13
+    sample_params, graph, mesh, variable_dtype, other_features = beam_search_setup(attention_types, 16)
+    sample_params["rotary_emb"] = True
+    length_dim = mtf.Dimension("sequence", n_ctx)
+    prompts = np.array([[5, 6, 7, 0, 0, 0, 0, 0],
+                        [9, 0, 0, 0, 0, 0, 0, 0]], dtype=np.int32)
+    prompt_lengths = [3, 1]
+    batch_dim = mtf.Dimension("batch", 2)
+    inputs = mtf.import_tf_tensor(mesh, tf.constant(prompts), mtf.Shape([batch_dim, length_dim]))
+
+    # Token t is sampled with the window starting at window_starts[t]
+    n_outputs = n_ctx + max_steps
+    window_starts = [0 if t < n_ctx else stride * ((t - n_ctx) // stride + 1) for t in range(n_outputs)]
+    window_indices = np.array([[w + i if w + i < t else -1 for i in range(n_ctx)]
+                               for t, w in enumerate(window_starts)], dtype=np.int32)
+    windows_dim = mtf.Dimension("windows", n_outputs)
+
+    with tf.compat.v1.variable_scope("", reuse=tf.compat.v1.AUTO_REUSE):
+        samples = sample_autoregressive(inputs, other_features=other_features, params=sample_params,
+                                        variable_dtype=variable_dtype, temperature=0.0, stop_at_token=None,
+                                        max_steps=max_steps, sliding_window_stride=stride)
+        indices = mtf.import_tf_tensor(mesh, tf.constant(window_indices), mtf.Shape([windows_dim, length_dim]))
+        outputs = mtf.rename_dimension(samples, "sequence", "outputs")
+        windows = mtf.gather(outputs, mtf.maximum(indices, 0), outputs.shape.dims[-1]) * \
+            mtf.to_int32(mtf.greater_equal(indices, 0))
+        windows = mtf.reshape(mtf.transpose(windows, [batch_dim, windows_dim, length_dim]),
+                              [mtf.Dimension("batch", 2 * n_outputs), length_dim])
+        with tf.compat.v1.variable_scope("gpt2"):
+            logits, _, _ = gpt2.model({"inputs": windows}, other_features, sample_params, mesh,
+                                      variable_dtype=variable_dtype)
+
+    mesh_impl = placement_mesh_impl.PlacementMeshImpl(shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    samples = lowering.export_to_tf_tensor(samples).numpy()
+    greedy = np.argmax(lowering.export_to_tf_tensor(logits).numpy(), -1).reshape(2, n_outputs, n_ctx)
+
+    assert samples.shape == (2, n_outputs)
+    for b, prompt_length in enumerate(prompt_lengths):
+        assert (samples[b, :prompt_length] == prompts[b, :prompt_length]).all()
+        assert (samples[b, prompt_length + max_steps:] == 0).all()
+        for t in range(prompt_length, prompt_length + max_steps):
+            assert samples[b, t] == greedy[b, t, t - window_starts[t] - 1]
+
+# incremental decoding
+
+def incremental_decoding_error(attention_types, n_steps=3, prefill_chunk_size=None, **extra_params):
+    """Max abs difference between the logits of first_part (or chunked) prefill + incremental decoding and those of a
+    full forward pass"""
+    inc_params = defaultdict(lambda: None, {
+        "n_head": 2,
+        "n_ctx": 8,
+        "n_embd": 8,
+        "n_vocab": 32,
+        "embed_dropout": 0.,
+        "n_layer": len(attention_types),
+        "num_microbatches": 1,
+        "causal": True,
+        "attention_types": attention_types,
+        "res_dropout": 0.,
+        "attn_dropout": 0.,
+        "activation_function": "gelu",
+        "mesh_shape": [],
+        "layout": {},
+        "local_attention_radius": 4,
+        "mode": "predict",
+        **extra_params
+    })
+
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    variable_dtype = mtf.VariableDType(tf.float32, tf.float32, tf.float32)
+
+    seq_len = inc_params["n_ctx"]
+    batch_dim = mtf.Dimension("batch", 2)
+    length_dim = mtf.Dimension("sequence", seq_len)
+    memory_length_dim = mtf.Dimension("memory_length", seq_len + inc_params.get("num_mem_kv", 0))
+
+    other_features = {}
+    other_features["attn_bias"] = biasmask_attn_weights(mesh, length_dim, memory_length_dim, variable_dtype)
+    other_features["embd_dim"] = mtf.Dimension("embd", inc_params["n_embd"])
+    other_features["vocab_dim"] = mtf.Dimension("vocab", inc_params["n_vocab"])
+    other_features["embed_sequence_dim"] = mtf.Dimension("embed_sequence", seq_len)
+    other_features["memory_length_dim"] = memory_length_dim
+
+    tokens = np.random.RandomState(0).randint(1, inc_params["n_vocab"], size=(2, seq_len)).astype(np.int32)
+    prompt_lengths = np.array([5, 2], dtype=np.int32)
+    prompts = tokens * (np.arange(seq_len)[None] < prompt_lengths[:, None])
+    full = mtf.import_tf_tensor(mesh, tf.constant(tokens), mtf.Shape([batch_dim, length_dim]))
+    ids = mtf.import_tf_tensor(mesh, tf.constant(prompts), mtf.Shape([batch_dim, length_dim]))
+    position = mtf.import_tf_tensor(mesh, tf.constant(prompt_lengths), mtf.Shape([batch_dim]))
+
+    def _context(mode, **kwargs):
+        return mtf_transformer.transformer.Context(
+            model=None, mesh=mesh, batch_dims=[batch_dim], length_dim=length_dim, variable_dtype=variable_dtype,
+            mode=mode, position_is_default=True, new_states=[], sequence_id=None, **kwargs)
+
+    with tf.compat.v1.variable_scope("", reuse=tf.compat.v1.AUTO_REUSE):
+        if prefill_chunk_size:
+            states = prefill_in_chunks(ids, other_features, inc_params, position, prefill_chunk_size, variable_dtype)
+
+    with tf.compat.v1.variable_scope("gpt2", reuse=tf.compat.v1.AUTO_REUSE):
+        full_logits, _, _ = gpt2.model({"inputs": full}, other_features, inc_params, mesh,
+                                       variable_dtype=variable_dtype)
+        if not prefill_chunk_size:
+            context = _context("first_part", position=mtf.range(mesh, length_dim, tf.int32),
+                               initial_position=position, inputs=ids)
+            gpt2.model({"inputs": ids}, other_features, inc_params, mesh, variable_dtype=variable_dtype,
+                       context=context)
+            states = context.new_states
+
+        step_logits = []
+        for _ in range(n_steps):
+            context = _context("incremental", position=position, initial_position=position, states=states,
+                               inputs=ids)
+            logits, _, _ = gpt2.model({"inputs": ids}, other_features, inc_params, mesh,
+                                      variable_dtype=variable_dtype, context=context)
+            step_logits.append(logits)
+            states = context.new_states
+            # teacher force the next token so the result is comparable to the full forward pass
+            one_hot = mtf.one_hot(position, length_dim, dtype=tf.int32)
+            ids = ids * (1 - one_hot) + full * one_hot
+            position += 1
+
+    mesh_impl = placement_mesh_impl.PlacementMeshImpl(shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    full_logits = lowering.export_to_tf_tensor(full_logits).numpy()
+
+    error = 0.
+    for step, logits in enumerate(step_logits):
+        logits = lowering.export_to_tf_tensor(logits).numpy().reshape(2, -1)
+        for b, prompt_length in enumerate(prompt_lengths):
+            error = max(error, np.abs(logits[b] - full_logits[b, prompt_length - 1 + step]).max())
+    return error
+
+
+@pytest.mark.parametrize("attention_types,extra_params", [
+    (['global', 'global'], {}),
+    (['global', 'global'], {"rotary_emb": True}),
+    (['global', 'global'], {"num_mem_kv": 3}),
+    (['global', 'local'], {"rotary_emb": True}),
+    (['local', 'local'], {"local_attention_radius": 2}),
+    (['linear', 'global'], {}),
+    (['linear', 'linear'], {"rotary_emb": True}),
+    (['chunked_linear', 'global'], {"linear_attention_chunk_size": 2}),
+    (['chunked_linear', 'chunked_linear'], {"linear_attention_chunk_size": 3}),
+    (['global', 'global'], {"attention_block_size": 3}),
+    (['global', 'global'], {"attention_block_size": 2, "num_mem_kv": 3}),
+    # A capacity factor large enough that the full forward pass drops no tokens either
+    (['global', 'local'], {"moe_layers": [0, 1], "moe_params": {"moe_num_experts": 4, "moe_hidden_size": 16,
+                                                              "moe_capacity_factor_eval": 4.,
+                                                              "moe_second_policy_eval": "all"}}),
+])
+def test_incremental_decoding(attention_types, extra_params):
+    assert incremental_decoding_error(attention_types, **extra_params) < 1e-5
+
+
+@pytest.mark.parametrize("attention_types,extra_params", [
+    (['global', 'global'], {"rotary_emb": True}),
+    (['global', 'global'], {"num_mem_kv": 3}),
+    (['global', 'local'], {}),
+    (['local', 'local'], {"local_attention_radius": 2}),
+    (['linear', 'global'], {}),
+    (['chunked_linear', 'local'], {"linear_attention_chunk_size": 2, "rotary_emb": True}),
+])
+@pytest.mark.parametrize("prefill_chunk_size", [1, 3, 8])
+def test_chunked_prefill(attention_types, extra_params, prefill_chunk_size):
+    assert incremental_decoding_error(attention_types, prefill_chunk_size=prefill_chunk_size, **extra_params) < 1e-5
+
+def test_moe_incremental_decoding_routes_per_token():
+    # Identical rows route to the same experts - with expert capacity for one token per group, one of them would be
+    # dropped if the rows were routed as one group
+    moe_params = {"moe_num_experts": 4, "moe_hidden_size": 16, "moe_second_policy_eval": "all"}
+    inc_params = defaultdict(lambda: None, {
+        "n_head": 2, "n_ctx": 8, "n_embd": 8, "n_vocab": 32, "embed_dropout": 0., "n_layer": 1, "num_microbatches": 1,
+        "causal": True, "attention_types": ["global"], "res_dropout": 0., "attn_dropout": 0.,
+        "activation_function": "gelu", "mesh_shape": [], "layout": {}, "mode": "predict", "moe_layers": [0],
+        "moe_params": moe_params})
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    variable_dtype = mtf.VariableDType(tf.float32, tf.float32, tf.float32)
+    batch_dim = mtf.Dimension("batch", 2)
+    length_dim = mtf.Dimension("sequence", 8)
+    memory_length_dim = mtf.Dimension("memory_length", 8)
+    other_features = {
+        "attn_bias": biasmask_attn_weights(mesh, length_dim, memory_length_dim, variable_dtype),
+        "embd_dim": mtf.Dimension("embd", 8),
+        "vocab_dim": mtf.Dimension("vocab", 32),
+        "embed_sequence_dim": mtf.Dimension("embed_sequence", 8),
+        "memory_length_dim": memory_length_dim
+    }
+    prompts = np.array([[3, 5, 7, 0, 0, 0, 0, 0]] * 2, dtype=np.int32)
+    ids = mtf.import_tf_tensor(mesh, tf.constant(prompts), mtf.Shape([batch_dim, length_dim]))
+    position = mtf.constant(mesh, 3, mtf.Shape([batch_dim]), dtype=tf.int32)
+
+    def _context(mode, **kwargs):
+        return mtf_transformer.transformer.Context(
+            model=None, mesh=mesh, batch_dims=[batch_dim], length_dim=length_dim, variable_dtype=variable_dtype,
+            mode=mode, position_is_default=True, new_states=[], inputs=ids, **kwargs)
+
+    with tf.compat.v1.variable_scope("gpt2", reuse=tf.compat.v1.AUTO_REUSE):
+        context = _context("first_part", position=mtf.range(mesh, length_dim, tf.int32), initial_position=position)
+        gpt2.model({"inputs": ids}, other_features, inc_params, mesh, variable_dtype=variable_dtype, context=context)
+        context = _context("incremental", position=position, initial_position=position, states=context.new_states)
+        logits, _, _ = gpt2.model({"inputs": ids}, other_features, inc_params, mesh, variable_dtype=variable_dtype,
+                                  context=context)
+
+    mesh_impl = placement_mesh_impl.PlacementMeshImpl(shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    logits = lowering.export_to_tf_tensor(logits).numpy()
+    assert np.abs(logits[0] - logits[1]).max() < 1e-6
+
+@pytest.mark.parametrize("block_size,num_mem_kv", [(2, 0), (4, 0), (3, 2)])
+def test_blockwise_attention(block_size, num_mem_kv):
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+
+    batch_dim = mtf.Dimension("batch", 2)
+    sequence_dim = mtf.Dimension("sequence", 8)
+    memory_length_dim = mtf.Dimension("memory_length", 8 + num_mem_kv)
+    heads_dim = mtf.Dimension("heads", 2)
+    kv_dim = mtf.Dimension("features_per_head", 4)
+
+    def _random(*dims):
+        shape = mtf.Shape([batch_dim, *dims, heads_dim, kv_dim])
+        return mtf.import_tf_tensor(mesh, tf.random.normal(shape.to_integer_list), shape)
+
+    q, k, v = _random(sequence_dim), _random(memory_length_dim), _random(memory_length_dim)
+
+    bias = biasmask_attn_weights(mesh, sequence_dim, memory_length_dim, mtf.VariableDType(tf.float32))
+    expected = mtf_transformer.attention.attention(q, k, v, memory_length_dim, kv_dim, kv_dim, bias=bias)
+    out = blockwise_attention(q, k, v, memory_length_dim, kv_dim, kv_dim, block_size=block_size, recompute=True)
+    expected_grads = mtf.gradients([mtf.reduce_sum(mtf.square(expected))], [q, k, v])
+    grads = mtf.gradients([mtf.reduce_sum(mtf.square(out))], [q, k, v])
+
+    mesh_impl = placement_mesh_impl.PlacementMeshImpl(shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    for a, b in zip([out] + grads, [expected] + expected_grads):
+        a, b = lowering.export_to_tf_tensor(a).numpy(), lowering.export_to_tf_tensor(b).numpy()
+        assert np.allclose(a, b, atol=1e-4)
+
 # mlm
 
 mlm_params = defaultdict(lambda: None, {
@@ -163,6 +682,376 @@ def test_mlm_sample_text():
         features, labels = mlm_sample_text(mlm_params, document, random_documents = True)
         assert features.shape == (mlm_params['n_ctx'],)
 
+# input
+
+def write_shards(path, name, chunks, packed_dtype=None):
+    """Writes chunks to two tfrecords named like create_tfrecords.py does, as tf.train.Examples or packed bytes"""
+    tag = f"_{packed_dtype}" if packed_dtype else ""
+    half = len(chunks) // 2
+    for i, shard in enumerate([chunks[:half], chunks[half:]]):
+        with tf.io.TFRecordWriter(str(path / f"{name}_{i}{tag}_{len(shard)}.tfrecords")) as writer:
+            for chunk in shard:
+                if packed_dtype:
+                    writer.write(np.asarray(chunk, dtype=np.dtype(packed_dtype).newbyteorder("<")).tobytes())
+                else:
+                    feature = {"text": tf.train.Feature(int64_list=tf.train.Int64List(value=chunk))}
+                    writer.write(tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString())
+    return str(path / f"{name}_*.tfrecords")
+
+
+@pytest.mark.parametrize("packed_dtype", ["uint16", "uint32"])
+def test_packed_records(tmp_path, packed_dtype):
+    n_ctx, batch_size = 6, 2
+    chunks = np.random.RandomState(0).randint(0, 60000, size=(8, n_ctx + 1)).tolist()
+    input_params = defaultdict(lambda: None, {"n_ctx": n_ctx, "train_batch_size": batch_size, "iterations": 1,
+                                              "eos_id": 0, "seed": 1, "shuffle_input_filenames": False})
+
+    batches = {}
+    for fmt in [None, packed_dtype]:
+        path = write_shards(tmp_path, f"shard_{fmt}", chunks, fmt)
+        input_params["dataset_configs"] = {"data": {"path": path}}
+        sequential = [b for _, b in zip(range(3), sequential_input(input_params, global_step=1))]
+        documents = text_dataset(tf.io.gfile.glob(path), input_params, stitch=2, datatype="documents_fixed")
+        batches[fmt] = sequential + [b for _, b in zip(range(3), documents)]
+
+    for (inputs, labels), (packed_inputs, packed_labels) in zip(batches[None], batches[packed_dtype]):
+        assert packed_inputs.shape == inputs.shape and packed_inputs.dtype == inputs.dtype
+        assert (packed_inputs.numpy() == inputs.numpy()).all() and (packed_labels.numpy() == labels.numpy()).all()
+    # resuming skips the first global_step batches
+    assert (batches[None][0][0].numpy() == np.array(chunks)[batch_size:2 * batch_size, :n_ctx]).all()
+
+@pytest.mark.parametrize("global_step", [0, 1, 3, 5, 9])
+def test_sequential_input_manifest_resume(tmp_path, global_step):
+    n_ctx, batch_size = 6, 2
+    chunks = np.random.RandomState(0).randint(0, 60000, size=(9, n_ctx + 1)).tolist()
+    input_params = defaultdict(lambda: None, {"n_ctx": n_ctx, "train_batch_size": batch_size, "iterations": 1,
+                                              "seed": 1, "shuffle_input_filenames": False})
+    # shards of different sizes whose names don't give their number of records - only their manifests do
+    for i, shard in enumerate([chunks[:4], [], chunks[4:5], chunks[5:]]):
+        fp = str(tmp_path / f"shard-{i}.tfrecords")
+        with tf.io.TFRecordWriter(fp) as writer:
+            for chunk in shard:
+                feature = {"text": tf.train.Feature(int64_list=tf.train.Int64List(value=chunk))}
+                writer.write(tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString())
+        with open(fp + ".json", "w") as f:
+            json.dump({"n_records": len(shard), "n_bytes": os.path.getsize(fp), "sha256": None,
+                       "packed_dtype": None}, f)
+    # the glob also matches the manifests, which aren't input files
+    input_params["dataset_configs"] = {"data": {"path": str(tmp_path / "shard-*")}}
+
+    inputs, labels = next(iter(sequential_input(input_params, global_step=global_step)))
+    # resuming continues exactly where global_step batches left off, wrapping around after an epoch
+    expected = np.array(chunks)[np.arange(global_step * batch_size, (global_step + 1) * batch_size) % len(chunks)]
+    assert (inputs.numpy() == expected[:, :n_ctx]).all() and (labels.numpy() == expected[:, 1:]).all()
+
+    # a manifest that doesn't match its file is an error, rather than a wrong resume
+    with open(tmp_path / "shard-0.tfrecords", "ab") as f:
+        f.write(b"0")
+    with pytest.raises(ValueError):
+        sequential_input(input_params, global_step=global_step)
+
+
+def test_sequential_input_no_records(tmp_path):
+    fp = str(tmp_path / "shard_0.tfrecords")
+    with tf.io.TFRecordWriter(fp):
+        pass
+    with open(fp + ".json", "w") as f:
+        json.dump({"n_records": 0, "n_bytes": os.path.getsize(fp), "sha256": None, "packed_dtype": None}, f)
+    input_params = defaultdict(lambda: None, {"n_ctx": 6, "train_batch_size": 2, "iterations": 1,
+                                              "dataset_configs": {"data": {"path": fp}}})
+    with pytest.raises(ValueError, match="no records"):
+        sequential_input(input_params, global_step=1)
+
+
+def test_flat_input(tmp_path):
+    n_ctx, batch_size = 6, 2
+    chunks = np.random.RandomState(0).randint(0, 60000, size=(8, n_ctx + 1)).tolist()
+    input_params = defaultdict(lambda: None, {"n_ctx": n_ctx, "train_batch_size": batch_size, "iterations": 1,
+                                              "seed": 1, "shuffle_input_filenames": False})
+    # flat shards as written by create_tfrecords.py --flat, including an empty one
+    for i, shard in enumerate([chunks[:3], [], chunks[3:]]):
+        np.asarray(shard, dtype="<u2").tofile(str(tmp_path / f"flat_{i}_uint16_{len(shard)}.bin"))
+        with open(tmp_path / f"flat_{i}_uint16_{len(shard)}.idx", "wb") as f:
+            np.save(f, np.arange(len(shard) + 1) * (n_ctx + 1))
+
+    shards = FlatTokenShards(sorted(tf.io.gfile.glob(str(tmp_path / "flat_*.bin"))))
+    assert len(shards) == len(chunks)
+    assert all((shards[i] == chunks[i]).all() for i in range(len(chunks)))
+    assert isinstance(shards[5], np.memmap)
+
+    input_params["dataset_configs"] = {"data": {"path": write_shards(tmp_path, "shard", chunks)}}
+    sequential = [b for _, b in zip(range(5), sequential_input(input_params, global_step=1))]
+    input_params["dataset_configs"] = {"data": {"path": str(tmp_path / "flat_*.bin")}}
+    flat = [b for _, b in zip(range(5), flat_input(input_params, global_step=1))]
+    for (inputs, labels), (flat_inputs, flat_labels) in zip(sequential, flat):
+        assert flat_inputs.dtype == inputs.dtype
+        assert (flat_inputs.numpy() == inputs.numpy()).all() and (flat_labels.numpy() == labels.numpy()).all()
+
+# data
+
+DOCS = ["the cat sat on the mat", "a dog", "the dog sat on the cat and the mat sat on a dog", "cat",
+        "on a mat the cat sat", "dog dog dog", "the end"]
+
+
+def write_archives(path, docs_per_archive):
+    # writes each list of documents to an lm_dataformat archive, like the ones create_tfrecords.py reads
+    archive = Archive(str(path / "archives"))
+    for i, docs in enumerate(docs_per_archive):
+        for doc in docs:
+            archive.add_data(doc)
+        archive.commit(f"{i:02d}")
+    return natural_sort(get_files(str(path / "archives")))
+
+
+def write_tokenizer(path):
+    words = sorted(set(" ".join(DOCS).split()))
+    tokenizer = Tokenizer(WordLevel({word: i for i, word in enumerate(["[UNK]"] + words)}, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = Whitespace()
+    tokenizer.save(str(path / "tokenizer.json"))
+    return str(path / "tokenizer.json")
+
+
+def create_tfrecords_args(path, *argv):
+    return parse_args(["--input_dir", str(path / "archives"), "--output_dir", str(path / "out"),
+                       "--encoder_path", str(path / "tokenizer.json"), "--separator", "99", "--chunk_size", "4",
+                       "--minimum_size", "1", "--ftfy", "--wikitext-detokenize", *argv])
+
+
+@pytest.mark.parametrize("tokenize_batch_size", [1, 3, 1024])
+def test_archive_to_tokens_batched(tmp_path, tokenize_batch_size):
+    archive, = write_archives(tmp_path, [DOCS])
+    encoder = Tokenizer.from_file(write_tokenizer(tmp_path))
+    args = create_tfrecords_args(tmp_path, "--tokenize_batch_size", str(tokenize_batch_size))
+    prefix = [97, 98]  # the remainder of a chunk carried over from the previous archive
+
+    # one encode per document, as before documents were tokenized in batches
+    expected, doc_prefix = [], prefix
+    for doc in DOCS:
+        expected.append(split_list(doc_prefix + encoder.encode(doc).ids + args.separator, args.chunk_size))
+        doc_prefix = []
+
+    assert list(archive_to_tokens(archive, encoder, args, prefix=prefix)) == expected
+
+
+def test_schedule_files(tmp_path):
+    files = []
+    for i, size in enumerate([5, 1, 1, 1, 4, 4]):
+        files.append(str(tmp_path / f"{i}.txt"))
+        with open(files[-1], "w") as f:
+            f.write("x" * size)
+
+    # 3 groups of consecutive files, largest first
+    assert schedule_files(files, 3) == [(2, files[4:]), (0, files[:1]), (1, files[1:4])]
+    assert schedule_files(files, 1) == [(0, files)]
+    assert sorted(f for _, group in schedule_files(files, 100) for f in group) == files
+
+
+def test_create_tfrecords_mp_deterministic(tmp_path):
+    archives = write_archives(tmp_path, [DOCS[:2], DOCS[2:3], DOCS[3:5], DOCS[5:]])
+    write_tokenizer(tmp_path)
+    args = create_tfrecords_args(tmp_path, "--files_per", "2", "--processes", "2", "--tasks_per_process", "2",
+                                 "--flat")
+    os.makedirs(args.output_dir)
+
+    def outputs():
+        # every output file and its contents, besides the shared checkpoint
+        return {name: open(os.path.join(args.output_dir, name), "rb").read() for name in os.listdir(args.output_dir)
+                if name != "checkpoint.txt"}
+
+    # each group of files written by one process, one group at a time
+    expected_meta = collections.Counter()
+    for task_no, task_files in schedule_files(archives, args.processes * args.tasks_per_process):
+        expected_meta.update(create_tfrecords((task_files, args, task_no)))
+    expected = outputs()
+    assert expected
+
+    for _ in range(2):
+        shutil.rmtree(args.output_dir)
+        os.makedirs(args.output_dir)
+        assert create_tfrecords_mp(archives, args) == dict(expected_meta)
+        assert outputs() == expected
+
+
+# prediction
+
+@pytest.mark.parametrize("n_prompt_tokens,predict_max_steps,buckets,expected", [
+    (50, 100, None, 256),
+    (50, 300, None, 512),
+    (1000, 100, None, 2048),
+    (50, None, None, 2048),
+    (50, 10, [64, 128], 64),
+    (50, 100, [64, 4096], 2048),
+])
+def test_get_prediction_length(n_prompt_tokens, predict_max_steps, buckets, expected):
+    pred_params = defaultdict(lambda: None, {
+        "n_ctx": 2048,
+        "predict_max_steps": predict_max_steps,
+        "predict_length_buckets": buckets
+    })
+    assert get_prediction_length(pred_params, n_prompt_tokens) == expected
+
+def test_batch_prompts():
+    pred_params = defaultdict(lambda: None, {
+        "n_ctx": 2048,
+        "predict_max_steps": 100,
+        "predict_batch_size": 2
+    })
+    prompts = [("a", [1] * 500), ("b", [1] * 10), ("c", [1] * 20), ("d", [1] * 30)]
+    buckets = batch_prompts(pred_params, prompts)
+
+    assert sorted(buckets.keys()) == [256, 1024]
+    assert [prompt_id for prompt_id, _ in buckets[256]] == ["b", "c", "d", None]
+    assert [prompt_id for prompt_id, _ in buckets[1024]] == ["a", None]
+
+class CharEncoder:
+    def batch_decode(self, token_lists):
+        return ["".join(chr(t) for t in tokens) for tokens in token_lists]
+
+def test_prediction_writer(tmp_path):
+    pred_params = defaultdict(lambda: None, {
+        "eos_id": 0,
+        "padding_id": 1,
+        "remove_partial_sequences": False
+    })
+    prompts = [("a", [ord("h"), ord("i")]), ("b", [ord("y")]), (None, [ord("y")])]
+    predictions = [{"outputs": np.array(list(map(ord, "hi there")) + [0, 65])},
+                   {"outputs": np.array(list(map(ord, "yo")) + [1, 1, 1])},
+                   {"outputs": np.array(list(map(ord, "yo")))}]
+
+    path = str(tmp_path / "predictions.jsonl")
+    with PredictionWriter(path, CharEncoder(), logging.getLogger(), batch_size=2) as writer:
+        handle_prompts_pred_output(predictions, pred_params, prompts, writer)
+
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert records == [{"id": "a", "prompt": "hi", "completion": " there"},
+                       {"id": "b", "prompt": "y", "completion": "o"}]
+
+def test_prediction_writer_error(tmp_path):
+    decoding = threading.Event()
+
+    class FailingEncoder(CharEncoder):
+        # holds the first batch until the last prediction and the end of input are queued, then fails on that batch
+        def batch_decode(self, token_lists):
+            if token_lists == [[ord("a")]]:
+                decoding.set()
+                while writer._queue.qsize() < 2:
+                    time.sleep(0.01)
+                return super().batch_decode(token_lists)
+            raise ValueError("can't decode")
+
+    writer = PredictionWriter(str(tmp_path / "predictions.jsonl"), FailingEncoder(), logging.getLogger(),
+                              batch_size=2)
+    errors = []
+
+    def write():
+        try:
+            with writer:
+                writer.write({"id": "a"}, completion=[ord("a")])
+                decoding.wait()
+                writer.write({"id": "b"}, completion=[ord("b")])
+        except ValueError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=write, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    # the writer stops and re-raises, even though it failed after taking the end of input off the queue
+    assert not thread.is_alive() and len(errors) == 1
+
+def test_prediction_writer_error_in_with_block(tmp_path):
+    class FailingEncoder(CharEncoder):
+        def batch_decode(self, token_lists):
+            raise ValueError("can't decode")
+
+    # an error raised in the with block isn't replaced by the writer's own
+    with pytest.raises(KeyError):
+        with PredictionWriter(str(tmp_path / "predictions.jsonl"), FailingEncoder(), logging.getLogger()) as writer:
+            writer.write({"id": "a"}, completion=[ord("a")])
+            while writer._error is None:
+                time.sleep(0.01)
+            raise KeyError("prediction failed")
+
+# serving
+
+def serving_params(**extra_params):
+    return defaultdict(lambda: None, {
+        "n_head": 2,
+        "n_ctx": 16,
+        "n_embd": 8,
+        "n_vocab": 32,
+        "embed_dropout": 0.,
+        "n_layer": 2,
+        "num_microbatches": 1,
+        "causal": True,
+        "attention_types": ["global", "local"],
+        "res_dropout": 0.,
+        "attn_dropout": 0.,
+        "activation_function": "gelu",
+        "mesh_shape": [],
+        "layout": {},
+        "local_attention_radius": 4,
+        "mode": "predict",
+        **extra_params
+    })
+
+@pytest.mark.parametrize("extra_params", [
+    {},
+    {"moe_layers": [1], "moe_params": {"moe_num_experts": 4, "moe_hidden_size": 16, "moe_second_policy_eval": "all"}},
+])
+def test_continuous_batching(extra_params):
+    engine = InferenceEngine(serving_params(**extra_params), batch_size=2, temperature=0.0)
+    batcher = ContinuousBatcher(engine, eos_id=-1)
+    prompts = [[1, 2, 3, 4, 5], [7], [3, 3, 3, 9, 1, 2, 8], [5, 6]]
+    max_steps = [3, 8, 5, 20]
+
+    # greedy completions must not depend on which other requests share the batch
+    alone = [batcher.submit(tokens, steps).result(timeout=60) for tokens, steps in zip(prompts, max_steps)]
+    requests = [batcher.submit(tokens, steps) for tokens, steps in zip(prompts, max_steps)]
+    together = [list(request.stream(timeout=60)) for request in requests]
+
+    assert [len(completion) for completion in alone] == [3, 8, 5, 14]
+    assert together == alone
+
+@pytest.mark.parametrize("restore_chunk_size", [2, 64])
+def test_prefix_cache(restore_chunk_size):
+    engine = InferenceEngine(serving_params(attention_types=["global", "global"], rotary_emb=True), batch_size=2,
+                             temperature=0.0, restore_chunk_size=restore_chunk_size)
+    preamble = [3, 1, 4, 1, 5, 9, 2, 6, 5]
+    prompts = [preamble + [7, 7], preamble + [8], preamble + [2, 2, 2, 2]]
+
+    batcher = ContinuousBatcher(engine, eos_id=-1)
+    expected = [batcher.submit(tokens, 4).result(timeout=60) for tokens in prompts]
+
+    prefix_cache = PrefixCache(max_bytes=10 ** 6, block_size=4)
+    batcher = ContinuousBatcher(engine, eos_id=-1, prefix_cache=prefix_cache)
+    assert [batcher.submit(tokens, 4).result(timeout=60) for tokens in prompts] == expected
+    # the first prompt is prefilled, the others restore its first 8 tokens
+    assert prefix_cache.stats()["hits"] == 2
+    assert prefix_cache.tokens_saved == 16
+
+    # the least recently used entry is evicted once the budget is exceeded
+    entry_bytes = prefix_cache.bytes
+    prefix_cache.max_bytes = entry_bytes
+    states = engine.read_states(0)
+    prefix_cache.insert([1] * 9, states, engine.state_sequence_axes)
+    assert prefix_cache.bytes == entry_bytes
+    assert prefix_cache.lookup(prompts[0], engine.state_sequence_axes)[0] == 0
+    assert prefix_cache.lookup([1] * 12, engine.state_sequence_axes)[0] == 8
+
+class ByteEncoder:
+    def batch_decode(self, token_lists):
+        return [bytes(tokens).decode("utf-8", errors="replace") for tokens in token_lists]
+
+def test_generation_request_stream():
+    request = GenerationRequest([1], max_steps=8)
+    for token in "hé!".encode("utf-8"):
+        request.append(token)
+    request.finish()
+
+    # "é" is two tokens, and is only yielded once both have been sampled
+    assert list(request.stream_text(ByteEncoder(), timeout=1)) == ["h", "é", "!"]
+
 # entmax
 
 def test_entmax():
@@ -178,3 +1067,35 @@ def test_entmax():
     lowering = mtf.Lowering(graph, {mesh: mesh_impl})
     sample = lowering.export_to_tf_tensor(sample)
     grad = lowering.export_to_tf_tensor(grad)
+
+# sampling
+
+def _samples(sample_fn, probs, n_samples=2000):
+    graph = mtf.Graph()
+    mesh = mtf.Mesh(graph, "my_mesh")
+    batch_dim = mtf.Dimension("batch", n_samples)
+    vocab_dim = mtf.Dimension("vocab", len(probs))
+    probs = mtf.import_tf_tensor(mesh, tf.constant(np.tile(np.array(probs, dtype=np.float32), (n_samples, 1))),
+                                 mtf.Shape([batch_dim, vocab_dim]))
+    ids = sample_fn(probs, vocab_dim)
+
+    mesh_impl = placement_mesh_impl.PlacementMeshImpl(shape=[], layout={}, devices=[""])
+    lowering = mtf.Lowering(graph, {mesh: mesh_impl})
+    return lowering.export_to_tf_tensor(ids).numpy()
+
+@pytest.mark.parametrize("sampling_kwargs,allowed", [
+    ({}, {0, 1, 2, 3, 4, 5}),
+    ({"sampling_keep_top_k": 3}, {0, 1, 2}),
+    ({"sampling_top_p": 0.7}, {0, 1}),
+    ({"sampling_top_p": 0.85, "sampling_top_p_candidates": 4}, {0, 1, 2}),
+    ({"sampling_keep_top_k": 2, "sampling_top_p": 0.85}, {0, 1}),
+])
+def test_sample_logits(sampling_kwargs, allowed):
+    probs = [0.5, 0.3, 0.1, 0.05, 0.03, 0.02]
+    ids = _samples(lambda p, dim: sample_logits(mtf.log(p), dim, temperature=1.0, **sampling_kwargs), probs)
+    assert set(ids) == allowed
+
+def test_sample_categorical():
+    ids = _samples(sample_categorical, [0.6, 0.4, 0., 0.])
+    assert set(ids) == {0, 1}
+    assert abs((ids == 0).mean() - 0.6) < 0.05
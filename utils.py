@@ -286,6 +286,29 @@ def create_host_call(model_dir):
     return host_call_fn, [global_step_t] + reshaped_tensors
 
 
+class ScopedRestoreHook(tf.estimator.SessionRunHook):
+    """Restores the variables under scope from the latest checkpoint in checkpoint_dir, where they have no scope.
+
+    Used to load a second model (e.g the draft model of speculative decoding) into the graph of the first. Must come
+    before the mtf.MtfRestoreHook, which copies the restored variables to their slices.
+    """
+
+    def __init__(self, checkpoint_dir, scope):
+        self._checkpoint_dir = checkpoint_dir
+        self._scope = scope
+
+    def begin(self):
+        prefix = self._scope + "/"
+        var_list = {v.op.name[len(prefix):]: v for v in tf.global_variables() if v.op.name.startswith(prefix)}
+        self._saver = tf.train.Saver(var_list)
+
+    def after_create_session(self, session, coord):
+        checkpoint = tf.train.latest_checkpoint(self._checkpoint_dir)
+        if checkpoint is None:
+            raise ValueError(f"No checkpoint found in {self._checkpoint_dir}")
+        self._saver.restore(session, checkpoint)
+
+
 def natural_sort(l): 
     convert = lambda text: int(text) if text.isdigit() else text.lower() 
     alphanum_key = lambda key: [ convert(c) for c in re.split('([0-9]+)', key) ] 